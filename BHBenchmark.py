@@ -0,0 +1,1013 @@
+# -*- coding: utf-8 -*-
+
+"""
+@author: Tyler Landowski
+"""
+
+# Micro-benchmarks for BHServer's hot paths, and end-to-end benchmarks with synthetic clients. No emulator is needed.
+# Usage: python BHBenchmark.py [--json path] [benchmark ...]   (runs every benchmark if none are given)
+# Given --json, every benchmark's results are also saved to path, so runs can be compared
+# Exits with an error if a check fails, such as import_time going over its budget
+
+import sys
+import os
+import subprocess
+import socket
+import threading
+import time
+import io
+import tempfile
+import base64
+import json
+import argparse
+from urllib.parse import quote_plus  # Encoding statements like comm.httpPost()
+import numpy as np
+import matplotlib.image as mpimg  # Encoding PNG screenshots
+from BHServer import BHServer, ScreenshotHistory, ActionSpace, DECODERS, to_grayscale, Crop, Grayscale, Resize, Stack, ReplayBuffer, SaveSampler, DemonstrationWriter, SharedObservationRing
+
+# Most seconds a cold "import BHServer" may take
+IMPORT_BUDGET = 0.3
+# Packages a cold "import BHServer" must not import
+LAZY_IMPORTS = ("matplotlib", "PIL")
+
+# Screen sizes of emulated systems, (height, width)
+RESOLUTIONS = {
+    "NES": (240, 256),
+    "N64": (240, 320),
+}
+
+
+# Stands in for a client socket. Records the size of everything the server sends back
+class NullSocket:
+    def __init__(self, received = b"", chunk = 16384):
+        self.received = received  # Bytes handed out by recv()
+        self.chunk = chunk        # Most bytes handed out by a single recv(), like a TCP socket's buffer
+        self.sent = 0             # Number of bytes sent by the server
+
+    def send(self, data):
+        self.sent += len(data)
+        return len(data)
+
+    def recv(self, bufsize):
+        bufsize = min(bufsize, self.chunk)
+        data, self.received = self.received[:bufsize], self.received[bufsize:]
+        return data
+
+    def recv_into(self, buffer, nbytes = 0):
+        data = self.recv(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+# Server whose update() does nothing, so only message handling is timed
+class BenchServer(BHServer):
+    def update(self):
+        pass
+
+
+# Returns a server that never opens a socket. Takes the same arguments as BHServer
+def make_server(**kwargs):
+    return BenchServer(saves = {"Save/Bench.State": 1}, **kwargs)
+
+
+# Returns the headers of an HTTP POST, formatted like BizHawk's comm.http* functions, given a url-encoded body
+# A client id is given as the path
+def make_post(body, client_id = ""):
+    return (
+        "POST /" + client_id + " HTTP/1.1\r\n"
+        "Content-Type: application/x-www-form-urlencoded\r\n"
+        "Host: 127.0.0.1:1337\r\n"
+        "Content-Length: " + str(len(body)) + "\r\n"
+        "Expect: 100-continue\r\n"
+        "Connection: Keep-Alive\r\n\r\n"
+    ).encode("utf-8")
+
+
+# Returns the bytes of a PNG, given (height, width). Made of 8x8 tiles of random colors, like a game frame
+def make_png(shape, seed = 0):
+    tiles = np.random.default_rng(seed).integers(0, 256, (shape[0] // 8, shape[1] // 8, 3), dtype = np.uint8)
+    img = tiles.repeat(8, axis = 0).repeat(8, axis = 1)
+    png = io.BytesIO()
+    mpimg.imsave(png, img, format = "png")
+    return png.getvalue()
+
+
+# Returns the body comm.httpPostScreenshot() sends, given the bytes of a PNG
+def make_screenshot_body(png):
+    return ("screenshot=" + quote_plus(base64.b64encode(png).decode("ascii"))).encode("ascii")
+
+
+# Returns a free local TCP port
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# Starts a server in a new process, given BHServer arguments as Python source. Returns (process, port)
+# Each line written to the process's stdin is answered with its usage, read by server_usage()
+def start_server_process(args = ""):
+    port = free_port()
+    code = (
+        "import sys, resource\n"
+        "from BHBenchmark import BenchServer\n"
+        "BenchServer(port = {}, saves = {{'Save/Bench.State': 1}}, headless = True, {}).start()\n"
+        "for line in sys.stdin:\n"
+        "    usage = resource.getrusage(resource.RUSAGE_SELF)\n"
+        "    print(usage.ru_nvcsw + usage.ru_nivcsw, usage.ru_utime + usage.ru_stime, flush = True)\n"
+    ).format(port, args)
+    process = subprocess.Popen(
+        [sys.executable, "-c", code],
+        cwd = os.path.dirname(os.path.abspath(__file__)),
+        stdin = subprocess.PIPE,
+        stdout = subprocess.PIPE,
+        text = True
+    )
+
+    # Wait for the server to listen
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return process, port
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    process.kill()
+    sys.exit("Server failed to start")
+
+
+# Returns (context switches, CPU seconds) of a process started by start_server_process(), every thread included
+def server_usage(process):
+    process.stdin.write("\n")
+    process.stdin.flush()
+    switches, cpu = process.stdout.readline().split()
+    return int(switches), float(cpu)
+
+
+# Sends one HTTP POST on a new connection, reads the response until the server closes. Returns the latency
+def post_once(port, post):
+    start = time.perf_counter()
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.sendall(post)
+        while sock.recv(65536):
+            pass
+    return time.perf_counter() - start
+
+
+# Stands in for BizHawk running BHClient.lua, over real connections, so the server can be benchmarked end to end
+# Sends what BizHawk's comm.http* functions send: the headers of a POST, then its url-encoded body once the server
+# answers them, on a new connection that the server closes after its response
+class SyntheticClient:
+    def __init__(self, port, client_id = "", resolution = "NES", seed = 0, ip = "127.0.0.1"):
+        self.addr = (ip, port)
+        self.client_id = client_id
+        self.screenshot_body = make_screenshot_body(make_png(RESOLUTIONS[resolution], seed))
+
+        # Set by the server, like BHClient.lua
+        self.rom = None
+        self.save = None
+        self.update_interval = 0
+        self.controls = {}
+        self.episodes = 0
+        self.mode = "AI"
+
+    # Sends one POST, given its body. Returns the body of the server's response
+    def post(self, body):
+        with socket.create_connection(self.addr) as sock:
+            sock.sendall(make_post(body, self.client_id))
+
+            # Expect: 100-continue. The server answers the headers before the body is sent
+            response = sock.recv(65536)
+            interim = len(response)
+            sock.sendall(body)
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk: break
+                response += chunk
+
+        response = response[interim:] or response
+        return response[response.find(b"\r\n\r\n") + 4:].decode("utf-8")
+
+    # Sends statements like comm.httpPost(), given as a string. Returns each statement's response (BHClient:sendStr())
+    def send_str(self, statements):
+        response = self.post(("payload=" + quote_plus(statements)).encode("utf-8"))
+        return response.split("; ")
+
+    # Sends a list of statements. Returns each statement's response (BHClient:sendList())
+    def send_list(self, statements):
+        return self.send_str("; ".join(statements))
+
+    # Sends a screenshot like comm.httpPostScreenshot(): the PNG in Base64, url-encoded (BHClient:saveScreenshot())
+    def save_screenshot(self):
+        self.post(self.screenshot_body)
+
+    # Loads settings from the server (BHClient:initialize(), both passes)
+    def initialize(self):
+        self.rom = self.send_str("GET rom")[0]
+        self.save, update_interval, _, _, _, self.mode = self.send_list(
+            ["RESET", "GET save", "GET update_interval", "GET sound", "GET speed", "GET frameskip", "GET mode"])
+        self.update_interval = int(update_interval)
+
+    # One step of SampleTool.lua's loop: saves a screenshot, sends data, and reads controls. Returns whether to exit
+    def step(self):
+        self.save_screenshot()
+        _, controls, restart, exit = self.send_list(
+            ["SET x INT 512", "GET x", "UPDATE", "GET controls", "GET restart", "GET exit"])
+
+        self.controls = dict(pair.split(":") for pair in controls.split(",") if pair)
+        if restart == "True": self.episodes += 1
+        return exit == "True"
+
+
+# Returns the given percentile of a sorted list
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+# Calls fn() repeatedly for about the given number of seconds. Returns (calls, elapsed seconds)
+def repeat(fn, seconds):
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < seconds:
+        for _ in range(100):
+            fn()
+        calls += 100
+        elapsed = time.perf_counter() - start
+    return calls, elapsed
+
+
+#
+# Benchmarks
+#
+
+# Statements parsed per second by handle_msg(), for a typical client step and for an HTTP-wrapped step
+def bench_statements(seconds = 2.0):
+    server = make_server()
+    sock = NullSocket()
+
+    # The statements sent by SampleTool.lua every update
+    statements = [
+        "SET x INT 512",
+        "SET y INT[] [1, 2, 3]",
+        "SET y 3 4",
+        "GET x",
+        "GET y 1",
+        "UPDATE",
+        "GET controls",
+        "GET restart",
+        "GET exit",
+        "GET guessed",
+    ]
+    msg = "; ".join(statements).encode("utf-8")
+
+    # The same statements, as sent through comm.httpPost()
+    body = ("payload=" + quote_plus(msg)).encode("utf-8")
+    post = make_post(body) + body
+
+    results = {}
+    for name, m in (("plain", msg), ("http", post)):
+        server.data = dict()
+        calls, elapsed = repeat(lambda: server.handle_msg(m, sock), seconds)
+        results[name] = calls * len(statements) / elapsed
+        print("statements/{:<6} {:>12,.0f} statements/sec".format(name, results[name]))
+
+    return results
+
+
+# Values set per second by the client, such as RAM features sent every step. Each value is sent as its own SET
+# statement (SET f idx val), every value at once as a slice (SET f 0: [...]), or as bytes of memory (RAM addr hex)
+def bench_data(seconds = 1.0, features = 64):
+    server = make_server()
+    values = np.random.default_rng(0).integers(0, 256, features).tolist()
+    server.handle_statements("SET f INT[] " + str(values), None)
+
+    messages = {
+        "elements": "; ".join("SET f {} {}".format(i, v) for i, v in enumerate(values)),
+        "slice": "SET f 0: " + str(values),
+        "ram": "RAM 0 " + bytes(values).hex(),
+    }
+
+    results = {}
+    for name, msg in messages.items():
+        calls, elapsed = repeat(lambda: server.handle_statements(msg, None), seconds)
+        results[name] = calls * features / elapsed
+        print("data/{:<9} {:>12,.0f} values/sec".format(name, results[name]))
+
+    return results
+
+
+# Screenshot POSTs received per second by handle_msg(), with the body sent after the headers like BizHawk does
+def bench_screenshot_post(seconds = 2.0):
+    results = {}
+
+    for system, shape in RESOLUTIONS.items():
+        server = make_server()
+        body = make_screenshot_body(make_png(shape))
+        post = make_post(body)
+
+        # Hand out the body in chunks, like a socket would
+        def receive():
+            sock = NullSocket(body)
+            server.handle_msg(post, sock)
+
+        calls, elapsed = repeat(receive, seconds)
+        results[system] = calls / elapsed
+        print("screenshot_post/{:<4} {:>8,.0f} screenshots/sec ({:,} byte body)".format(
+            system, results[system], len(body)))
+
+    return results
+
+
+# Screenshots stored per second for many clients, each POSTing an NES screenshot then sending UPDATE, decoding before
+# answering each POST, or on 1 to 4 decode_threads. Also how long each POST waits for its answer, and each frame to be
+# stored (p50/p99). With decode_threads, a frame is stored while its client moves on to UPDATE
+def bench_decode_pool(steps = 100, clients = 8, threads = (None, 1, 2, 4)):
+    bodies = [make_screenshot_body(make_png(RESOLUTIONS["NES"], seed)) for seed in range(4)]
+    results = {}
+
+    for count in threads:
+        server = make_server(screenshot_decoder = "pillow", decode_threads = count)
+        sessions = [server.get_session("emu" + str(idx)) for idx in range(clients)]
+        answers = []
+
+        start = time.perf_counter()
+        for step in range(steps):
+            for session in sessions:
+                with server.using_session(session):
+                    posted = time.perf_counter()
+                    server.handle_post_body(bodies[step % len(bodies)], None)
+                    answers.append(time.perf_counter() - posted)
+            for session in sessions:
+                with server.using_session(session):
+                    server.handle_update("", None)
+        elapsed = time.perf_counter() - start
+
+        answers.sort()
+        frames = server.stats.snapshot()
+        name = "inline" if count is None else "threads/" + str(count)
+        results[name] = {
+            "screenshots/sec": steps * clients / elapsed,
+            "answer p50": percentile(answers, 50),
+            "frame p50": (frames["screenshot_p50_us"] / 1e6) if count is not None else percentile(answers, 50),
+            "frame p99": (frames["screenshot_p99_us"] / 1e6) if count is not None else percentile(answers, 99),
+        }
+        r = results[name]
+        print("decode_pool/{:<9} {:>6,.0f} screenshots/sec, POST answered in {:.3f} ms, frame stored p50 {:.2f} ms, "
+              "p99 {:.2f} ms".format(name, r["screenshots/sec"], r["answer p50"] * 1e3, r["frame p50"] * 1e3,
+                                     r["frame p99"] * 1e3))
+
+    return results
+
+
+# Screenshots decoded per second by each decoder, in color and grayscale, at NES and N64 resolutions
+def bench_decode(seconds = 1.0):
+    results = {}
+
+    for system, shape in RESOLUTIONS.items():
+        png = make_png(shape)
+
+        for decoder in DECODERS:
+            for grayscale in (False, True):
+                server = make_server(screenshot_decoder = decoder, use_grayscale = grayscale)
+                calls, elapsed = repeat(lambda: server.store_screenshot(png), seconds)
+
+                name = "{}/{}/{}".format(system, decoder, "gray" if grayscale else "color")
+                results[name] = calls / elapsed
+                print("decode/{:<20} {:>8,.0f} screenshots/sec ({})".format(
+                    name, results[name], server.screenshots[0].dtype))
+
+    return results
+
+
+# Steps per second and memory per screenshot, preprocessing an N64 screenshot into a stack of 4 84x84 grayscale
+# observations (Atari-style), in update() after storing it in full as floats, or once on arrival with a pipeline
+def bench_pipeline(seconds = 1.0):
+    png = make_png(RESOLUTIONS["N64"])
+    results = {}
+
+    # Preprocesses in update(), like tools did before pipelines
+    def update_step(server):
+        server.actions += 1
+        server.store_screenshot(png)
+        frames = []
+        for key in server.screenshots.keys()[-4:]:
+            img = BHServer.crop_percent(server.screenshots[key], 0.1, 0, 0.1, 0)
+            img = to_grayscale(img)
+            rows = np.linspace(0, img.shape[0] - 1, 84).astype(int)
+            cols = np.linspace(0, img.shape[1] - 1, 84).astype(int)
+            frames.append(img[rows][:, cols])
+        return np.stack(frames)
+
+    # Preprocesses on arrival. update() only reads the stack
+    def pipeline_step(server):
+        server.actions += 1
+        server.store_screenshot(png)
+        return server.observation
+
+    for name, step, kwargs in (
+            ("update", update_step, {}),
+            ("pipeline", pipeline_step, {"pipeline": [Crop(0.1, 0, 0.1, 0), Grayscale(), Resize(84, 84), Stack(4)]}),
+    ):
+        for decoder in DECODERS:
+            server = make_server(screenshot_decoder = decoder, **kwargs)
+            calls, elapsed = repeat(lambda: step(server), seconds)
+            key = "{}/{}".format(name, decoder)
+            results[key] = {
+                "steps/sec": calls / elapsed,
+                "bytes/screenshot": server.screenshots.nbytes // server.screenshots.capacity,
+            }
+            print("pipeline/{:<19} {:>7,.0f} steps/sec, {:>7,} bytes/screenshot".format(
+                key, results[key]["steps/sec"], results[key]["bytes/screenshot"]))
+
+    return results
+
+
+# Frames added and minibatches of 32 transitions sampled per second by a full ReplayBuffer of 84x84 frames, stacked by 4,
+# sampled uniformly and by priority. Memory is compared to storing both stacked observations of every transition
+def bench_replay(seconds = 1.0, capacity = 100000, batch_size = 32):
+    shape = (84, 84)
+    frames = np.random.default_rng(0).integers(0, 256, (64,) + shape, dtype = np.uint8)
+    results = {}
+
+    for name, prioritized in (("uniform", False), ("prioritized", True)):
+        replay = ReplayBuffer(capacity, history = 4, prioritized = prioritized, seed = 0)
+        for i in range(capacity):
+            replay.add(frames[i % len(frames)], i % 8, 1.0, i % 1000 == 999)
+
+        added = [0]
+        def add():
+            replay.add(frames[added[0] % len(frames)], 0, 1.0)
+            added[0] += 1
+        adds, add_elapsed = repeat(add, seconds / 2)
+
+        def sample():
+            batch = replay.sample(batch_size)
+            if prioritized: replay.update_priorities(batch["indices"], batch["rewards"])
+        samples, sample_elapsed = repeat(sample, seconds / 2)
+
+        results[name] = {
+            "adds/sec": adds / add_elapsed,
+            "samples/sec": samples / sample_elapsed,
+            "bytes": replay.nbytes,
+            "stacked bytes": capacity * 2 * 4 * int(np.prod(shape)),
+        }
+        r = results[name]
+        print("replay/{:<12} {:>8,.0f} adds/sec, {:>6,.0f} samples/sec, {:,.0f} MB ({:,.0f} MB stacked)".format(
+            name, r["adds/sec"], r["samples/sec"], r["bytes"] / 1e6, r["stacked bytes"] / 1e6))
+
+    return results
+
+
+# Seconds to checkpoint a server holding 1000 NES screenshots in full, to checkpoint it again after a few steps (stalling
+# the caller, then in total), and to restore it, against decoding its screenshots again
+def bench_checkpoint(screenshots = 1000, steps = 10):
+    png = make_png(RESOLUTIONS["NES"])
+    server = make_server(screenshot_decoder = "pillow", screenshot_capacity = screenshots)
+    start = time.perf_counter()
+    for action in range(screenshots):
+        server.actions = action
+        server.store_screenshot(png)
+    decode = time.perf_counter() - start
+    results = {"decode": decode}
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        server.checkpoint(directory, wait = True)
+        results["full"] = time.perf_counter() - start
+
+        for _ in range(steps):
+            server.actions += 1
+            server.store_screenshot(png)
+        start = time.perf_counter()
+        server.checkpoint(directory)
+        results["incremental stall"] = time.perf_counter() - start
+        server.checkpoint_thread.join()
+        results["incremental"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        make_server(screenshot_decoder = "pillow").restore(directory)
+        results["restore"] = time.perf_counter() - start
+
+        # Restore into the same server, take more steps, then check a checkpoint of it restores every screenshot
+        server.restore(directory)
+        for seed in range(1, steps + 1):
+            server.actions += 1
+            server.store_screenshot(make_png(RESOLUTIONS["NES"], seed))
+        server.checkpoint(directory, wait = True)
+        restored = make_server(screenshot_decoder = "pillow")
+        restored.restore(directory)
+        for action in server.screenshots.keys():
+            if not np.array_equal(restored.screenshots[action], server.screenshots[action]):
+                sys.exit("checkpoint: screenshot {} differs after restoring a restored server".format(action))
+
+    for name, elapsed in results.items():
+        print("checkpoint/{:<18} {:>8.1f} ms".format(name, elapsed * 1e3))
+    return results
+
+
+# Save states loaded per second by load_save(), for many saves, by a SaveSampler and by np.random.choice() over the
+# saves dictionary (how saves were sampled before SaveSampler), and weights changed per second
+def bench_saves(seconds = 0.5, counts = (10, 300, 3000)):
+    results = {}
+
+    for count in counts:
+        saves = {"Save/{}.State".format(i): i % 7 + 1 for i in range(count)}
+        sampler = SaveSampler(saves)
+
+        def choice():
+            np.random.choice(a = list(saves.keys()), size = 1, p = list(v / sum(saves.values()) for v in saves.values()))
+
+        def update():
+            sampler["Save/0.State"] = 2
+
+        results[count] = {}
+        for name, fn in (("choice", choice), ("sampler", sampler.sample), ("update", update)):
+            calls, elapsed = repeat(fn, seconds)
+            results[count][name] = calls / elapsed
+        r = results[count]
+        print("saves/{:<6} {:>9,.0f} samples/sec by np.random.choice, {:>9,.0f} by SaveSampler, {:>9,.0f} updates/sec".format(
+            count, r["choice"], r["sampler"], r["update"]))
+
+    return results
+
+
+# Steps recorded per second in HUMAN mode, for NES screenshots: how fast add() returns to the client, and how fast
+# steps reach the disk with each number of writing threads, along with the compression ratio
+def bench_recording(steps = 2048, threads = (1, 2)):
+    server = make_server(screenshot_decoder = "pillow")
+    for seed in range(8):
+        server.actions = seed
+        server.store_screenshot(make_png(RESOLUTIONS["NES"], seed))
+    frames = [server.screenshots[seed] for seed in range(8)]
+    controls = [0.0] * 22
+    ram = np.zeros(2048, np.uint8)
+    results = {}
+
+    for count in threads:
+        with tempfile.TemporaryDirectory() as directory:
+            writer = DemonstrationWriter(directory, range(22), threads = count)
+            start = time.perf_counter()
+            for step in range(steps):
+                writer.add(frames[step % len(frames)], step % 8, controls, ram, {}, 0, step)
+            added = time.perf_counter() - start
+            writer.close()
+            elapsed = time.perf_counter() - start
+
+            name = "threads/" + str(count)
+            results[name] = {
+                "adds/sec": steps / added,
+                "steps/sec": steps / elapsed,
+                "compression": steps * frames[0].nbytes / writer.bytes,
+            }
+            r = results[name]
+            print("recording/{:<10} {:>8,.0f} adds/sec, {:>7,.0f} steps/sec written, {:.1f}x compression".format(
+                name, r["adds/sec"], r["steps/sec"], r["compression"]))
+
+    return results
+
+
+# Trainer answering steps published to a SharedObservationRing, run in its own process by bench_shared
+SHARED_TRAINER = """
+import sys
+from BHServer import SharedObservationReader
+reader = SharedObservationReader(sys.argv[1], timeout = 10)
+while not reader.closed:
+    steps = reader.wait(timeout = 0.1)
+    reader.act(steps["clients"], steps["seqs"], steps["steps"] % 8)
+reader.close()
+"""
+
+
+# Steps per second and p50/p99 round-trip latency of 84x84 observations published to a SharedObservationRing, answered
+# by a trainer in another process, one client at a time and many at once
+def bench_shared(steps = 2000, clients = (1, 8)):
+    observation = np.random.default_rng(0).integers(0, 256, (84, 84), dtype = np.uint8)
+    results = {}
+
+    for count in clients:
+        name = "bhbench_" + str(os.getpid())
+        ring = SharedObservationRing(name, observation.shape, observation.dtype, clients = count)
+        trainer = subprocess.Popen([sys.executable, "-c", SHARED_TRAINER, name],
+                                   cwd = os.path.dirname(os.path.abspath(__file__)))
+        try:
+            ring.wait_action(0, ring.publish(0, observation, 0, 0, 0.0, False), timeout = 10)  # Trainer has started
+
+            latencies = []
+            def client(idx):
+                for step in range(steps // count):
+                    start = time.perf_counter()
+                    ring.wait_action(idx, ring.publish(idx, observation, 0, step, 0.0, False))
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            threads = [threading.Thread(target = client, args = (idx,)) for idx in range(count)]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            ring.close()
+            trainer.wait()
+
+        latencies.sort()
+        results["clients/" + str(count)] = {
+            "steps/sec": len(latencies) / elapsed,
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+        }
+        r = results["clients/" + str(count)]
+        print("shared/clients/{:<3} {:>7,.0f} steps/sec, p50 {:.3f} ms, p99 {:.3f} ms".format(
+            count, r["steps/sec"], r["p50"] * 1e3, r["p99"] * 1e3))
+
+    return results
+
+
+# Bytes on the wire and time to store one screenshot, for each way of sending it:
+#   png/<decoder>  comm.httpPostScreenshot(): a PNG in URL-encoded Base64
+#   raw/<format>     A POST of a frame= body of raw pixels
+#   socket/<format>  A length-prefixed frame= message through the socket server (BHClient:sendFrame() after useSocket())
+#   hex/<format>     A FRAME statement of raw pixels in hex, through comm.httpPost() (BHClient:sendFrame() over HTTP)
+def bench_raw_frame(seconds = 1.0):
+    results = {}
+
+    for system, shape in RESOLUTIONS.items():
+        png = make_png(shape)
+        rgb = mpimg.imread(io.BytesIO(png), format = "png")[:, :, :3]
+        rgb = np.rint(rgb * 255).astype(np.uint8)
+        bgra = np.concatenate([rgb[:, :, ::-1], np.full(shape + (1,), 255, np.uint8)], axis = 2)
+        header = "{} {} ".format(shape[1], shape[0])
+
+        bodies = {}
+        for decoder in DECODERS:
+            bodies["png/" + decoder] = (make_screenshot_body(png), dict(screenshot_decoder = decoder))
+        for pixel_format, pixels in (("RGB24", rgb), ("BGRA32", bgra)):
+            bodies["raw/" + pixel_format] = (
+                ("frame=" + header + pixel_format + " ").encode("ascii") + pixels.tobytes(), {})
+            bodies["hex/" + pixel_format] = (
+                ("payload=" + quote_plus("FRAME " + header + pixel_format + " " + pixels.tobytes().hex())).encode("ascii"), {})
+
+        for name, (body, kwargs) in bodies.items():
+            server = make_server(screenshot_dtype = "uint8", **kwargs)
+            post = make_post(body)
+            calls, elapsed = repeat(lambda: server.handle_msg(post, NullSocket(body)), seconds)
+
+            name = system + "/" + name
+            results[name] = {"bytes": len(post) + len(body), "sec": elapsed / calls}
+            print("raw_frame/{:<18} {:>9,} bytes on the wire, {:>7.3f} ms to store".format(
+                name, results[name]["bytes"], results[name]["sec"] * 1e3))
+
+        # The same frame= bodies, length-prefixed through the socket server. The first recv() holds the start
+        for pixel_format in ("RGB24", "BGRA32"):
+            body = bodies["raw/" + pixel_format][0]
+            message = str(len(body)).encode("ascii") + b" " + body
+            server = make_server(screenshot_dtype = "uint8")
+            calls, elapsed = repeat(lambda: server.handle_msg(message[:16384], NullSocket(message[16384:])), seconds)
+
+            name = system + "/socket/" + pixel_format
+            results[name] = {"bytes": len(message), "sec": elapsed / calls}
+            print("raw_frame/{:<18} {:>9,} bytes on the wire, {:>7.3f} ms to store".format(
+                name, results[name]["bytes"], results[name]["sec"] * 1e3))
+
+    return results
+
+
+# Time to build a large combinatorial action set (analog stick buckets x buttons), and GET controls per second
+# when controls are set as a dictionary, or chosen by index with use_action()
+def bench_action_space(seconds = 1.0, buckets = 32):
+    axis = list(np.linspace(-128, 127, buckets).astype(int).tolist())
+    actions = [("P1 X Axis", axis), ("P1 Y Axis", axis)] + [(b, [False, True]) for b in ("P1 A", "P1 B", "P1 Z", "P1 R", "P1 L")]
+    results = {}
+
+    start = time.perf_counter()
+    space = ActionSpace(actions, make_server().initial_controls)
+    results["build"] = time.perf_counter() - start
+    start = time.perf_counter()
+    BHServer.make_action_map(actions)
+    results["build action map"] = time.perf_counter() - start
+    print("action_space/build        {:>8.3f} sec for {:,} actions ({:.3f} sec as an action map)".format(
+        results["build"], len(space), results["build action map"]))
+
+    server = make_server(actions = actions)
+    action = iter(range(sys.maxsize))
+
+    # Controls chosen by setting the dictionary, then sent by GET controls
+    def set_dict():
+        server.controls.update(space[next(action) % len(space)])
+        server.get_controls("")
+
+    # Controls chosen by index, then sent by GET controls
+    def set_index():
+        server.use_action(next(action) % len(space))
+        server.get_controls("")
+
+    for name, fn in (("dict", set_dict), ("index", set_index)):
+        calls, elapsed = repeat(fn, seconds)
+        results[name] = calls / elapsed
+        print("action_space/{:<12} {:>8,.0f} controls/sec".format(name, results[name]))
+
+    # Controls edited directly, before or after use_action(), must reach the client instead of the prebuilt response
+    for edit_first in (True, False):
+        server = make_server(actions = actions)
+        if edit_first: server.controls["P1 Start"] = True
+        server.use_action(3)
+        if not edit_first: server.controls["P1 Start"] = True
+        if "P1 Start:True" not in server.get_controls("").split(","):
+            sys.exit("action_space: a direct edit {} use_action() was not sent".format("before" if edit_first else "after"))
+    server = make_server(actions = actions)
+    server.use_action(3)
+    if server.get_controls("") != space.wire[3]:
+        sys.exit("action_space: use_action() did not send the prebuilt response")
+
+    return results
+
+
+# Screenshots exported per second by save_screenshots() (a PNG each) and by a ScreenshotHistory
+def bench_screenshot_export(seconds = 2.0):
+    server = make_server()
+    results = {}
+
+    img = np.random.default_rng(0).random(RESOLUTIONS["N64"] + (4,), dtype = np.float32)
+    server.screenshots[0] = img
+
+    with tempfile.TemporaryDirectory() as directory:
+        calls, elapsed = repeat(lambda: server.save_screenshots(0, 0, os.path.join(directory, "png")), seconds)
+        results["png"] = calls / elapsed
+
+        history = ScreenshotHistory(os.path.join(directory, "history"), mode = "w")
+        action = iter(range(sys.maxsize))
+        calls, elapsed = repeat(lambda: history.__setitem__((0, next(action)), img), seconds)
+        history.close()
+        results["history"] = calls / elapsed
+
+    for name, rate in results.items():
+        print("screenshot_export/{:<8} {:>8,.0f} screenshots/sec".format(name, rate))
+
+    return results
+
+
+# Time of a cold "import BHServer", measured with python -X importtime in a new interpreter
+# Fails if it goes over IMPORT_BUDGET, or if any of LAZY_IMPORTS are imported
+def bench_import_time(budget = IMPORT_BUDGET):
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import BHServer"],
+        cwd = os.path.dirname(os.path.abspath(__file__)),
+        capture_output = True,
+        text = True
+    )
+
+    # Lines look like: "import time: self [us] | cumulative | imported package"
+    elapsed = None
+    imported = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line: continue
+        _, cumulative, package = line.split("|")
+        package = package.strip()
+        if package == "BHServer": elapsed = int(cumulative) / 1e6
+        if package.split(".")[0] in LAZY_IMPORTS: imported.append(package)
+
+    if elapsed is None:
+        sys.exit("import_time: BHServer failed to import\n" + process.stderr[-2000:])
+
+    print("import_time              {:>8.3f} sec (budget {:.3f} sec)".format(elapsed, budget))
+
+    if imported:
+        sys.exit("import_time: BHServer imported " + ", ".join(imported) + " at load")
+    if elapsed > budget:
+        sys.exit("import_time: BHServer took {:.3f} sec to import, over budget".format(elapsed))
+
+    return elapsed
+
+
+# Round-trip latency and server context switches for many clients, for each transport
+# Every "http" client opens a new connection per request, like BizHawk's comm.httpPost()
+# Every "socket" client keeps one connection open, sending length-prefixed messages like comm.socketServerSend()
+def bench_connections(clients = 8, requests = 200):
+    statements = b"GET restart; GET exit; GET guessed"
+    body = b"payload=" + quote_plus(statements).encode("utf-8")
+    post = make_post(body) + body
+    message = str(len(statements)).encode("ascii") + b" " + statements
+    results = {}
+
+    # Sends requests over one connection, reading each length-prefixed response. Records each latency
+    def socket_client(port, latencies):
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for _ in range(requests):
+                start = time.perf_counter()
+                sock.sendall(message)
+                response = sock.recv(65536)
+                length, _, rest = response.partition(b" ")
+                while len(rest) < int(length):
+                    rest += sock.recv(65536)
+                latencies.append(time.perf_counter() - start)
+
+    # Sends requests on a new connection each. Records each latency
+    def http_client(port, latencies):
+        for _ in range(requests):
+            latencies.append(post_once(port, post))
+
+    for transport in ("threads", "asyncio"):
+        process, port = start_server_process("transport = '{}', backlog = 128".format(transport))
+
+        for mode, client in (("http", http_client), ("socket", socket_client)):
+            latencies = []
+            switches, cpu = server_usage(process)
+            start = time.perf_counter()
+            threads = [threading.Thread(target = client, args = (port, latencies)) for _ in range(clients)]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+            elapsed = time.perf_counter() - start
+            end_switches, end_cpu = server_usage(process)
+
+            latencies.sort()
+            name = transport + "/" + mode
+            results[name] = {
+                "requests/sec": len(latencies) / elapsed,
+                "p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+                "context switches/request": (end_switches - switches) / len(latencies),
+                "server cpu/request": (end_cpu - cpu) / len(latencies),
+            }
+            r = results[name]
+            print("connections/{:<15} {:>7,.0f} requests/sec, p50 {:.2f} ms, p99 {:.2f} ms, "
+                  "{:.1f} context switches/request, {:.0f} us server CPU/request".format(
+                name, r["requests/sec"], r["p50"] * 1e3, r["p99"] * 1e3,
+                r["context switches/request"], r["server cpu/request"] * 1e6))
+
+        process.kill()
+        process.wait()
+
+    return results
+
+
+# UPDATEs handled per second for many clients at once, calling update() per client, or batch_update() per batch
+# The hooks sleep for a fixed time, standing in for policy inference that costs about the same for 1 or many frames
+def bench_batch_update(clients = 8, updates = 50, inference = 0.002):
+    results = {}
+
+    class InferenceServer(BenchServer):
+        def update(self):
+            self.calls += 1
+            time.sleep(inference)
+
+        def batch_update(self, observations, sessions):
+            self.calls += 1
+            time.sleep(inference)
+            return [{"P1 A": True}] * len(sessions)
+
+    for name, batch_size in (("update", None), ("batch_update", clients)):
+        server = InferenceServer(saves = {"Save/Bench.State": 1}, batch_size = batch_size, batch_window = 0.01)
+        server.calls = 0
+        sessions = [server.get_session("emu" + str(i)) for i in range(clients)]
+        for session in sessions:
+            session.screenshots[0] = np.zeros(RESOLUTIONS["NES"] + (3,), np.uint8)
+
+        def client(session):
+            with server.using_session(session):
+                for _ in range(updates):
+                    server.handle_statements("UPDATE; GET controls", None)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target = client, args = (session,)) for session in sessions]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        elapsed = time.perf_counter() - start
+
+        results[name] = {
+            "updates/sec": clients * updates / elapsed,
+            "calls/update": server.calls / (clients * updates),
+        }
+        print("batch_update/{:<13} {:>7,.0f} UPDATEs/sec, {:.3f} hook calls/UPDATE".format(
+            name, results[name]["updates/sec"], results[name]["calls/update"]))
+
+    return results
+
+
+# Latency of a client step over real connections, sending the screenshot and statements separately like
+# SampleTool.lua (2 requests), or as one STEP statement given the path of the frame (BHClient:step(), 1 request)
+def bench_step(steps = 200):
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        png = make_png(RESOLUTIONS["NES"])
+        path = os.path.join(directory, "frame.png")
+        with open(path, "wb") as f:
+            f.write(png)
+
+        screenshot_body = make_screenshot_body(png)
+        screenshot_post = make_post(screenshot_body) + screenshot_body
+        body = ("payload=" + quote_plus("SET x INT 512; UPDATE; GET controls; GET restart; GET exit; GET guessed")).encode("utf-8")
+        statements_post = make_post(body) + body
+        body = ("payload=" + quote_plus("SET x INT 512; STEP " + path)).encode("utf-8")
+        step_post = make_post(body) + body
+
+        process, port = start_server_process("screenshot_decoder = 'pillow', frame_directory = " + repr(directory))
+        for name, posts in (("separate", (screenshot_post, statements_post)), ("step", (step_post,))):
+            latencies = []
+            for _ in range(steps):
+                start = time.perf_counter()
+                for post in posts: post_once(port, post)
+                latencies.append(time.perf_counter() - start)
+
+            latencies.sort()
+            results[name] = {
+                "steps/sec": len(latencies) / sum(latencies),
+                "requests/step": len(posts),
+                "p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+            }
+            r = results[name]
+            print("step/{:<9} {:>7,.0f} steps/sec, {} requests/step, p50 {:.2f} ms, p99 {:.2f} ms".format(
+                name, r["steps/sec"], r["requests/step"], r["p50"] * 1e3, r["p99"] * 1e3))
+        process.kill()
+        process.wait()
+
+    return results
+
+
+# Steps per second, p50/p99 step latency, and server CPU per step, for many synthetic clients running SampleTool.lua's
+# loop at once (a screenshot POST, then a statements POST), at each resolution
+def bench_end_to_end(clients = (1, 2, 4, 8), resolutions = ("NES", "N64"), steps = 50,
+                     server_args = "screenshot_decoder = 'pillow'"):
+    results = {}
+    process, port = start_server_process(server_args)
+
+    # Runs the steps of one client. Records each latency
+    def run(client, latencies):
+        for _ in range(steps):
+            start = time.perf_counter()
+            if client.step(): break
+            latencies.append(time.perf_counter() - start)
+
+    for resolution in resolutions:
+        for count in clients:
+            synthetic = [SyntheticClient(port, "emu" + str(i), resolution, seed = i) for i in range(count)]
+            for client in synthetic: client.initialize()
+
+            latencies = []
+            _, cpu = server_usage(process)
+            start = time.perf_counter()
+            threads = [threading.Thread(target = run, args = (client, latencies)) for client in synthetic]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+            elapsed = time.perf_counter() - start
+            _, end_cpu = server_usage(process)
+
+            latencies.sort()
+            name = "{}/{}".format(resolution, count)
+            results[name] = {
+                "clients": count,
+                "resolution": resolution,
+                "steps/sec": len(latencies) / elapsed,
+                "p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+                "server cpu/step": (end_cpu - cpu) / len(latencies),
+            }
+            r = results[name]
+            print("end_to_end/{:<6} {:>7,.0f} steps/sec, p50 {:.2f} ms, p99 {:.2f} ms, {:.0f} us server CPU/step".format(
+                name, r["steps/sec"], r["p50"] * 1e3, r["p99"] * 1e3, r["server cpu/step"] * 1e6))
+
+    process.kill()
+    process.wait()
+    return results
+
+
+BENCHMARKS = {
+    "statements": bench_statements,
+    "data": bench_data,
+    "screenshot_post": bench_screenshot_post,
+    "decode": bench_decode,
+    "decode_pool": bench_decode_pool,
+    "pipeline": bench_pipeline,
+    "replay": bench_replay,
+    "checkpoint": bench_checkpoint,
+    "saves": bench_saves,
+    "recording": bench_recording,
+    "shared": bench_shared,
+    "raw_frame": bench_raw_frame,
+    "action_space": bench_action_space,
+    "screenshot_export": bench_screenshot_export,
+    "connections": bench_connections,
+    "step": bench_step,
+    "batch_update": bench_batch_update,
+    "end_to_end": bench_end_to_end,
+    "import_time": bench_import_time,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks BHServer's hot paths, and end-to-end with synthetic clients")
+    parser.add_argument("--json", metavar = "path", help = "also save every benchmark's results to path")
+    parser.add_argument("benchmarks", nargs = "*", metavar = "benchmark",
+                        help = "benchmarks to run, all if none are given: " + ", ".join(BENCHMARKS))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS: parser.error("unknown benchmark " + name + " (choose from " + ", ".join(BENCHMARKS) + ")")
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        results[name] = BENCHMARKS[name]()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 4, default = float)
@@ -9,6 +9,15 @@
 GREEN = 0x6600FF00
 RED = 0x66FF0000
 
+-- Two hex digits of every byte, for sending raw pixels
+HEX = {}
+for byte = 0, 255 do
+    HEX[byte] = string.format("%02x", byte)
+end
+
+-- Bytes per pixel of each raw pixel format the server reads
+PIXEL_BYTES = {GRAY8 = 1, RGB24 = 3, BGR24 = 3, RGBA32 = 4, BGRA32 = 4}
+
 -- =====================================================================================================================
 -- BHClient Definition
 -- =====================================================================================================================
@@ -17,13 +26,21 @@ BHClient = {}
 BHClient.__index = BHClient
 
 function BHClient:new (
-    addr
+    addr,
+    clientId
 )
     local self = {}
     setmetatable(self, BHClient)
 
-    -- Address of the server
+    -- Id of this client, so one server can run many emulators. Each id gets its own data on the server
+    self.clientId = clientId
+    -- Address of the server. The client id is sent as the path of every request
     self.addr = addr or "http://127.0.0.1:1337"
+    if clientId then
+        self.addr = self.addr .. "/" .. clientId
+    end
+    -- How messages reach the server: "http" (a connection per message) or "socket" (one connection). See useSocket()
+    self.transport = "http"
     -- Path to game ROM
     self.rom = "../../"
     -- Path to save state
@@ -38,6 +55,18 @@ function BHClient:new (
     self.controls = {}
     -- Whether the last action was guessed randomly
     self.guessed = true
+    -- "AI" applies controls from the server, "HUMAN" lets a person play and sends their joypad. Set by the server
+    self.mode = "AI"
+    -- Where step() saves each frame for the server to read, as an absolute path, since the server runs in another
+    -- directory. Next to this script if its path is known, otherwise set by setFramePath()
+    self.framePath = nil
+    local directory = BHClient.scriptDirectory()
+    if directory then
+        self.framePath = directory .. "BHFrame.png"
+        if clientId then
+            self.framePath = directory .. "BHFrame_" .. clientId .. ".png"
+        end
+    end
 
     return self
 end
@@ -46,6 +75,27 @@ end
 -- General Useful Functions
 -- =====================================================================================================================
 
+--[[ Returns whether a path is absolute, on Windows (C:\..., \\server\...) or elsewhere (/...) ]]
+function BHClient.isAbsolutePath (path)
+    return path:match("^%a:[/\\]") ~= nil or path:sub(1, 1) == "/" or path:sub(1, 2) == "\\\\"
+end
+
+--[[ Returns the absolute directory of this script, ending in a separator, or nil if its path isn't known ]]
+function BHClient.scriptDirectory ()
+    if not debug or not debug.getinfo then
+        return nil
+    end
+    local source = debug.getinfo(1, "S").source
+    if source:sub(1, 1) ~= "@" then
+        return nil
+    end
+    local directory = source:sub(2):match("^(.*[/\\])")
+    if directory and BHClient.isAbsolutePath(directory) then
+        return directory
+    end
+    return nil
+end
+
 --[[ Converts string-representation of a table to a table
      Input Format: "key:val,key:val,key:val" ]]
 function BHClient:tableFromString (str)
@@ -58,6 +108,18 @@ function BHClient:tableFromString (str)
     return table
 end
 
+--[[ Converts a table to its string-representation
+     Output Format: "key:val,key:val,key:val" ]]
+function BHClient:stringFromTable (tbl)
+    local pairsList = {}
+
+    for key, val in pairs(tbl) do
+        pairsList[#pairsList + 1] = key .. ":" .. tostring(val)
+    end
+
+    return table.concat(pairsList, ",")
+end
+
 --[[ Returns a list of statements to a delimited string
      Output Format: "s1; s2; s3" ]]
 function BHClient:stringFromList (list)
@@ -70,6 +132,22 @@ function BHClient:stringFromList (list)
     return str:sub(1, -3)
 end
 
+--[[ Returns the first size bytes of a table in hex, such as from memory.readbyterange() ]]
+function BHClient:hexFromBytes (bytes, size)
+    -- Tables from memory.readbyterange() may start at 0 or 1
+    local first = 1
+    if bytes[0] ~= nil then
+        first = 0
+    end
+
+    local hex = {}
+    for i = 1, size do
+        hex[i] = HEX[bytes[first + i - 1]]
+    end
+
+    return table.concat(hex)
+end
+
 --[[ Returns a boolean given a string representing a bool ]]
 function BHClient:boolFromString (str)
     if str == "True" then
@@ -102,8 +180,12 @@ function BHClient:advanceFrame ()
 	self.frames = self.frames + 1
 end
 
---[[ Applies the controls table for the current frame ]]
+--[[ Applies the controls table for the current frame. In HUMAN mode, the person playing keeps control ]]
 function BHClient:useControls ()
+    if self.mode == "HUMAN" then
+        return
+    end
+
     joypad.set(self.controls)
     joypad.setanalog(self.controls)
 end
@@ -138,19 +220,51 @@ end
 -- Server Interaction Functions
 -- =====================================================================================================================
 
+--[[ Sends every message through BizHawk's socket server, over one connection kept open, instead of an HTTP request each
+     BizHawk connects to the ip and port given on its command line (--socket_ip, --socket_port), or to the ones given
+     here on versions that can set them. Call before initialize() ]]
+function BHClient:useSocket (ip, port)
+    if ip and comm.socketServerSetIp then
+        comm.socketServerSetIp(ip)
+    end
+    if port and comm.socketServerSetPort then
+        comm.socketServerSetPort(port)
+    end
+    self.transport = "socket"
+end
+
+--[[ Returns a response from the socket server, without its length prefix ("LENGTH MESSAGE")
+     Some versions of BizHawk remove the prefix themselves ]]
+function BHClient:receiveSocket ()
+    local response = comm.socketServerResponse()
+    local length, msg = string.match(response, "^(%d+) (.*)$")
+    if length and tonumber(length) == string.len(msg) then
+        return msg
+    end
+    return response
+end
+
 --[[ Sends string of statements to the server, returns each output as separate return ]]
 function BHClient:sendStr (str)
-    -- Send an HTTP post
-    local response = comm.httpPost(self.addr, str)
+    local msg
 
-    -- Grab the body of the response
-    local headEnd = string.find(response, "\r\n\r\n")
-    local rspStart = 0
-    local rspEnd = string.len(response)
-    if not (headEnd == nil) then
-        rspStart = headEnd + 4
+    if self.transport == "socket" then
+        -- Send through the open connection. BizHawk prefixes the message with its length
+        comm.socketServerSend(str)
+        msg = self:receiveSocket()
+    else
+        -- Send an HTTP post
+        local response = comm.httpPost(self.addr, str)
+
+        -- Grab the body of the response
+        local headEnd = string.find(response, "\r\n\r\n")
+        local rspStart = 0
+        local rspEnd = string.len(response)
+        if not (headEnd == nil) then
+            rspStart = headEnd + 4
+        end
+        msg = string.sub(response, rspStart, rspEnd)
     end
-    local msg = string.sub(response, rspStart, rspEnd)
 
     -- Split the msg into each statement response
     local returns = {}
@@ -172,11 +286,21 @@ function BHClient:sendList (list)
 end
 
 --[[ Returns statement to call server's update() function
+     In HUMAN mode, the joypad is sent first, so the server records it
      Server should send no (real) response ]]
 function BHClient:updateStatement()
+    if self.mode == "HUMAN" then
+        return self:joypadStatement() .. "; UPDATE"
+    end
     return "UPDATE"
 end
 
+--[[ Returns statement to send the joypad's current state to the server, stored as its controls
+     Server sends no response ]]
+function BHClient:joypadStatement ()
+    return "JOYPAD " .. self:stringFromTable(joypad.get())
+end
+
 --[[ Returns statement to set a variable on server to value and datatype
      If no dataType is given, assume it to be a string ]]
 function BHClient:setStatement (var, val, dataType)
@@ -187,6 +311,34 @@ function BHClient:setStatement (var, val, dataType)
     end
 end
 
+--[[ Returns a list as the server reads it: "[e1, e2, ...]". Booleans become True and False ]]
+function BHClient:listString (list)
+    local elems = {}
+
+    for i, elem in ipairs(list) do
+        if elem == true then
+            elems[i] = "True"
+        elseif elem == false then
+            elems[i] = "False"
+        else
+            elems[i] = tostring(elem)
+        end
+    end
+
+    return "[" .. table.concat(elems, ", ") .. "]"
+end
+
+--[[ Returns statement to set many elements of a list on server at once, starting at idx (0 is the first element)
+     Elements past the end of the list are appended ]]
+function BHClient:setSliceStatement (var, idx, list)
+    return "SET " .. var .. " " .. idx .. ": " .. self:listString(list)
+end
+
+--[[ Returns statement to append a list of elements to a list on server ]]
+function BHClient:appendStatement (var, list)
+    return "APPEND " .. var .. " " .. self:listString(list)
+end
+
 --[[ Returns the data type and value of the variable, given server's response]]
 function BHClient:get (response)
     if not response then
@@ -278,10 +430,130 @@ end
 --[[ Takes screenshot of game window, and sends to server
      The server will store it at the newest index of the screenshot[] list ]]
 function BHClient:saveScreenshot ()
-    comm.httpPostScreenshot()
+    if self.transport == "socket" then
+        comm.socketServerScreenShot()
+    else
+        comm.httpPostScreenshot()
+    end
+    self.numScreenshots = self.numScreenshots + 1
+end
+
+--[[ Returns statement to send raw pixels to the server, stored like a screenshot from saveScreenshot()
+     pixels is a table of bytes (0-255) in one of PIXEL_BYTES' formats, row by row, such as from memory.readbyterange()
+     The server reads them without decoding a PNG. They're sent in hex, since comm.httpPost() URL-encodes
+     sendFrame() sends the bytes as they are instead, when using the socket server ]]
+function BHClient:frameStatement (width, height, format, pixels)
+    local size = width * height * PIXEL_BYTES[format]
+    return "FRAME " .. width .. " " .. height .. " " .. format .. " " .. self:hexFromBytes(pixels, size)
+end
+
+--[[ Returns frameStatement() for a framebuffer held in memory, given its address and memory domain ]]
+function BHClient:readFrameStatement (addr, width, height, format, domain)
+    local pixels = memory.readbyterange(addr, width * height * PIXEL_BYTES[format], domain)
+    return self:frameStatement(width, height, format, pixels)
+end
+
+--[[ Returns statement to send ranges of the game's memory to the server, read with mainmemory.readbyterange()
+     ranges is a list of {address, length}. The server stores them in its ram array, by address ]]
+function BHClient:ramStatement (ranges)
+    local parts = {"RAM"}
+
+    for _, range in ipairs(ranges) do
+        local bytes = mainmemory.readbyterange(range[1], range[2])
+        parts[#parts + 1] = range[1] .. " " .. self:hexFromBytes(bytes, range[2])
+    end
+
+    return table.concat(parts, " ")
+end
+
+--[[ Returns the bytes of a raw frame message, "frame=WIDTH HEIGHT FORMAT " followed by the pixel bytes as they are
+     Takes the same arguments as frameStatement(). Returns a table of bytes, starting at 1 ]]
+function BHClient:frameBytes (width, height, format, pixels)
+    local size = width * height * PIXEL_BYTES[format]
+    local header = "frame=" .. width .. " " .. height .. " " .. format .. " "
+
+    -- Tables from memory.readbyterange() may start at 0 or 1
+    local first = 1
+    if pixels[0] ~= nil then
+        first = 0
+    end
+
+    local bytes = {string.byte(header, 1, -1)}
+    local n = #bytes
+    for i = 1, size do
+        bytes[n + i] = pixels[first + i - 1]
+    end
+    return bytes
+end
+
+--[[ Sends raw pixels to the server, like saveScreenshot()
+     Through the socket server (see useSocket()), the pixel bytes are sent as they are (see frameBytes()), where
+     BizHawk has comm.socketServerSendBytes(). BizHawk prefixes them with their length
+     Otherwise, they're sent in hex (see frameStatement()), twice their size: comm.httpPost() URL-encodes, and
+     comm.socketServerSend() re-encodes its string as text, changing bytes above 127 ]]
+function BHClient:sendFrame (width, height, format, pixels)
+    if self.transport == "socket" and comm.socketServerSendBytes then
+        comm.socketServerSendBytes(self:frameBytes(width, height, format, pixels))
+        self:receiveSocket()
+    else
+        self:sendStr(self:frameStatement(width, height, format, pixels))
+    end
     self.numScreenshots = self.numScreenshots + 1
 end
 
+--[[ Sets where step() saves each frame, given an absolute path. The server reads it from there ]]
+function BHClient:setFramePath (path)
+    if not BHClient.isAbsolutePath(path) then
+        print("ERROR: framePath must be an absolute path, since the server runs in another directory: " .. path)
+        return
+    end
+    self.framePath = path
+end
+
+--[[ Returns statement to store a frame, update, and get controls, restart, exit and guessed in one response
+     If a path is given, the server reads the frame from that PNG. Server's response should be passed to step() ]]
+function BHClient:stepStatement (path)
+    if path then
+        return "STEP " .. path
+    end
+    return "STEP"
+end
+
+--[[ Plays one step in a single request: saves the frame to framePath, sends it with the given statements (such as
+     SETs, which return nothing) and an UPDATE, then applies the controls and restarts if asked
+     Returns whether the client should exit ]]
+function BHClient:step (statements)
+    if not self.framePath then
+        print("ERROR: step() needs an absolute framePath. Call setFramePath()")
+        return false
+    end
+    client.screenshot(self.framePath)
+    self.numScreenshots = self.numScreenshots + 1
+
+    local list = {}
+    for _, stmt in ipairs(statements or {}) do
+        list[#list + 1] = stmt
+    end
+    if self.mode == "HUMAN" then
+        list[#list + 1] = self:joypadStatement()
+    end
+    list[#list + 1] = self:stepStatement(self.framePath)
+
+    -- STEP's responses come last. If the server couldn't read the frame, it responds with an error instead
+    local returns = {self:sendList(list)}
+    local n = #returns
+    if returns[n] and returns[n]:sub(1, 6) == "ERROR:" then
+        print(returns[n])
+        return false
+    end
+    local controls, restart, exit, guessed = returns[n - 3], returns[n - 2], returns[n - 1], returns[n]
+
+    self:setControls(controls)
+    self:checkGuessed(guessed)
+    self:checkRestart(restart)
+    return self:checkExit(exit)
+end
+
 --[[ Applies controls from server and saves to controls table, given server's response
      Response should be retrieved from sending setControlsStatement() to server ]]
 function BHClient:setControls (controls)
@@ -378,7 +650,7 @@ function BHClient:checkGuessed (guessed)
         return
     end
 
-    self.guessed = self:boolFromString(bool)
+    self.guessed = self:boolFromString(guessed)
 end
 
 --[[ Returns statement for checkGuessedStatement()
@@ -420,6 +692,23 @@ function BHClient:setSoundStatement ()
     return "GET sound"
 end
 
+--[[ Sets whether the server or a person plays, given server's response
+     Response should be retrieved from sending setModeStatement() to server ]]
+function BHClient:setMode (mode)
+    if not mode then
+        print("ERROR: No server response given to setMode()")
+        return
+    end
+
+    self.mode = mode
+end
+
+--[[ Returns statement for setMode()
+     Server's response should be passed to setMode() ]]
+function BHClient:setModeStatement ()
+    return "GET mode"
+end
+
 --[[ Set's the emulator's speed multiplier, given server's response
      Response should be retrieved from sending setSpeedStatement() to server ]]
 function BHClient:setSpeed (speed)
@@ -470,18 +759,25 @@ function BHClient:initialize ()
 
     userdata.set("init", false)
 
+    -- Over a socket there's no URL, so the client id is given to RESET
+    local reset = "RESET"
+    if self.transport == "socket" and self.clientId then
+        reset = "RESET " .. self.clientId
+    end
+
     -- Prepare list of statements
     local statements = {
-        "RESET",  -- No return
+        reset,  -- No return
         self:setSaveStatement(), -- Get save state for loading and resetting
         self:setUpdateIntervalStatement(),
         self:setSoundStatement(),
         self:setSpeedStatement(),
-        self:setFrameskipStatement()
+        self:setFrameskipStatement(),
+        self:setModeStatement()
     }
 
     -- Send statements to server, retrieve response
-    local save, updateInterval, sound, speed, frameskip = self:sendList(statements)
+    local save, updateInterval, sound, speed, frameskip, mode = self:sendList(statements)
 
     -- Handle each response and pass to appropriate functions
     self:setSave(save)
@@ -489,6 +785,7 @@ function BHClient:initialize ()
     self:setSound(sound)
     self:setSpeed(speed)
     self:setFrameskip(frameskip)
+    self:setMode(mode)
 
     -- Start a new episode of learning (load state, reset number of screenshots)
     self:newEpisode()
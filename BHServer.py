@@ -5,44 +5,91 @@
 """
 
 # TODO Error checking, especially of server arguments
-# TODO Function for getting screenshot size
 # TODO Make sure screenshots are float32
 # TODO Research mixed scalar and multiclass, multilabel NN regression
 # TODO Weight regularization (L1, L2)
 # TODO Dropout
 # TODO Check output shape of last conv layer, should be around 3x3
-# TODO DQN History
 
 # TODO Change rom/save path to root of server (absolute path)
 # TODO self.actions incremented after update() instead of screenshot(). Check if stable
 # TODO Check if sample tool code increments episodes correctly (new_episode, exit_client)
 
 # TODO Test syntax in Lua
-# TODO Save server data to disk (just screenshots?). Autosave?
 # TODO Does self.socket break multithreading?
 # TODO Public, private, protected
 
 # TODO Semicolons in message statements?
-# TODO Reveal screenshot memory size
-# TODO ?    Allow endless screenshots, not terminated by episode
 # TODO Check if self.close_client breaks threading, rewrite it
 # TODO Stricter RegEx's and patterns
 # TODO Fix screenshot encoding, showing b'tretre' in lua
-# TODO Allow pausing and resuming learning, saving progress
 # TODO Support more data types: float, dict, lists
 # TODO Check for pointer safety - did we overwrite any variable once passed to a function?
 
 import sys
 import socket as s  # Allows data connections to clients
 import threading  # Allows multiple connections simultaneously
+import asyncio  # Handles every connection in one thread (transport = "asyncio")
+import time  # Batch deadlines
+from contextlib import contextmanager  # Switching sessions
 import re  # Pattern-matching messages using regular expressions
-import ast  # Interpretting string representations of lists and ints
+import ast  # Interpretting string representations of string lists
 import numpy as np  # For probability selection
-from urllib.parse import unquote_plus  # Decoding url-safe HTTP requests
+from urllib.parse import quote, unquote_plus, unquote_to_bytes  # Decoding url-safe HTTP requests, escaping client ids
 import base64  # Decoding Base64 screenshot strings
 import io  # Decodes Base64 to bytes
-import matplotlib.image as mpimg  # Loading numpy.ndarray from PNG bytes
-import matplotlib.pyplot as plt  # Visualizing screenshots
+import os  # Checking for screenshot history files
+import json  # Screenshot history header
+import zlib  # Compressing demonstrations
+import queue  # Handing demonstration chunks to writing threads
+import concurrent.futures  # Running update() on workers, by a deadline
+import importlib.util  # Checking for optional packages without importing them
+# Imported on first use, since they're slow to import:
+#   matplotlib.image   Loading numpy.ndarray from PNG bytes, saving screenshots
+#   matplotlib.pyplot  Visualizing screenshots
+#   PIL.Image          Fast PNG decoding (optional)
+
+# Patterns for reading messages, compiled once
+CONTENT_LENGTH_PATTERN = re.compile(rb"Content-Length: (\d+)")  # Size of an HTTP POST body
+
+# Response header for every HTTP POST
+HTTP_OK = "HTTP/1.1 200 OK\r\n\r\n"
+# Markers inside an HTTP POST
+HEADER_END = b"\r\n\r\n"         # End of the headers, start of the body
+SCREENSHOT_KEY = b"screenshot="  # Body holds a screenshot (comm.httpPostScreenshot)
+PAYLOAD_KEY = b"payload="        # Body holds statements (comm.httpPost)
+FRAME_KEY = b"frame="            # Body holds raw pixels: "frame=WIDTH HEIGHT FORMAT " followed by the pixel bytes
+# Start of every PNG, such as a screenshot sent through a persistent connection (comm.socketServerScreenShot)
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Directory STEP frames are read from by default: next to BHServer.py, where BHClient.lua saves them (BHFrame.png)
+FRAME_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Raw pixel formats: {name: (bytes per pixel, channels as red, green, blue)}. None for a single gray channel
+PIXEL_FORMATS = {
+    "GRAY8": (1, None),
+    "RGB24": (3, slice(0, 3)),
+    "BGR24": (3, slice(2, None, -1)),
+    "RGBA32": (4, slice(0, 3)),
+    "BGRA32": (4, slice(2, None, -1)),  # BizHawk's framebuffer: 32-bit ARGB, little endian
+}
+
+# Checkpoints
+CHECKPOINT_HEADER = "checkpoint.json"  # Header of a checkpoint directory, read first
+CHECKPOINT_VERSION = 1                 # Format of checkpoints written
+
+# Shared observation rings
+SHARED_HEADER = 64       # Bytes of the header: published steps, length of the description and whether it's closed
+SHARED_ALIGNMENT = 64    # Arrays of a ring start at multiples of this many bytes
+SHARED_VERSION = 1       # Format of rings written
+
+# Index of a demonstration dataset, a line per chunk
+DEMONSTRATION_INDEX = "index.jsonl"
+
+# Entry of a screenshot history's index
+INDEX_ENTRY = np.dtype([("episode", np.int64), ("action", np.int64), ("slot", np.int64)])
+
+# Weights of the red, green, and blue channels when converting to grayscale
+GRAYSCALE_WEIGHTS = np.array([0.2989, 0.5870, 0.1140], np.float32)
 
 
 # Convert string representation of bool to bool
@@ -52,22 +99,1746 @@ def to_bool(string):
 
 # Returns a string representation of the dictionary
 def dict_as_str(dictionary):
-    string = ""
-
-    for key, val in dictionary.items():
-        string += ',' + key + ":" + str(val)
-
-    return string[1:]
+    return ",".join(key + ":" + str(val) for key, val in dictionary.items())
+
+
+# Converts numpy.ndarray to grayscale. Writes into out, if given
+def to_grayscale(img, out = None):
+    return np.matmul(img[:, :, :3], GRAYSCALE_WEIGHTS, out = out)
+
+
+# Copies an image into out, converting between uint8 [0, 255] and floats [0, 1] if their data types differ
+def convert_image(img, out):
+    if img.dtype == out.dtype:
+        np.copyto(out, img)
+    elif out.dtype == np.uint8:
+        np.copyto(out, np.rint(img * 255), casting = "unsafe")
+    elif img.dtype == np.uint8:
+        np.multiply(img, 1 / 255, out = out)
+    else:
+        np.copyto(out, img, casting = "same_kind")
+
+
+#
+# Client Data
+#
+# Values set by the client are parsed by their data type, without evaluating them as Python
+# INT[] and BOOL[] lists are kept in DataArrays, and STRING[] lists in Python lists
+#
+
+# Returns an INT value
+def parse_int(val):
+    return int(val)
+
+
+# Returns a BOOL value, given "True" or "False"
+def parse_bool(val):
+    if val == "True": return True
+    if val == "False": return False
+    raise ValueError("Expected True or False, got " + val)
+
+
+# Returns a STRING value, given a quoted string ('text' or "text")
+def parse_string(val):
+    if len(val) >= 2 and val[0] == val[-1] and val[0] in "'\"" and "\\" not in val:
+        return val[1:-1]
+    val = ast.literal_eval(val)  # Escaped characters
+    if not isinstance(val, str): raise ValueError("Expected a quoted string")
+    return val
+
+
+# Returns the elements of a list value, given "[e1, e2, ...]": a numpy.ndarray for INT and BOOL, else a list
+def parse_elements(data_type, val):
+    val = val.strip()
+    if not (val.startswith("[") and val.endswith("]")):
+        raise ValueError("Expected a list")
+    inner = val[1:-1]
+
+    if data_type == "STRING":
+        elements = ast.literal_eval(val)  # Strings may hold commas
+        if not all(isinstance(e, str) for e in elements): raise ValueError("Expected a list of quoted strings")
+        return elements
+    if not inner.strip():
+        return np.empty(0, DATA_DTYPES[data_type])
+    if data_type == "INT":
+        try:
+            return np.array(inner.split(","), np.int64)
+        except OverflowError:
+            raise ValueError("INT[] elements must fit in 64 bits")
+    return np.array([parse_bool(e.strip()) for e in inner.split(",")], np.bool_)
+
+
+# Parsers of single values, by data type
+DATA_PARSERS = {
+    "INT": parse_int,
+    "BOOL": parse_bool,
+    "STRING": parse_string,
+}
+
+# Data types of list elements stored in DataArrays
+DATA_DTYPES = {
+    "INT": np.int64,
+    "BOOL": np.bool_,
+}
+
+
+# Returns the value of a variable, given its data type and value as sent by the client
+# Raises KeyError on unrecognized data types, and ValueError on values that don't match the data type
+def parse_data(data_type, val):
+    if not data_type.endswith("[]"):
+        return DATA_PARSERS[data_type](val)
+
+    data_type = data_type[:-2]
+    if data_type not in DATA_PARSERS: raise KeyError(data_type)
+    elements = parse_elements(data_type, val)
+    return DataArray(elements) if data_type in DATA_DTYPES else elements
+
+
+# A list of INTs or BOOLs, stored in a numpy.ndarray that grows as elements are appended
+# Reads like a list. values is a view of the elements, without copying
+class DataArray:
+    def __init__(self, elements):
+        self.buffer = np.array(elements)  # Elements, followed by room to grow
+        self.length = len(self.buffer)    # Number of elements
+
+    # Every element, as a numpy.ndarray. A view, not a copy
+    @property
+    def values(self):
+        return self.buffer[:self.length]
+
+    # Writes elements starting at idx, appending any past the end. idx may be at most the number of elements
+    def set(self, idx, elements):
+        end = idx + len(elements)
+        if end > len(self.buffer):
+            buffer = np.empty(max(end, 2 * len(self.buffer), 16), self.buffer.dtype)
+            buffer[:self.length] = self.values
+            self.buffer = buffer
+        self.buffer[idx:end] = elements
+        self.length = max(self.length, end)
+
+    # Appends elements to the end
+    def extend(self, elements):
+        self.set(self.length, elements)
+
+    def append(self, element):
+        self.set(self.length, [element])
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        return self.values[idx]
+
+    def __setitem__(self, idx, val):
+        self.values[idx] = val
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __array__(self, dtype = None, copy = None):
+        return self.values if dtype is None else self.values.astype(dtype)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    # Formatted like a Python list, as sent to the client
+    def __str__(self):
+        return str(self.values.tolist())
+
+    def __repr__(self):
+        return "DataArray(" + str(self) + ")"
+
+
+#
+# Screenshot Decoders
+#
+# A decoder is called with the bytes of a PNG, and reserve(shape, dtype), which returns the array to decode into
+# It may also convert the screenshot to grayscale, shrink it by an integer scale, and convert it to the given dtype
+#
+
+# Decodes with matplotlib. Screenshots are floats in [0, 1], with every channel of the PNG (alpha included)
+# Shrinks by keeping every scale-th pixel
+def decode_png_matplotlib(png, reserve, grayscale = False, scale = 1, dtype = None):
+    import matplotlib.image as mpimg
+    img = mpimg.imread(io.BytesIO(png), format = 'png')[::scale, ::scale]
+    dtype = img.dtype if dtype is None else np.dtype(dtype)
+
+    if not grayscale:
+        convert_image(img, reserve(img.shape, dtype))
+    elif dtype == img.dtype:
+        to_grayscale(img, out = reserve(img.shape[:2], dtype))
+    else:
+        convert_image(to_grayscale(img), reserve(img.shape[:2], dtype))
+
+
+# Decodes with Pillow. Screenshots are uint8 in [0, 255], RGB without alpha, or a single channel if grayscale
+# Shrinks by averaging scale x scale pixels
+def decode_png_pillow(png, reserve, grayscale = False, scale = 1, dtype = None):
+    from PIL import Image
+    img = Image.open(io.BytesIO(png))
+    img = img.convert("L" if grayscale else "RGB")
+    if scale > 1: img = img.reduce(scale)
+    img = np.asarray(img)
+
+    convert_image(img, reserve(img.shape, img.dtype if dtype is None else np.dtype(dtype)))
+
+
+# Reads raw pixels, given as bytes in one of PIXEL_FORMATS. Screenshots are uint8 in [0, 255], RGB without alpha,
+# or a single channel if grayscale or given GRAY8. There is nothing to decode: the pixels are viewed in place, and
+# only copied into the reserved array. Shrinks by keeping every scale-th pixel. Raises ValueError on bad frames
+def decode_raw(pixels, width, height, pixel_format, reserve, grayscale = False, scale = 1, dtype = None):
+    if pixel_format not in PIXEL_FORMATS:
+        raise ValueError("Unrecognized pixel format " + str(pixel_format))
+    depth, channels = PIXEL_FORMATS[pixel_format]
+    if len(pixels) != width * height * depth:
+        raise ValueError("Frame holds {} bytes, expected {}x{} {}".format(len(pixels), width, height, pixel_format))
+
+    img = np.frombuffer(pixels, np.uint8).reshape(height, width, depth)[::scale, ::scale]
+    dtype = img.dtype if dtype is None else np.dtype(dtype)
+
+    if channels is None:
+        convert_image(img[:, :, 0], reserve(img.shape[:2], dtype))
+    elif not grayscale:
+        img = img[:, :, channels]
+        convert_image(img, reserve(img.shape, dtype))
+    else:
+        gray = to_grayscale(img[:, :, channels].astype(np.float32))
+        gray *= 1 / 255
+        convert_image(gray, reserve(gray.shape, dtype))
+
+
+# Decoders, by name. Given to the server as screenshot_decoder
+DECODERS = {
+    "matplotlib": decode_png_matplotlib,
+    "pillow": decode_png_pillow,
+}
+
+
+# Stores the most recent screenshots inside one preallocated numpy.ndarray, replacing the oldest once full
+# Screenshots are accessed like a dictionary, by the action they were taken at
+class ScreenshotStore:
+    def __init__(
+            self,
+            # Most screenshots stored at once
+            capacity = 1000,
+            # Shape of every screenshot. Set by the first screenshot if None
+            shape = None,
+            # Data type of every screenshot. Set by the first screenshot if None
+            dtype = None,
+            # Most recent screenshots last() can return without copying
+            window = 4,
+    ):
+        self.capacity = capacity
+        self.shape = None if shape is None else tuple(shape)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.window = max(1, min(window, capacity))
+        self.given = (shape, dtype)          # Shape and data type given, kept when cleared
+        self.frames = None                   # Every slot. The first window - 1 slots are mirrored after the last
+        self.slots = dict()                  # {key: slot}
+        self.slot_keys = [None] * capacity   # Key of the screenshot in each slot
+        self.head = -1                       # Slot of the newest screenshot
+        self.count = 0                       # Number of screenshots stored
+        self.advances = 0                    # Number of times a new slot was taken. Tells checkpoints what changed
+
+        if self.shape is not None and self.dtype is not None:
+            self.allocate()
+
+    # Allocates every slot at once
+    def allocate(self):
+        self.frames = np.zeros((self.capacity + self.window - 1,) + self.shape, self.dtype)
+
+    # Returns the empty slot for a new screenshot, given its key, shape and data type. Call commit() once written
+    # A key that is already stored is replaced, and the oldest screenshot is dropped if the store is full
+    def reserve(self, key, shape, dtype):
+        # Allocate on the first screenshot, or again if the first since clear() has a new shape or data type
+        if self.frames is None or not self.count:
+            new_shape = tuple(shape) if self.given[0] is None else self.shape
+            new_dtype = np.dtype(dtype) if self.given[1] is None else self.dtype
+            if self.frames is None or new_shape != self.shape or new_dtype != self.dtype:
+                self.shape, self.dtype = new_shape, new_dtype
+                self.allocate()
+
+        if tuple(shape) != self.shape:
+            raise ValueError("Screenshot shape {} does not match stored shape {}".format(tuple(shape), self.shape))
+
+        # Is this a replacement of the newest screenshot? Keep its slot
+        if self.count == 0 or self.slot_keys[self.head] != key:
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self.advances += 1
+
+            # Forget the screenshot being overwritten
+            old_key = self.slot_keys[self.head]
+            if self.slots.get(old_key) == self.head:
+                del self.slots[old_key]
+
+            self.slots[key] = self.head
+            self.slot_keys[self.head] = key
+
+        return self.frames[self.head]
+
+    # Finishes writing the slot returned by reserve()
+    def commit(self):
+        if self.head < self.window - 1:
+            self.frames[self.capacity + self.head] = self.frames[self.head]
+
+    # Stores a copy of the screenshot
+    def __setitem__(self, key, img):
+        img = np.asarray(img)
+        self.reserve(key, img.shape, img.dtype)[...] = img
+        self.commit()
+
+    # Returns the screenshot (a view, not a copy)
+    def __getitem__(self, key):
+        return self.frames[self.slots[key]]
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    # Returns the keys of stored screenshots, oldest first
+    def keys(self):
+        return sorted(self.slots, key = lambda key: (self.slots[key] - self.head - 1) % self.capacity)
+
+    # Returns the last n screenshots as one numpy.ndarray, oldest first
+    # The result is a view if n <= window, or if the screenshots were not wrapped around the end of the store
+    def last(self, n = 1):
+        if n < 1 or n > self.count:
+            raise ValueError("Cannot get last {} of {} screenshots".format(n, self.count))
+
+        start = self.head - n + 1
+        if start >= 0:
+            return self.frames[start:self.head + 1]
+        if n <= self.window:
+            return self.frames[self.capacity + start:self.capacity + self.head + 1]
+        return np.concatenate((self.frames[self.capacity + start:self.capacity], self.frames[:self.head + 1]))
+
+    # Returns the slots of the n newest screenshots, oldest first
+    def recent_slots(self, n):
+        n = min(n, self.count)
+        return (np.arange(self.head - n + 1, self.head + 1)) % self.capacity
+
+    # Copies whole slots into the store, given their indices and screenshots, keeping the mirrored window up to date
+    def load_slots(self, slots, frames):
+        self.frames[slots] = frames
+        mirrored = slots < self.window - 1
+        self.frames[self.capacity + slots[mirrored]] = frames[mirrored]
+
+    # Forgets every screenshot. Keeps the allocated memory, reallocated only if the next screenshot doesn't fit it
+    def clear(self):
+        self.slots = dict()
+        self.slot_keys = [None] * self.capacity
+        self.head = -1
+        self.count = 0
+
+    # Bytes allocated for screenshots
+    @property
+    def nbytes(self):
+        return 0 if self.frames is None else self.frames.nbytes
+
+
+# Stores every screenshot on disk inside one numpy.memmap file, by (episode, action)
+# Files: path.json (shape and data type), path.frames (raw screenshots), path.index (episode, action, slot per screenshot)
+# Another process can read the same files while they're written, using mode "r" and refresh()
+class ScreenshotHistory:
+    def __init__(
+            self,
+            # Path of the files, without extension
+            path,
+            # "a" to append (creates the files if missing), "w" to overwrite, "r" to read only
+            mode = "a",
+            # Shape of every screenshot. Set by the first screenshot if None
+            shape = None,
+            # Data type of every screenshot. Set by the first screenshot if None
+            dtype = None,
+            # Screenshots to grow the frames file by when it's full
+            chunk = 1024,
+    ):
+        if mode not in ("a", "w", "r"):
+            raise ValueError("Unrecognized mode " + mode)
+
+        self.path = path
+        self.mode = mode
+        self.shape = None if shape is None else tuple(shape)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.chunk = chunk
+        self.frames = None       # numpy.memmap of every slot in the frames file
+        self.count = 0           # Slots used
+        self.index = dict()      # {episode: {action: slot}}
+        self.last_key = None     # (episode, action) of the newest screenshot
+        self.index_file = None   # Index, opened for appending
+        self.index_read = 0      # Bytes of the index read so far, when reading only
+
+        # Are we continuing or reading existing files?
+        if mode != "w" and os.path.exists(path + ".json"):
+            with open(path + ".json") as f:
+                header = json.load(f)
+            self.shape = tuple(header["shape"])
+            self.dtype = np.dtype(header["dtype"])
+            self.refresh()
+        elif mode == "r":
+            raise FileNotFoundError(path + ".json")
+        elif self.shape is not None and self.dtype is not None:
+            self.create()
+
+        if mode != "r" and self.shape is not None:
+            self.index_file = open(path + ".index", "ab")
+
+    # Creates empty files, given the shape and data type
+    def create(self):
+        with open(self.path + ".json", "w") as f:
+            json.dump({"shape": list(self.shape), "dtype": self.dtype.str}, f)
+        open(self.path + ".frames", "wb").close()
+        open(self.path + ".index", "wb").close()
+        self.frames = None
+        self.count = 0
+        self.index = dict()
+
+    # Maps the frames file, given the number of slots it should hold. Grows the file if needed
+    def map(self, slots):
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        if self.mode != "r" and os.path.getsize(self.path + ".frames") < slots * frame_bytes:
+            with open(self.path + ".frames", "r+b") as f:
+                f.truncate(slots * frame_bytes)
+
+        self.flush()
+        self.frames = None if slots == 0 else np.memmap(
+            self.path + ".frames",
+            dtype = self.dtype,
+            mode = "r" if self.mode == "r" else "r+",
+            shape = (slots,) + self.shape
+        )
+
+    # Reads index entries written since the last refresh (by this or another process), and maps any new screenshots
+    def refresh(self):
+        with open(self.path + ".index", "rb") as f:
+            f.seek(self.index_read)
+            entries = f.read()
+        entries = entries[:len(entries) - len(entries) % INDEX_ENTRY.itemsize]
+        self.index_read += len(entries)
+
+        for episode, action, slot in np.frombuffer(entries, INDEX_ENTRY).tolist():
+            self.index.setdefault(episode, dict())[action] = slot
+            self.last_key = (episode, action)
+            self.count = max(self.count, slot + 1)
+
+        if self.frames is None or len(self.frames) < self.count:
+            frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+            self.map(max(self.count, os.path.getsize(self.path + ".frames") // frame_bytes))
+
+    # Stores a copy of the screenshot, given (episode, action)
+    # The newest screenshot is replaced if given its key again. Otherwise, older screenshots are never overwritten
+    def __setitem__(self, key, img):
+        if self.mode == "r":
+            raise IOError("Screenshot history " + self.path + " is read only")
+
+        img = np.asarray(img)
+
+        # Create the files on the first screenshot
+        if self.shape is None:
+            self.shape = img.shape
+            self.dtype = img.dtype if self.dtype is None else self.dtype
+            self.create()
+            self.index_file = open(self.path + ".index", "ab")
+
+        if img.shape != self.shape:
+            raise ValueError("Screenshot shape {} does not match stored shape {}".format(img.shape, self.shape))
+
+        episode, action = key = (int(key[0]), int(key[1]))
+
+        # Is this a replacement of the newest screenshot? Keep its slot
+        if key == self.last_key:
+            self.frames[self.index[episode][action]] = img
+            return
+
+        # Grow the frames file
+        if self.frames is None or self.count == len(self.frames):
+            self.map(self.count + self.chunk)
+
+        # Write the screenshot before its index entry, so readers never see an unwritten slot
+        slot = self.count
+        self.frames[slot] = img
+        self.index_file.write(np.array((episode, action, slot), INDEX_ENTRY).tobytes())
+        self.index_file.flush()
+
+        self.index.setdefault(episode, dict())[action] = slot
+        self.last_key = key
+        self.count += 1
+
+    # Returns the screenshot (a view, not a copy), given (episode, action)
+    def __getitem__(self, key):
+        return self.frames[self.index[key[0]][key[1]]]
+
+    def __contains__(self, key):
+        return key[0] in self.index and key[1] in self.index[key[0]]
+
+    def __len__(self):
+        return sum(len(actions) for actions in self.index.values())
+
+    # Episode after the newest stored, so a new run never reuses an episode of an earlier one
+    @property
+    def next_episode(self):
+        return max(self.index) + 1 if self.index else 0
+
+    # Returns the stored (episode, action) keys, sorted
+    def keys(self):
+        return [(episode, action) for episode in sorted(self.index) for action in sorted(self.index[episode])]
+
+    # Returns every screenshot of an episode as one numpy.ndarray, by action
+    # The result is a view if the episode's screenshots are contiguous on disk, which they are unless replaced
+    def episode(self, episode):
+        actions = self.index[episode]
+        slots = [actions[action] for action in sorted(actions)]
+        if slots == list(range(slots[0], slots[0] + len(slots))):
+            return self.frames[slots[0]:slots[-1] + 1]
+        return self.frames[slots]
+
+    # Writes every screenshot to disk
+    def flush(self):
+        if self.frames is not None and self.mode != "r": self.frames.flush()
+
+    # Flushes and closes the files
+    def close(self):
+        self.flush()
+        if self.index_file is not None: self.index_file.close()
+        self.index_file = None
+        self.frames = None
+
+    # Bytes of screenshots stored on disk
+    @property
+    def nbytes(self):
+        return 0 if self.shape is None else self.count * int(np.prod(self.shape)) * self.dtype.itemsize
+
+
+# Records demonstrations (a person playing) into a chunked, append-only dataset on disk: one step per UPDATE
+# Steps are gathered into chunks of preallocated arrays, then compressed and written by background threads, so the
+# emulator never waits on the disk. zlib releases the GIL, so threads compress in parallel with the server
+# Files: path/chunk_N.bin (each array of a chunk, compressed back to back), path/index.jsonl (a line per chunk)
+class DemonstrationWriter:
+    def __init__(
+            self,
+            # Directory of the dataset. An existing dataset is appended to
+            path,
+            # Name of each control, in the order of each step's controls
+            control_names,
+            # Steps per chunk
+            chunk_size = 256,
+            # zlib compression level: 1 is fastest, 9 is smallest
+            level = 1,
+            # Threads compressing and writing chunks
+            threads = 1,
+            # Most chunks waiting to be written. Once full, add() waits, rather than holding every frame in memory
+            queue_size = 8,
+    ):
+        os.makedirs(path, exist_ok = True)
+        self.path = path
+        self.control_names = list(control_names)
+        self.chunk_size = chunk_size
+        self.level = level
+        self.chunk = None  # Arrays of the chunk being filled
+        self.count = 0     # Steps in the chunk being filled
+        self.next_chunk = len(DemonstrationDataset(path).chunks)  # Number of the next chunk
+        self.queue = queue.Queue(queue_size)  # (number, chunk, steps) waiting to be written
+        self.free = queue.SimpleQueue()       # Written chunks, reused by new chunks
+        self.index_lock = threading.Lock()    # Held while appending to the index
+        self.steps = 0  # Steps written to disk
+        self.bytes = 0  # Compressed bytes written to disk
+        self.workers = [threading.Thread(target = self.work, daemon = True) for _ in range(threads)]
+        for worker in self.workers: worker.start()
+
+    # Returns empty arrays for a chunk, reusing a written chunk of the same shapes if there's one
+    def new_chunk(self, frame_shape, ram_size):
+        while not self.free.empty():
+            chunk = self.free.get()
+            if chunk["frames"].shape[1:] == frame_shape and chunk["ram"].shape[1] == ram_size:
+                chunk["data"] = []
+                return chunk
+
+        n = self.chunk_size
+        return {
+            "frames": np.empty((n,) + frame_shape, np.uint8),
+            "actions": np.empty(n, np.int64),
+            "controls": np.empty((n, len(self.control_names)), np.float32),
+            "ram": np.empty((n, ram_size), np.uint8),
+            "episodes": np.empty(n, np.int64),
+            "steps": np.empty(n, np.int64),
+            "data": [],
+        }
+
+    # Adds a step: the frame (stored as uint8), the index of its action (-1 if none), the value of each control,
+    # a snapshot of ram, and of data as a JSON-compatible dictionary, and the episode and step it was taken at
+    def add(self, frame, action, controls, ram, data, episode, step):
+        chunk = self.chunk
+        if chunk is not None and (chunk["frames"].shape[1:] != frame.shape or chunk["ram"].shape[1] != len(ram)):
+            self.submit()
+            chunk = None
+        if chunk is None:
+            self.chunk = chunk = self.new_chunk(frame.shape, len(ram))
+
+        i = self.count
+        convert_image(frame, chunk["frames"][i])
+        chunk["actions"][i] = action
+        chunk["controls"][i] = controls
+        chunk["ram"][i] = ram
+        chunk["episodes"][i] = episode
+        chunk["steps"][i] = step
+        chunk["data"].append(data)
+        self.count += 1
+        if self.count == self.chunk_size: self.submit()
+
+    # Hands the chunk being filled to the writing threads
+    def submit(self):
+        if self.count:
+            self.queue.put((self.next_chunk, self.chunk, self.count))
+            self.next_chunk += 1
+        self.chunk = None
+        self.count = 0
+
+    # Writes chunks handed to the queue, until given None
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            number, chunk, count = item
+            try:
+                self.write_chunk(number, chunk, count)
+            except Exception as e:  # Keep writing later chunks, so flush() still returns
+                print("ERROR: Could not write demonstration chunk " + str(number) + ": " + str(e))
+            finally:
+                self.free.put(chunk)
+                self.queue.task_done()
+
+    # Compresses each array of a chunk, writes them back to back, then appends where they are to the index
+    def write_chunk(self, number, chunk, count):
+        file = "chunk_{:06d}.bin".format(number)
+        blocks = {}
+        offset = 0
+        with open(os.path.join(self.path, file), "wb") as f:
+            for name, arr in chunk.items():
+                if name == "data":
+                    raw = self.data_json(arr, chunk["episodes"], chunk["steps"]).encode("utf-8")
+                    entry = {"dtype": "json"}
+                else:
+                    raw = arr = arr[:count]
+                    entry = {"dtype": arr.dtype.str, "shape": list(arr.shape)}
+                compressed = zlib.compress(raw, self.level)
+                f.write(compressed)
+                entry.update(offset = offset, size = len(compressed))
+                blocks[name] = entry
+                offset += len(compressed)
+
+        line = {"chunk": number, "file": file, "steps": count, "controls": self.control_names, "blocks": blocks}
+        with self.index_lock:
+            with open(os.path.join(self.path, DEMONSTRATION_INDEX), "a") as f:
+                f.write(json.dumps(line) + "\n")
+            self.steps += count
+            self.bytes += offset
+
+    # Returns the data of every step of a chunk as a JSON list. Data that can't be written is reported, and stored as null
+    @staticmethod
+    def data_json(data, episodes, steps):
+        entries = []
+        for i, step_data in enumerate(data):
+            try:
+                entries.append(json.dumps(step_data))
+            except (TypeError, ValueError) as e:
+                print("ERROR: Could not record data of episode {} step {}: {}".format(episodes[i], steps[i], e))
+                entries.append("null")
+        return "[" + ",".join(entries) + "]"
+
+    # Writes every step added so far, returning once they're on disk
+    def flush(self):
+        self.submit()
+        self.queue.join()
+
+    # Writes every step added so far, and stops the writing threads
+    def close(self):
+        self.flush()
+        for _ in self.workers: self.queue.put(None)
+        for worker in self.workers: worker.join()
+        self.workers = []
+
+
+# Reads a dataset written by a DemonstrationWriter, chunk by chunk
+class DemonstrationDataset:
+    def __init__(self, path):
+        self.path = path
+        self.chunks = []  # Index line of every chunk, in order
+        self.refresh()
+
+    # Reads chunks written since opening
+    def refresh(self):
+        index = os.path.join(self.path, DEMONSTRATION_INDEX)
+        if not os.path.exists(index): return
+        with open(index) as f:
+            self.chunks = sorted((json.loads(line) for line in f if line.strip()), key = lambda line: line["chunk"])
+
+    # Number of steps stored
+    def __len__(self):
+        return sum(chunk["steps"] for chunk in self.chunks)
+
+    # Returns the arrays of the i-th chunk: frames, actions, controls, ram, episodes, steps and data (a list)
+    def __getitem__(self, i):
+        chunk = self.chunks[i]
+        with open(os.path.join(self.path, chunk["file"]), "rb") as f:
+            raw = f.read()
+
+        arrays = {}
+        for name, entry in chunk["blocks"].items():
+            block = zlib.decompress(raw[entry["offset"]:entry["offset"] + entry["size"]])
+            if entry["dtype"] == "json": arrays[name] = json.loads(block)
+            else:                        arrays[name] = np.frombuffer(block, np.dtype(entry["dtype"])).reshape(entry["shape"])
+        return arrays
+
+    # Returns the arrays of every chunk, in order
+    def __iter__(self):
+        return (self[i] for i in range(len(self.chunks)))
+
+
+#
+# Observation Pipeline
+#
+# Steps that turn each screenshot into an observation once, as it arrives: pipeline = [Crop(...), Grayscale(), ...]
+# Each step's prepare(shape, dtype) is called with the shape and data type of the frames it's given, once per session
+# It returns (shape, dtype, apply) of its output, where apply(img, out) returns the output, written into out
+# Steps that only view their input have copies = False, and are given no out
+#
+
+# Crops the frame, given decimal percentages to remove from each side (like crop_percent). A view, not a copy
+class Crop:
+    copies = False
+
+    def __init__(self, top = 0.0, left = 0.0, bottom = 0.0, right = 0.0):
+        self.margins = (top, left, bottom, right)
+
+    def prepare(self, shape, dtype):
+        top, left, bottom, right = self.margins
+        y1, x1 = int(top * shape[0]), int(left * shape[1])
+        y2, x2 = int(shape[0] - bottom * shape[0]), int(shape[1] - right * shape[1])
+        return (y2 - y1, x2 - x1) + tuple(shape[2:]), dtype, lambda img, out: img[y1:y2, x1:x2]
+
+
+# Converts the frame to a single grayscale channel, keeping its data type
+# When it comes before any step but Crop, screenshots are decoded straight to grayscale instead
+class Grayscale:
+    copies = True
+
+    def prepare(self, shape, dtype):
+        if len(shape) == 2:
+            return shape, dtype, lambda img, out: img
+        if dtype != np.uint8:
+            return shape[:2], dtype, lambda img, out: to_grayscale(img, out = out)
+
+        # Weigh uint8 channels in a reused float32 buffer, then round back to uint8
+        gray = np.empty(shape[:2], np.float32)
+        def apply(img, out):
+            to_grayscale(img, out = gray)
+            np.rint(gray, out = gray)
+            np.copyto(out, gray, casting = "unsafe")
+            return out
+        return shape[:2], dtype, apply
+
+
+# Resizes the frame to (height, width), keeping the nearest pixel to the center of each output pixel
+class Resize:
+    copies = True
+
+    def __init__(self, height, width):
+        self.size = (height, width)
+
+    def prepare(self, shape, dtype):
+        height, width = self.size
+        rows = ((np.arange(height) + 0.5) * shape[0] / height).astype(np.intp)
+        cols = ((np.arange(width) + 0.5) * shape[1] / width).astype(np.intp)
+        picked_rows = np.empty((height,) + tuple(shape[1:]), dtype)
+
+        def apply(img, out):
+            np.take(img, rows, axis = 0, out = picked_rows)
+            return np.take(picked_rows, cols, axis = 1, out = out)
+        return (height, width) + tuple(shape[2:]), dtype, apply
+
+
+# Stacks the last n observations, oldest first. Must be the last step of a pipeline
+# Observations are stored one by one, and stacks are views of the most recent ones (see ScreenshotStore.last())
+class Stack:
+    def __init__(self, frames):
+        self.frames = frames
+
+
+# Runs a pipeline's steps over each screenshot of a session, writing only into buffers allocated for its first frame
+# Screenshots are decoded into one reused frame, or into raw_screenshots when raw frames are kept
+class ObservationPipeline:
+    def __init__(self, steps, raw_screenshots = None):
+        steps = list(steps)
+        self.stack = steps.pop().frames if steps and isinstance(steps[-1], Stack) else 1  # Observations per stack
+        if any(isinstance(step, Stack) for step in steps):
+            raise ValueError("Stack must be the last step of a pipeline")
+
+        # Decode straight to grayscale, unless raw frames are kept in color
+        self.grayscale = False  # Whether screenshots are decoded to grayscale
+        if raw_screenshots is None:
+            for i, step in enumerate(steps):
+                if isinstance(step, Grayscale):
+                    self.grayscale = True
+                    del steps[i]
+                if not isinstance(step, Crop): break
+
+        self.steps = steps
+        self.raw_screenshots = raw_screenshots  # Stores raw frames, before the pipeline. None to keep only the latest
+        self.frame = None     # Latest raw frame, when raw frames aren't kept
+        self.prepared = None  # (shape, dtype) of the frames the stages were prepared for
+        self.stages = []      # [(apply, buffer)] of each step. The last step writes into the reserved observation
+        self.shape = None     # Shape of every observation
+        self.dtype = None     # Data type of every observation
+
+    # Returns the array to decode the next raw frame into, given its key, shape and data type
+    def reserve(self, key, shape, dtype):
+        if self.raw_screenshots is not None:
+            return self.raw_screenshots.reserve(key, shape, dtype)
+        if self.frame is None or self.frame.shape != tuple(shape) or self.frame.dtype != dtype:
+            self.frame = np.empty(shape, dtype)
+        return self.frame
+
+    # Prepares every step for raw frames of the given shape and data type, allocating their buffers
+    def prepare(self, shape, dtype):
+        self.stages = []
+        for i, step in enumerate(self.steps):
+            shape, dtype, apply = step.prepare(shape, dtype)
+            last = i == len(self.steps) - 1
+            self.stages.append((apply, np.empty(shape, dtype) if step.copies and not last else None))
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+
+    # Runs the steps over the latest raw frame, writing the observation into reserve(shape, dtype)
+    def process(self, reserve):
+        if self.raw_screenshots is not None:
+            self.raw_screenshots.commit()
+            frame = self.raw_screenshots.frames[self.raw_screenshots.head]
+        else:
+            frame = self.frame
+        if self.prepared != (frame.shape, frame.dtype):
+            self.prepare(frame.shape, frame.dtype)
+            self.prepared = (frame.shape, frame.dtype)
+
+        img = frame
+        for apply, buffer in self.stages[:-1]:
+            img = apply(img, buffer)
+
+        out = reserve(self.shape, self.dtype)
+        if self.stages: img = self.stages[-1][0](img, out)
+        if img is not out: np.copyto(out, img)
+
+    # Returns the last stack observations of a ScreenshotStore, oldest first. A view once it holds that many
+    # Until then, the oldest observation is repeated
+    def stacked(self, observations):
+        if observations.count >= self.stack:
+            return observations.last(self.stack)
+        recent = observations.last(observations.count)
+        return np.concatenate((recent[:1].repeat(self.stack - observations.count, axis = 0), recent))
+
+
+#
+# Experience Replay
+#
+
+# Sums of priorities in a binary tree, so items are sampled by priority in O(log n). Leaves are the items' priorities
+# Updates and samples are vectorized over many items at once
+class SumTree:
+    def __init__(self, capacity):
+        self.size = 1 << max(0, capacity - 1).bit_length()  # Leaves, a power of 2
+        self.depth = self.size.bit_length() - 1             # Levels below the root
+        self.tree = np.zeros(2 * self.size)  # Node i sums nodes 2i and 2i + 1. The root is node 1
+        self.max_priority = 1.0              # Highest priority given so far, given to new items
+
+    # Sum of every priority
+    @property
+    def total(self):
+        return self.tree[1]
+
+    # Returns the priorities of items, given their indices
+    def __getitem__(self, indices):
+        return self.tree[self.size + np.asarray(indices)]
+
+    # Sets the priorities of items, given their indices
+    def update(self, indices, priorities):
+        nodes = self.size + np.asarray(indices, np.intp)
+        self.tree[nodes] = priorities
+
+        # A single item is faster to update without numpy
+        if len(nodes) == 1:
+            tree = self.tree
+            node = int(nodes[0]) >> 1
+            while node:
+                tree[node] = tree[2 * node] + tree[2 * node + 1]
+                node >>= 1
+            return
+
+        for _ in range(self.depth):
+            nodes = np.unique(nodes >> 1)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    # Returns the item holding each value, given values in [0, total). Items hold spans as wide as their priorities
+    def find(self, values):
+        values = np.minimum(values, np.nextafter(self.total, 0))
+
+        # A single value is faster to find without numpy
+        if len(values) == 1:
+            tree = self.tree
+            value = float(values[0])
+            node = 1
+            for _ in range(self.depth):
+                left = tree[2 * node]
+                if value >= left:
+                    value -= left
+                    node = 2 * node + 1
+                else:
+                    node = 2 * node
+            return np.array([node - self.size])
+
+        nodes = np.ones(len(values), np.intp)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            right = values >= left
+            values = values - left * right
+            nodes = 2 * nodes + right
+        return nodes - self.size
+
+
+# Stores transitions (observation, action, reward, next observation, done) of one client, as its frames arrive
+# Each frame is stored once as uint8, along with the action taken at it, and the reward and done flag that followed
+# Observations are stacks of the last history frames, gathered when sampled, so transitions share their frames
+# Frames before the start of an episode are replaced by its first frame
+class ReplayBuffer:
+    def __init__(
+            self,
+            # Most frames stored at once. The oldest is dropped once full. See memory() for the bytes used
+            capacity,
+            # Frames stacked into each observation
+            history = 4,
+            # Sample transitions by priority, held in a SumTree, instead of uniformly
+            prioritized = False,
+            # How much priorities count when sampling: 0 is uniform, 1 is proportional to priorities
+            alpha = 0.6,
+            # How much importance weights correct for prioritized sampling: 0 is none, 1 is fully
+            beta = 0.4,
+            # Seed of the random generator, for repeatable samples
+            seed = None,
+    ):
+        self.capacity = capacity
+        self.history = history
+        self.alpha = alpha
+        self.beta = beta
+        self.frames = None                                # Every frame. Allocated by the first frame
+        self.actions = np.full(capacity, -1, np.int64)   # Index in action_space of the action taken at each frame
+        self.rewards = np.zeros(capacity, np.float32)    # Reward after each frame's action
+        self.dones = np.zeros(capacity, np.bool_)        # Whether the episode ended after each frame's action
+        self.starts = np.zeros(capacity, np.bool_)       # Whether each frame is the first of its episode still stored
+        self.valid = np.zeros(capacity, np.bool_)        # Whether each frame's transition is complete, so it's sampled
+        self.head = -1       # Slot of the newest frame
+        self.count = 0       # Number of frames stored
+        self.pending = False  # Whether the reward and done flag of the newest frame are yet to come
+        self.episode_start = True  # Whether the next frame starts an episode
+        self.added = 0  # Number of frames ever added. Tells checkpoints what changed
+        self.complete = 0  # Number of frames stored with a complete transition (valid)
+        self.tree = SumTree(capacity) if prioritized else None
+        self.rng = np.random.default_rng(seed)
+        self.offsets = np.arange(1 - history, 1)  # Slots of an observation's frames, relative to its newest
+        self.batch = None  # Arrays reused by sample(), allocated for the last batch size
+        self.lock = threading.Lock()  # Held while adding or sampling, since they're called from different threads
+
+    # Returns the bytes used by a buffer of capacity frames, each of the given shape
+    @staticmethod
+    def memory(capacity, shape, prioritized = False):
+        per_frame = int(np.prod(shape)) + 8 + 4 + 1 + 1 + 1
+        tree = 16 << max(0, capacity - 1).bit_length() if prioritized else 0
+        return capacity * per_frame + tree
+
+    # Bytes used by the buffer
+    @property
+    def nbytes(self):
+        frames = 0 if self.frames is None else self.frames.nbytes
+        tree = 0 if self.tree is None else self.tree.tree.nbytes
+        flags = self.dones.nbytes + self.starts.nbytes + self.valid.nbytes
+        return frames + self.actions.nbytes + self.rewards.nbytes + flags + tree
+
+    def __len__(self):
+        return self.count
+
+    # Adds the next frame of an episode and the action taken at it (None if not chosen by index)
+    # The reward and done flag follow the previous frame's action. If done, this frame ends the episode, so it is not
+    # stored, and the next frame starts a new one
+    def add(self, frame, action, reward = 0.0, done = False):
+        with self.lock:
+            if self.pending:
+                self.rewards[self.head] = reward
+                self.dones[self.head] = done
+                self.valid[self.head] = True
+                self.complete += 1
+                self.pending = False
+                if self.tree is not None: self.tree.update([self.head], [self.tree.max_priority])
+            if done:
+                self.episode_start = True
+                return
+
+            if self.frames is None:
+                self.frames = np.zeros((self.capacity,) + frame.shape, np.uint8)
+            head = (self.head + 1) % self.capacity
+            if self.valid[head]:
+                self.valid[head] = False
+                self.complete -= 1
+            convert_image(frame, self.frames[head])
+            self.actions[head] = -1 if action is None else action
+            self.rewards[head] = 0.0
+            self.dones[head] = False
+            self.starts[head] = self.episode_start
+            self.episode_start = False
+            self.head = head
+            self.count = min(self.count + 1, self.capacity)
+            self.added += 1
+            self.pending = True
+
+            # Observations of the oldest frame can't reach back past it
+            if self.count == self.capacity:
+                self.starts[(head + 1) % self.capacity] = True
+            if self.tree is not None: self.tree.update([head], [0.0])
+
+    # Ends the current episode without a final reward, such as when the client restarts. The next frame starts a new one
+    # The newest frame's transition is cut short, with no reward or next frame, so it's never sampled (its priority stays 0)
+    def end_episode(self):
+        with self.lock:
+            self.pending = False
+            self.episode_start = True
+
+    # Returns the slots of the frames of each observation, given the slots of their newest frames. Shape (n, history)
+    def stack_slots(self, slots):
+        stacks = (slots[:, None] + self.offsets) % self.capacity
+        starts = self.starts[stacks]
+
+        # Replace frames before the newest episode start by the start
+        first = np.where(starts.any(axis = 1), self.history - 1 - np.argmax(starts[:, ::-1], axis = 1), 0)
+        start_slots = stacks[np.arange(len(slots)), first]
+        return np.where(np.arange(self.history) < first[:, None], start_slots[:, None], stacks)
+
+    # Samples transitions into arrays reused by the next sample() (copy them to keep them). Returns a dictionary:
+    #   observations, next_observations  uint8 (batch_size, history, *frame shape)
+    #   actions (int64), rewards (float32), dones (bool), indices (int64), weights (float32)  (batch_size,)
+    # weights are importance weights of prioritized samples (1 if uniform). Give indices to update_priorities()
+    def sample(self, batch_size = 32):
+        with self.lock:
+            transitions = self.complete
+            if transitions < 1 or self.tree is not None and self.tree.total <= 0:
+                raise ValueError("Cannot sample from a replay buffer without complete transitions")
+
+            batch = self.batch
+            if batch is None or len(batch["actions"]) != batch_size:
+                stack = (batch_size, self.history) + self.frames.shape[1:]
+                self.batch = batch = {
+                    "observations": np.empty(stack, np.uint8),
+                    "actions": np.empty(batch_size, np.int64),
+                    "rewards": np.empty(batch_size, np.float32),
+                    "next_observations": np.empty(stack, np.uint8),
+                    "dones": np.empty(batch_size, np.bool_),
+                    "indices": np.empty(batch_size, np.int64),
+                    "weights": np.ones(batch_size, np.float32),
+                }
+
+            if self.tree is None:
+                oldest = (self.head + 1) % self.capacity if self.count == self.capacity else 0
+                slots = (oldest + self.rng.integers(0, self.count, batch_size)) % self.capacity
+
+                # Draw again for frames without a complete transition: the newest, and any cut short by end_episode()
+                invalid = ~self.valid[slots]
+                while invalid.any():
+                    slots[invalid] = (oldest + self.rng.integers(0, self.count, int(invalid.sum()))) % self.capacity
+                    invalid = ~self.valid[slots]
+            else:
+                # One sample from each of batch_size equal spans of the total priority
+                total = self.tree.total
+                slots = self.tree.find((np.arange(batch_size) + self.rng.random(batch_size)) * (total / batch_size))
+                weights = (transitions * self.tree[slots] / total) ** -self.beta
+                np.divide(weights, weights.max(), out = batch["weights"], casting = "unsafe")
+
+            np.take(self.frames, self.stack_slots(slots), axis = 0, out = batch["observations"])
+            np.take(self.frames, self.stack_slots((slots + 1) % self.capacity), axis = 0, out = batch["next_observations"])
+            np.take(self.actions, slots, out = batch["actions"])
+            np.take(self.rewards, slots, out = batch["rewards"])
+            np.take(self.dones, slots, out = batch["dones"])
+            batch["indices"][:] = slots
+            return batch
+
+    # Returns the slots of the n newest frames, oldest first
+    def recent_slots(self, n):
+        n = min(n, self.count)
+        return (np.arange(self.head - n + 1, self.head + 1)) % self.capacity
+
+    # Sets the priorities of sampled transitions, given their indices and errors (such as TD errors)
+    def update_priorities(self, indices, errors):
+        priorities = (np.abs(errors) + 1e-6) ** self.alpha
+        with self.lock:
+            self.tree.max_priority = max(self.tree.max_priority, float(priorities.max()))
+            self.tree.update(indices, priorities)
+
+
+#
+# Save States
+#
+
+# Samples save states by weight in O(log n), through a SumTree, so weights can change between episodes cheaply
+# Reads and writes like the saves dictionary it replaces, {path: weight}. Weights needn't sum to 1
+# Also records statistics of the episodes started from each save, for curricula that weigh saves by how they went
+class SaveSampler:
+    def __init__(self, saves = None, seed = None):
+        self.paths = []       # Every save's path, by index
+        self.indices = dict()  # {path: index}
+        self.tree = SumTree(max(1, len(saves or ())))  # Weights of saves, by index
+        self.episodes = np.zeros(self.tree.size, np.int64)   # Episodes recorded for each save
+        self.results = np.zeros(self.tree.size, np.float64)  # Sum of the results of each save's episodes
+        self.last = np.zeros(self.tree.size, np.float64)     # Result of each save's last episode
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()  # Held while changing weights or sampling, since clients share the sampler
+
+        for path, weight in (saves or dict()).items():
+            self.indices[path] = len(self.paths)
+            self.paths.append(path)
+        if self.paths:
+            self.tree.update(np.arange(len(self.paths)), [saves[path] for path in self.paths])
+
+    # Returns a save's weight
+    def __getitem__(self, path):
+        return float(self.tree[[self.indices[path]]][0])
+
+    # Sets a save's weight, adding the save if it's new. 0 stops it from being sampled
+    def __setitem__(self, path, weight):
+        if weight < 0: raise ValueError("Save weights can't be negative")
+        with self.lock:
+            idx = self.indices.get(path)
+            if idx is None:
+                idx = self.add(path)
+            self.tree.update([idx], [weight])
+
+    # Adds a save without weight. Doubles the tree once full. Returns its index
+    def add(self, path):
+        idx = len(self.paths)
+        if idx == self.tree.size:
+            tree = SumTree(2 * self.tree.size)
+            tree.update(np.arange(idx), self.tree[np.arange(idx)])
+            self.tree = tree
+            for name in ("episodes", "results", "last"):
+                grown = np.zeros(tree.size, getattr(self, name).dtype)
+                grown[:idx] = getattr(self, name)
+                setattr(self, name, grown)
+        self.indices[path] = idx
+        self.paths.append(path)
+        return idx
+
+    def __contains__(self, path):
+        return path in self.indices
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def keys(self):
+        return list(self.paths)
+
+    def values(self):
+        return [float(weight) for weight in self.tree[np.arange(len(self.paths))]]
+
+    def items(self):
+        return list(zip(self.paths, self.values()))
+
+    # Sets many saves' weights at once, given {path: weight}
+    def update(self, saves):
+        with self.lock:
+            indices = [self.indices[path] if path in self.indices else self.add(path) for path in saves]
+            self.tree.update(indices, list(saves.values()))
+
+    # Returns the path of a save, picked with probability proportional to its weight
+    def sample(self):
+        with self.lock:
+            if self.tree.total <= 0: raise ValueError("No save state has any weight")
+            return self.paths[int(self.tree.find(self.rng.random(1) * self.tree.total)[0])]
+
+    # Records the result of an episode started from a save, such as its return or whether it succeeded
+    def record(self, path, result = 0.0):
+        idx = self.indices.get(path)
+        if idx is None: return
+        with self.lock:
+            self.episodes[idx] += 1
+            self.results[idx] += result
+            self.last[idx] = result
+
+    # Returns statistics of the episodes started from a save: episodes, mean_result and last_result
+    def stats(self, path):
+        idx = self.indices[path]
+        episodes = int(self.episodes[idx])
+        return {
+            "episodes": episodes,
+            "mean_result": float(self.results[idx] / episodes) if episodes else 0.0,
+            "last_result": float(self.last[idx]),
+        }
+
+
+#
+# Shared Memory
+#
+
+# Returns where each array of a shared observation ring is, {name: (offset, shape, dtype)}, and the bytes of the ring
+# A ring holds a header (int64s), its description as JSON, then its arrays, each aligned to SHARED_ALIGNMENT bytes
+def shared_layout(description):
+    capacity, clients = description["capacity"], description["clients"]
+    arrays = (
+        ("frames", (capacity,) + tuple(description["shape"]), np.dtype(description["dtype"])),
+        ("seqs", (capacity,), np.dtype(np.int64)),      # Step held by each slot. -1 while it's written
+        ("clients", (capacity,), np.dtype(np.int64)),   # Client of each step (its session's shared_client)
+        ("episodes", (capacity,), np.dtype(np.int64)),  # Episodes the client had completed at each step
+        ("steps", (capacity,), np.dtype(np.int64)),     # Actions taken by the client in its episode at each step
+        ("rewards", (capacity,), np.dtype(np.float32)),  # Reward of the client's previous action
+        ("dones", (capacity,), np.dtype(np.bool_)),      # Whether the client's previous action ended its episode
+        ("answers", (clients, 2), np.dtype(np.int64)),   # Each client's latest [step answered, action], from trainers
+    )
+    layout = dict()
+    offset = SHARED_HEADER + len(json.dumps(description))
+    for name, shape, dtype in arrays:
+        offset = -(-offset // SHARED_ALIGNMENT) * SHARED_ALIGNMENT
+        layout[name] = (offset, shape, dtype)
+        offset += int(np.prod(shape)) * dtype.itemsize
+    return layout, offset
+
+
+# Returns the header and arrays of a shared observation ring, as views of its memory
+def shared_arrays(buf, layout):
+    header = np.ndarray(SHARED_HEADER // 8, np.int64, buf)
+    return header, {name: np.ndarray(shape, dtype, buf, offset) for name, (offset, shape, dtype) in layout.items()}
+
+
+# Publishes each client's observations to trainers in other processes, through a multiprocessing.shared_memory block
+# Steps are written into a ring of capacity slots. Each slot holds the number of the step in it, set to -1 while it's
+# being written, so readers (see SharedObservationReader) copy steps without a lock, and can tell a step was overwritten
+# while they copied it. Trainers answer each step with an action, written into the client's row of answers
+class SharedObservationRing:
+    def __init__(
+            self,
+            # Name of the shared memory block, given to readers
+            name,
+            # Shape and data type of every observation
+            shape,
+            dtype,
+            # Steps held at once. The oldest is overwritten once full
+            capacity = 256,
+            # Most clients publishing, each with a row of answers
+            clients = 64,
+    ):
+        from multiprocessing import shared_memory  # Only needed when publishing
+        self.description = SharedObservationRing.describe(shape, dtype, capacity, clients)
+        self.capacity = capacity
+        self.max_clients = clients
+        layout, size = shared_layout(self.description)
+        self.memory = shared_memory.SharedMemory(name, create = True, size = size)
+        self.header, arrays = shared_arrays(self.memory.buf, layout)
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+        self.seqs[:] = -1
+        self.answers[:] = -1
+        self.published = 0  # Steps ever published. The next step's number
+        self.lock = threading.Lock()  # Held while publishing, since clients publish from different threads
+        self.idle = threading.Condition(self.lock)  # Notified once no client is waiting for an action
+        self.waiting = 0  # Clients in wait_action(). close() waits for them, since they read the memory
+        self.closed = False  # Set by close(). Nothing is published or waited for once set
+
+        # Describe the ring last, so readers wait until it's ready
+        description = json.dumps(self.description).encode("utf-8")
+        self.memory.buf[SHARED_HEADER:SHARED_HEADER + len(description)] = description
+        self.header[1] = len(description)
+
+    # Returns the description of a ring, written to its memory for readers
+    @staticmethod
+    def describe(shape, dtype, capacity, clients):
+        return {
+            "version": SHARED_VERSION, "shape": list(shape), "dtype": np.dtype(dtype).str,
+            "capacity": capacity, "clients": clients,
+        }
 
+    # Returns the bytes used by a ring of capacity observations, each of the given shape and dtype
+    @staticmethod
+    def memory_size(shape, dtype, capacity = 256, clients = 64):
+        return shared_layout(SharedObservationRing.describe(shape, dtype, capacity, clients))[1]
+
+    # Writes a client's observation and step into the next slot. Returns the step's number, answered by trainers
+    def publish(self, client, observation, episode, step, reward, done):
+        if not 0 <= client < self.max_clients:
+            raise ValueError("Client {} is past the {} clients of the shared ring".format(client, self.max_clients))
+        with self.lock:
+            if self.closed: raise ValueError("The shared ring is closed")
+            seq = self.published
+            slot = seq % self.capacity
+            self.seqs[slot] = -1
+            self.frames[slot] = observation
+            self.clients[slot] = client
+            self.episodes[slot] = episode
+            self.steps[slot] = step
+            self.rewards[slot] = reward
+            self.dones[slot] = done
+            self.seqs[slot] = seq
+            self.published = seq + 1
+            self.header[0] = seq + 1
+        return seq
+
+    # Waits for a trainer to answer a client's step, then returns the action
+    # None if timeout seconds pass first, or the ring is closed while waiting
+    def wait_action(self, client, seq, timeout = None):
+        with self.lock:
+            if self.closed: return None
+            self.waiting += 1
+
+        answer = self.answers[client]
+        try:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            delay = 0.0
+            while answer[0] < seq:
+                if self.closed or deadline is not None and time.monotonic() >= deadline: return None
+                time.sleep(delay)
+                delay = min(2 * delay + 1e-5, 1e-3)  # Poll quickly at first, then back off to a millisecond
+            return int(answer[1])
+        finally:
+            answer = None  # A view of the memory, which can't be freed while it's held
+            with self.lock:
+                self.waiting -= 1
+                self.idle.notify_all()
+
+    # Marks the ring closed for readers, wakes clients waiting for actions, then frees its memory
+    # Call once the server is done with it. Closing again does nothing
+    def close(self):
+        with self.lock:
+            if self.closed: return
+            self.closed = True
+            self.header[2] = 1
+            self.idle.wait_for(lambda: self.waiting == 0)
+        del self.header, self.frames, self.seqs, self.clients, self.episodes, self.steps, self.rewards, self.dones
+        del self.answers
+        self.memory.close()
+        self.memory.unlink()
+
+
+# Reads the steps published to a SharedObservationRing, from another process (a trainer), and answers them with actions
+# Never blocks the server: steps are copied without a lock, and steps overwritten before they're read are skipped
+class SharedObservationReader:
+    def __init__(self, name, timeout = None):
+        from multiprocessing import shared_memory, resource_tracker
+
+        # Wait for the server to create and describe the ring
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                self.memory = shared_memory.SharedMemory(name)
+                break
+            except FileNotFoundError:
+                if deadline is not None and time.monotonic() >= deadline: raise
+                time.sleep(0.01)
+        # The server frees the ring, not its readers. Before Python 3.13, attaching also registers it to be freed
+        try:
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+        except Exception:
+            pass
+        header = np.ndarray(SHARED_HEADER // 8, np.int64, self.memory.buf)
+        while not header[1]:
+            time.sleep(0.001)
+
+        self.description = json.loads(bytes(self.memory.buf[SHARED_HEADER:SHARED_HEADER + int(header[1])]))
+        if self.description["version"] != SHARED_VERSION:
+            raise ValueError("Unrecognized shared ring version " + str(self.description["version"]))
+        self.capacity = self.description["capacity"]
+        self.max_clients = self.description["clients"]
+        layout, _ = shared_layout(self.description)
+        self.header, arrays = shared_arrays(self.memory.buf, layout)
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+        self.next = 0     # Number of the next step to read
+        self.dropped = 0  # Steps overwritten before they were read
+
+    # Whether the server has closed the ring
+    @property
+    def closed(self):
+        return bool(self.header[2])
+
+    # Steps published, but not yet read
+    @property
+    def pending(self):
+        return int(self.header[0]) - self.next
+
+    # Returns copies of the steps published since the last read (at most max_steps, oldest first), as a dictionary:
+    #   seqs, clients, episodes, steps (int64), rewards (float32), dones (bool)  (n,)
+    #   observations  (n, *observation shape)
+    # Pass seqs and clients to act() to answer steps
+    def read(self, max_steps = None):
+        published = int(self.header[0])
+        if published - self.next > self.capacity:
+            self.dropped += published - self.capacity - self.next
+            self.next = published - self.capacity
+        end = published if max_steps is None else min(published, self.next + max_steps)
+        seqs = np.arange(self.next, end)
+        slots = seqs % self.capacity
+
+        # Copy the slots, keeping only those holding the same step before and after
+        before = self.seqs[slots]
+        steps = {
+            "observations": self.frames[slots], "clients": self.clients[slots], "episodes": self.episodes[slots],
+            "steps": self.steps[slots], "rewards": self.rewards[slots], "dones": self.dones[slots],
+        }
+        valid = (before == seqs) & (self.seqs[slots] == seqs)
+        if not valid.all():
+            self.dropped += int(len(valid) - valid.sum())
+            steps = {name: arr[valid] for name, arr in steps.items()}
+        steps["seqs"] = seqs[valid]
+        self.next = end
+        return steps
+
+    # Waits until a step is published, then reads like read(). Returns no steps if timeout seconds pass, or it's closed
+    def wait(self, max_steps = None, timeout = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0
+        while self.pending <= 0 and not self.closed:
+            if deadline is not None and time.monotonic() >= deadline: break
+            time.sleep(delay)
+            delay = min(2 * delay + 1e-5, 1e-3)
+        return self.read(max_steps)
+
+    # Answers steps with actions (indices into the server's action_space), given their clients and numbers
+    def act(self, clients, seqs, actions):
+        for client, seq, action in zip(np.atleast_1d(clients), np.atleast_1d(seqs), np.atleast_1d(actions)):
+            answer = self.answers[client]
+            answer[1] = action  # The action is written first, so the server never reads it before its step number
+            answer[0] = seq
+
+    # Detaches from the ring. The server frees it
+    def close(self):
+        del self.header, self.frames, self.seqs, self.clients, self.episodes, self.steps, self.rewards, self.dones
+        del self.answers
+        self.memory.close()
+
+
+#
+# Checkpoint Blocks
+#
+
+# Appends a copy of an array to blocks, {"arrays": [...], "size": bytes}, written back to back. Returns where it is
+def add_block(blocks, arr):
+    arr = np.array(arr, order = "C")
+    entry = {"offset": blocks["size"], "dtype": arr.dtype.str, "shape": list(arr.shape)}
+    blocks["arrays"].append(arr)
+    blocks["size"] += arr.nbytes
+    return entry
+
+
+# Returns a copy of an array from the bytes of blocks, given where it is
+def read_block(raw, entry):
+    count = int(np.prod(entry["shape"]))
+    return np.frombuffer(raw, np.dtype(entry["dtype"]), count, entry["offset"]).reshape(entry["shape"]).copy()
+
+
+# Returns a copy of a value of data that's a list (STRING[]) or a dictionary (DICT), or the value itself otherwise
+def copy_value(val):
+    if isinstance(val, list): return list(val)
+    if isinstance(val, dict): return dict(val)
+    return val
+
+
+# Reads every slot of a store from a file, straight into its frames
+def read_ring(path, frames):
+    with open(path, "rb") as f:
+        if f.readinto(memoryview(frames).cast("B")) != frames.nbytes:
+            raise ValueError("Checkpoint file " + path + " is incomplete")
+
+
+# Discrete actions: every combination of the given controls' values, numbered like make_action_map()
+# Actions are stored as a table of values, with a row per action and a column per control
+# The GET controls response of every action is built once, so choosing controls by index costs a lookup and a comparison
+class ActionSpace:
+    def __init__(
+            self,
+            # Controls and the values each can take: [(name, [values]), ...]. The first control changes slowest
+            actions,
+            # Controls sent along with every action, such as the server's initial_controls
+            base = None,
+    ):
+        self.names = [name for name, _ in actions]             # Name of each control
+        self.values = [list(values) for _, values in actions]  # Values each control can take
+        self.sizes = tuple(len(values) for values in self.values)
+        self.base = dict() if base is None else dict(base)
+
+        # Index into values of each control, for every action
+        choices = np.indices(self.sizes).reshape(len(self.sizes), -1)
+        # Value of each control, for every action. Booleans become 0 and 1 if mixed with integers
+        self.table = np.stack([np.asarray(values)[c] for values, c in zip(self.values, choices)], axis = 1)
+
+        # GET controls response of every action. Keys are ordered like base.update(action)
+        # Runs of base controls are joined once, then each action control's column is appended to every response
+        parts = []
+        for key in list(self.base) + [name for name in self.names if name not in self.base]:
+            sep = "," if parts else ""
+            if key in self.names:
+                c = self.names.index(key)
+                parts.append(np.array([sep + key + ":" + str(val) for val in self.values[c]], dtype = object)[choices[c]])
+            elif parts and isinstance(parts[-1], str):
+                parts[-1] += sep + key + ":" + str(self.base[key])
+            else:
+                parts.append(sep + key + ":" + str(self.base[key]))
+        wire = np.full(len(choices[0]), "", dtype = object)
+        for part in parts:
+            wire += part
+        self.wire = wire.tolist()  # [response of action 0, ...]
+
+    def __len__(self):
+        return len(self.wire)
+
+    # Returns the controls of an action, {name: value}
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if not 0 <= idx < len(self.wire): raise IndexError("Action " + str(idx) + " is out of range")
+        controls = {}
+        for name, values, size in zip(reversed(self.names), reversed(self.values), reversed(self.sizes)):
+            idx, c = divmod(idx, size)
+            controls[name] = values[c]
+        return controls
+
+    # Returns the controls of an action, along with the base controls
+    def controls(self, idx):
+        controls = dict(self.base)
+        controls.update(self[idx])
+        return controls
+
+    # Returns the GET controls response of a controls dict chosen as action idx
+    # Prebuilt, unless the dict was also edited directly, so that it no longer holds just the action and base controls
+    def response(self, idx, controls):
+        if controls == self.controls(idx): return self.wire[idx]
+        return dict_as_str(controls)
+
+    # Returns the values of many actions at once, given an array of indices (e.g. from a policy)
+    # Returns an array with a row per index and a column per control, in the order of names
+    def decode(self, indices):
+        return self.table[indices]
+
+    # Returns the index of the action nearest to the given controls, {name: value}, such as a person's joypad
+    # Each control takes its nearest value (True is 1, False is 0). Missing controls are taken as 0
+    def encode(self, controls):
+        choices = [
+            int(np.argmin(np.abs(np.asarray(values, np.float64) - float(controls.get(name, 0)))))
+            for name, values in zip(self.names, self.values)
+        ]
+        return int(np.ravel_multi_index(choices, self.sizes))
+
+
+# Returns the path of a client's file or directory, given the path shared by every client: with "_id" appended, or
+# unchanged for clients without an id. Ids come from clients, so everything but letters, digits, "_" and "-" is escaped,
+# keeping ids like "../x" from leaving the directory of path
+def client_path(path, client_id):
+    if not client_id: return path
+    return path + "_" + quote(client_id, safe = "").replace(".", "%2E").replace("~", "%7E")
+
+
+# State of a single client (emulator). The server holds a session for each client id
+class BHSession:
+    def __init__(self, client_id, controls, screenshot_capacity = 1000, screenshot_history = None, ram_size = 0,
+                 pipeline = None, keep_raw_screenshots = False, replay = None):
+        self.client_id = client_id  # Given by the client in its URL path (http://127.0.0.1:1337/id), or by RESET id
+        # Learning
+        self.episodes = 0  # Number of COMPLETED episodes. Incremented by new_episode and exit_client
+        self.actions = 0   # Actions taken during the current episode (number of UPDATEs called)
+        # Emulator status
+        self.client_started_flag = False  # Did the client just call START? Access ONLY by client_started()
+        # Emulator Controls
+        self.restart = False  # Tells emu to restart. Set to False after value is requested
+        self.exit = False     # Tells client to exit.
+        self.save = ""        # Path to the current save file (from parent of BizHawk dir). Updated with load_save()
+        self.controls = dict(controls)  # Controls dict to be passed to emulator, or received from emulator if recording
+        # Client-Settable
+        self.data = dict()         # Stores {VAR: (DATATYPE, VAL)}. Utilized by SET and GET statements from clients
+        self.screenshots = ScreenshotStore(screenshot_capacity)  # Stores screenshots as numpy.ndarrays, by action
+        self.raw_screenshots = None  # Stores screenshots before the pipeline, by action, if kept
+        self.pipeline = None  # Turns screenshots into observations, stored in screenshots instead
+        if pipeline is not None:
+            if keep_raw_screenshots: self.raw_screenshots = ScreenshotStore(screenshot_capacity)
+            self.pipeline = ObservationPipeline(pipeline, self.raw_screenshots)
+            self.screenshots = ScreenshotStore(screenshot_capacity, window = max(4, self.pipeline.stack))
+        self.screenshot_history = None  # Stores every screenshot on disk, by (history_episode + episodes, action)
+        self.history_episode = 0  # Episode of screenshot_history the current run starts at. Moved past it by RESET
+        if screenshot_history is not None:
+            self.screenshot_history = ScreenshotHistory(screenshot_history)
+            self.history_episode = self.screenshot_history.next_episode
+        self.ram = np.zeros(ram_size, np.uint8)  # Emulator memory sent by RAM statements, indexed by address
+        self.recorder = None  # Records demonstrations in HUMAN mode. Set by the server
+        # Experience Replay
+        self.replay = replay  # Stores transitions of this client, recorded after each UPDATE. None if disabled
+        self.reward = 0.0  # Reward of the last action, set by update(). Recorded into replay, then reset
+        self.done = False  # Whether the last action ended the episode. Set by new_episode()
+        # Misc
+        self.guessed = False  # Last action was picked randomly?
+        self.action = None  # Index in the server's action_space of the controls chosen by use_action(). None if set directly
+        # Update Deadlines
+        self.update_future = None  # update() still running on a worker after missing its deadline, or None
+        self.sent_controls = None  # Controls sent instead of controls while update() is late, or None
+        self.missed_deadlines = 0  # UPDATEs answered with the previous controls, because update() was late
+        self.shared_client = 0  # Row of this client in the shared ring's answers. Set by the server
+        self.screenshot_future = None  # Screenshot being decoded by the server's decode_threads, or None
+
+
+# Gathers UPDATEs from many clients into batches, so the server's batch_update() is called once per batch
+# A batch is handled once it holds batch_size clients, or batch_window seconds after its first UPDATE
+# Every client's thread waits until its batch has been handled
+class UpdateBatcher:
+    def __init__(self, handle, batch_size, batch_window):
+        self.handle = handle              # Called with the list of sessions in a batch
+        self.batch_size = batch_size      # Clients that fill a batch
+        self.batch_window = batch_window  # Most seconds to wait for a batch to fill
+        self.condition = threading.Condition()
+        self.batch = UpdateBatcher.Batch()  # Batch being filled
+
+    # Sessions gathered in one batch
+    class Batch:
+        def __init__(self):
+            self.sessions = []
+            self.deadline = None  # When the batch is handled, even if not full
+            self.taken = False    # Whether a thread is handling the batch
+            self.done = False     # Whether the batch has been handled
+
+    # Adds a client's session to the next batch. Returns once that batch has been handled
+    def submit(self, session):
+        with self.condition:
+            batch = self.batch
+            batch.sessions.append(session)
+            if len(batch.sessions) == 1:
+                batch.deadline = time.monotonic() + self.batch_window
+
+            # Wait for the batch to fill, or for its deadline
+            while len(batch.sessions) < self.batch_size and not batch.taken:
+                remaining = batch.deadline - time.monotonic()
+                if remaining <= 0: break
+                self.condition.wait(remaining)
+            self.condition.notify_all()
+
+            # Is the batch ready, and no other thread handling it? Handle it in this thread
+            lead = not batch.taken
+            if lead:
+                batch.taken = True
+                self.batch = UpdateBatcher.Batch()
+            else:
+                while not batch.done:
+                    self.condition.wait()
+                return
 
-# Converts numpy.ndarray to grayscale
-def to_grayscale(img):
-    return 0.2989 * img[:, :, 0] + 0.5870 * img[:, :, 1] + 0.1140 * img[:, :, 2]
+        try:
+            self.handle(batch.sessions)
+        finally:
+            with self.condition:
+                batch.done = True
+                self.condition.notify_all()
+
+
+# Counters and latency histograms of the server's hot path, cheap enough to always keep
+# Latencies are counted in buckets by powers of two of microseconds, so percentiles are within a factor of 2
+# Stages are counted by their latencies, so handled messages are the count of "handle", screenshots of "decode", ...
+class ServerStats:
+    # Names of the counts of stages, also given per second: {name: stage}
+    RATES = {"messages": "handle", "screenshots": "decode", "updates": "update"}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = dict()  # {name: count}
+        self.timings = dict()   # {stage: [count, total seconds, [count of each bucket]]}
+
+    # Adds n to a counter
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # Records the latency of a stage, given the time.perf_counter() it started at
+    def record(self, stage, start):
+        elapsed = time.perf_counter() - start
+        bucket = int(elapsed * 1e6).bit_length()
+        with self.lock:
+            timing = self.timings.get(stage)
+            if timing is None: timing = self.timings[stage] = [0, 0.0, [0] * 64]
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2][bucket] += 1
+
+    # Returns the upper bound of the bucket holding the given percentile, in microseconds
+    @staticmethod
+    def percentile(timing, p):
+        target = p / 100 * timing[0]
+        seen = 0
+        for bucket, count in enumerate(timing[2]):
+            seen += count
+            if seen >= target: return 1 << bucket
+        return 1 << 63
+
+    # Returns every statistic, {name: value}. Counters are also given per second since the server started
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timings = {stage: [t[0], t[1], list(t[2])] for stage, t in self.timings.items()}
+        uptime = time.monotonic() - self.started
+
+        stats = {"uptime_sec": round(uptime, 3)}
+        for name, stage in ServerStats.RATES.items():
+            counters[name] = timings[stage][0] if stage in timings else 0
+        for name, count in sorted(counters.items()):
+            stats[name] = count
+            stats[name + "_per_sec"] = round(count / uptime, 3)
+        for stage, timing in sorted(timings.items()):
+            stats[stage + "_count"] = timing[0]
+            stats[stage + "_mean_us"] = round(timing[1] / timing[0] * 1e6, 1)
+            stats[stage + "_p50_us"] = ServerStats.percentile(timing, 50)
+            stats[stage + "_p99_us"] = ServerStats.percentile(timing, 99)
+        return stats
+
+    # Returns every statistic as plain text, a "name value" line each
+    def report(self):
+        return "".join("bhserver_{} {}\n".format(name, val) for name, val in self.snapshot().items())
+
+
+# Returns a property of BHServer that reads and writes an attribute of the current client's BHSession
+def session_attribute(name):
+    return property(
+        lambda self: getattr(self.session, name),
+        lambda self, val: setattr(self.session, name, val)
+    )
 
 
 class BHServer:
     BUFSIZE = 38500
 
+    # Per-client state, stored in the session of the client whose message is being handled (see BHSession)
+    episodes = session_attribute("episodes")
+    actions = session_attribute("actions")
+    client_started_flag = session_attribute("client_started_flag")
+    restart = session_attribute("restart")
+    exit = session_attribute("exit")
+    save = session_attribute("save")
+    controls = session_attribute("controls")
+    data = session_attribute("data")
+    screenshots = session_attribute("screenshots")
+    screenshot_history = session_attribute("screenshot_history")
+    history_episode = session_attribute("history_episode")
+    raw_screenshots = session_attribute("raw_screenshots")
+    pipeline = session_attribute("pipeline")
+    guessed = session_attribute("guessed")
+    action = session_attribute("action")
+    ram = session_attribute("ram")
+    replay = session_attribute("replay")
+    recorder = session_attribute("recorder")
+    reward = session_attribute("reward")
+    done = session_attribute("done")
+    sent_controls = session_attribute("sent_controls")
+    missed_deadlines = session_attribute("missed_deadlines")
+
     def __init__(
             self,
             # ---------------
@@ -77,15 +1848,78 @@ class BHServer:
             ip = "127.0.0.1",
             # Port to host server on
             port = 1337,
+            # Never start a GUI (matplotlib.pyplot). For servers without a display
+            headless = False,
+            # How connections are handled: "threads" (a thread per connection) or "asyncio" (one event loop)
+            transport = "threads",
+            # Most connections waiting to be accepted
+            backlog = 5,
+            # Port to serve plain-text statistics on (see ServerStats), to any connection. None to disable
+            metrics_port = None,
+            # Clients whose UPDATEs are gathered into one call of batch_update(). None calls update() per UPDATE
+            batch_size = None,
+            # Most seconds to wait for a batch to fill before calling batch_update()
+            batch_window = 0.005,
+            # Most seconds an UPDATE waits for update() on a worker, before replying with the previous controls. None to wait
+            update_deadline = None,
+            # Name of a shared memory block to publish observations to, answered by a trainer in another process. None to disable
+            shared_memory = None,
+            # Steps held at once by the shared ring. The oldest is overwritten once full
+            shared_capacity = 256,
+            # Most clients publishing to the shared ring
+            shared_clients = 64,
+            # Most seconds an UPDATE waits for a trainer's action, before keeping its controls. None to wait until close()
+            shared_timeout = 10.0,
             # -------------
             # Data Settings
             # -------------
-            # Not yet implemented
-            mode = "HUMAN",  # Used for recording human input to emulator
+            # "AI": update() chooses controls. "HUMAN": a person plays, and each UPDATE records a step to recording_path
+            mode = "AI",
+            # Directory (per client, like screenshot_history) of the demonstration dataset recorded in HUMAN mode
+            recording_path = None,
+            # Steps per compressed chunk of recordings
+            recording_chunk = 256,
+            # Threads compressing and writing recordings
+            recording_threads = 1,
+            # Threads decoding screenshot POSTs, which are answered before they're decoded. None decodes before answering
+            decode_threads = None,
             # Store screenshots as grayscale
             use_grayscale = False,
+            # Decodes screenshots: "matplotlib", "pillow" (faster, stores uint8 RGB), or a decoder function
+            screenshot_decoder = "matplotlib",
+            # Data type to store screenshots as: "float32" in [0, 1], "uint8" in [0, 255], or None to keep the decoder's
+            screenshot_dtype = None,
+            # Shrinks screenshots by this factor in both dimensions
+            screenshot_scale = 1,
+            # Steps turning each screenshot into the observation stored instead: [Crop(...), Grayscale(), Resize(84, 84), Stack(4)]
+            pipeline = None,
+            # Also store screenshots before the pipeline, in raw_screenshots
+            keep_raw_screenshots = False,
+            # Most screenshots stored at once. The oldest is dropped once full
+            screenshot_capacity = 1000,
+            # Path (without extension) to also store every screenshot on disk, by episode and action. None to disable
+            screenshot_history = None,
+            # Directory STEP statements may read frames from. Frames elsewhere are refused. By default, the directory of
+            # BHServer.py, where BHClient.lua saves them. None reads any path the client names: only for trusted clients
+            frame_directory = FRAME_DIRECTORY,
+            # Bytes of emulator memory held by ram, from address 0. Grows if a RAM statement reaches past it
+            ram_size = 0,
+            # Structured numpy dtype giving the offset and type of fields in ram, read through ram_fields. None to disable
+            ram_dtype = None,
+            # Frames kept per client by replay, a ReplayBuffer recording each UPDATE. None to disable
+            replay_capacity = None,
+            # Frames stacked into each observation sampled from replay
+            replay_history = 4,
+            # Sample replay transitions by priority instead of uniformly
+            replay_prioritized = False,
+            # Directory to save checkpoints to every checkpoint_episodes episodes. See checkpoint()
+            checkpoint_path = None,
+            # Episodes between checkpoints saved to checkpoint_path. None to disable
+            checkpoint_episodes = None,
             # System being emulated. Sets initial controls dictionary
             system = "N64",
+            # Discrete actions, as controls and the values each can take: [(name, [values]), ...]. Makes action_space
+            actions = None,
             # ---------------
             # Client Settings
             # ---------------
@@ -99,7 +1933,7 @@ class BHServer:
             speed = 6399,
             # ROM game file
             rom = "",
-            # Dictionary of save states and their probabilities  {"path": prob}
+            # Dictionary of save states and their weights {"path": weight}, or a SaveSampler
             saves = dict(),
     ):
 
@@ -110,17 +1944,62 @@ class BHServer:
         self.ip = ip        # Address to host server on
         self.port = port    # Port to host server on
         self.socket = None  # Server socket
+        self.transport = transport  # How connections are handled: "threads" or "asyncio"
+        self.backlog = backlog  # Most connections waiting to be accepted
+        self.headless = headless  # Never start a GUI
+        self.metrics_port = metrics_port  # Port to serve plain-text statistics on
+        self.stats = ServerStats()  # Counters and latencies of the hot path. Read by GET stats
         # Misc
-        self.logging = False       # Print auxiliary messages to console for debugging
-        self.close_client = False  # Closes client after message has been received
-        # Learning
-        self.episodes = 0  # Number of COMPLETED episodes. Incremented by new_episode and exit_client
-        self.actions = 0   # Actions taken during the current episode (number of UPDATEs called)
-        # Emulator status
-        self.client_started_flag = False  # Did the client just call START? Access ONLY by client_started()
+        self.logging = False  # Print auxiliary messages to console for debugging
+        self.local = threading.local()  # State of the connection handled by the current thread
+        # Sessions
+        self.sessions = dict()  # Stores {CLIENT_ID: BHSession}. Clients without an id share the session of id ""
+        self.sessions_lock = threading.Lock()  # Held while creating a session
+        self.update_lock = threading.Lock()  # Held during update(), so it's called by one client at a time
+        self.batcher = None  # Gathers UPDATEs into batches for batch_update(). Set by batch_size
+        if batch_size is not None:
+            self.batcher = UpdateBatcher(self.call_batch_update, batch_size, batch_window)
+        self.update_deadline = update_deadline  # Most seconds an UPDATE waits for update(). None to wait
+        self.update_workers = None  # Run update() (or batches) while UPDATEs wait by their deadline. Set by update_deadline
+        if update_deadline is not None:
+            # Clients wait on each other's batches, and on trainers in shared_memory, so each needs its own worker
+            workers = batch_size or (shared_clients if shared_memory is not None else 1)
+            self.update_workers = concurrent.futures.ThreadPoolExecutor(workers, "update")
+        self.deadline_lock = threading.Lock()  # Held while a late update() and the UPDATEs waiting on it trade controls
+        self.shared_memory = shared_memory  # Name of the shared ring observations are published to. None to disable
+        self.shared_capacity = shared_capacity  # Steps held at once by the shared ring
+        self.shared_clients = shared_clients  # Most clients publishing to the shared ring
+        self.shared_timeout = shared_timeout  # Most seconds to wait for a trainer's action. None to wait until close()
+        self.shared = None  # SharedObservationRing of every client. Created by the first observation published
+        self.closed = False  # Set by close(). No shared ring is created once set
+        self.observations = None  # Latest screenshot of each client in a batch, reused by every batch
+        self.screenshot_capacity = screenshot_capacity  # Most screenshots stored at once, per session
+        self.screenshot_history_path = screenshot_history  # Path of screenshot history, per session
+        self.frame_directory = None if frame_directory is None else os.path.realpath(frame_directory)  # Of STEP frames
+        self.ram_dtype = None if ram_dtype is None else np.dtype(ram_dtype)  # Fields of ram, read through ram_fields
+        self.ram_size = ram_size if ram_dtype is None else max(ram_size, self.ram_dtype.itemsize)  # Bytes of ram, per session
         # Data Management
         self.use_grayscale = use_grayscale  # Store screenshots as grayscale
-        self.saves = saves  # Dictionary of save states and their probabilities {"path": prob}
+        self.screenshot_decoder = DECODERS.get(screenshot_decoder, screenshot_decoder)  # Decodes screenshots
+        self.decode_pool = None  # Decodes screenshot POSTs after they're answered. Set by decode_threads
+        if decode_threads is not None:
+            self.decode_pool = concurrent.futures.ThreadPoolExecutor(decode_threads, "decode")
+        self.screenshot_dtype = screenshot_dtype  # Data type to store screenshots as. None keeps the decoder's
+        self.screenshot_scale = screenshot_scale  # Shrinks screenshots by this factor
+        self.pipeline_steps = pipeline  # Steps turning screenshots into observations, run per session. None to disable
+        self.keep_raw_screenshots = keep_raw_screenshots  # Also store screenshots before the pipeline
+        self.replay_capacity = replay_capacity  # Frames kept per client by replay. None to disable
+        self.replay_history = replay_history  # Frames stacked into each observation sampled from replay
+        self.replay_prioritized = replay_prioritized  # Sample replay transitions by priority
+        self.mode = mode  # "AI" (update() chooses controls) or "HUMAN" (a person plays, and steps are recorded)
+        self.recording_path = recording_path  # Directory of the demonstration dataset, per session
+        self.recording_chunk = recording_chunk  # Steps per compressed chunk of recordings
+        self.recording_threads = recording_threads  # Threads compressing and writing recordings
+        self.checkpoint_path = checkpoint_path  # Directory to save checkpoints to every checkpoint_episodes episodes
+        self.checkpoint_episodes = checkpoint_episodes  # Episodes between checkpoints. None to disable
+        self.checkpoint_thread = None  # Writes the last checkpoint to disk
+        self.checkpoint_marks = dict()  # {(path, file): (frames taken, layout)} of stores at the last checkpoint
+        self.saves = saves if isinstance(saves, SaveSampler) else SaveSampler(saves)  # Save states, by weight {"path": weight}
         # ---------------------------
         # Client-Accessible Variables
         # ---------------------------
@@ -131,20 +2010,79 @@ class BHServer:
         self.rom = rom      # ROM game file
         self.update_interval = update_interval  # Frames to wait before emulator sends/receives data
         # Emulator Controls
-        self.restart = False  # Tells emu to restart. Set to False after value is requested
-        self.exit = False     # Tells client to exit.
-        self.save = ""        # Path to the current save file (from parent of BizHawk dir). Updated with load_save()
-        self.controls = {}    # Controls dict to be passed to emulator, or received from emulator if recording
-        # Client-Settable
-        self.data = dict()         # Stores {VAR: (DATATYPE, VAL)}. Utilized by SET and GET statements from clients
-        self.screenshots = dict()  # Stores screenshots as numpy.ndarrays
-        # Misc
-        self.guessed = False  # Last action was picked randomly?
-
-        self.load_save()  # Set initial save
+        self.initial_controls = {}  # Controls of every new session. Set by system
+        self.action_space = None  # Every combination of actions, chosen by index with use_action(). Set by actions
+        # Emulator controls, client-settable data and screenshots are kept per client. See BHSession
+        # ----------------
+        # Message Handling
+        # ----------------
+        # Statement handlers, by verb. Called with the rest of the statement and the client socket
+        # HTTP POSTs are not statements. They are read by handle_post(), and their bodies may hold statements
+        self.statement_handlers = {
+            "RESET": self.handle_reset,
+            "UPDATE": self.handle_update,
+            "GET": self.handle_get,
+            "SET": self.handle_set,
+            "FRAME": self.handle_frame,
+            "STEP": self.handle_step,
+            "APPEND": self.handle_append,
+            "RAM": self.handle_ram,
+            "JOYPAD": self.handle_joypad,
+        }
+        # GET handlers for variables outside self.data, by name. Called with the rest of the statement
+        self.get_handlers = {
+            # Dictionaries
+            "screenshots":     self.get_screenshot,
+            "controls":        self.get_controls,
+            # Strings
+            "rom":             lambda idx: self.rom,
+            "save":            lambda idx: self.save,
+            # Integers
+            "update_interval": lambda idx: str(self.update_interval),
+            "speed":           lambda idx: str(self.speed),
+            "frameskip":       lambda idx: str(self.frameskip),
+            # Booleans
+            "exit":            self.get_exit,
+            "restart":         self.get_restart,
+            "sound":           lambda idx: str(self.sound),
+            "guessed":         lambda idx: str(self.guessed),
+            # Modes
+            "mode":            lambda idx: self.mode,
+            # Statistics
+            "stats":           lambda idx: dict_as_str(self.stats.snapshot()),
+        }
+        # SET handlers for variables outside self.data, by name. Called with the name and the rest of the statement
+        self.set_handlers = {
+            var: self.set_read_only for var in (
+                "screenshots", "controls",                            # Dictionaries
+                "rom", "save",                                        # Strings
+                "update_interval", "actions", "speed", "frameskip",   # Integers
+                "exit", "sound", "guessed",                           # Booleans
+                "mode",                                               # Modes
+                "stats",                                              # Statistics
+            )
+        }
+        self.set_handlers["restart"] = self.set_restart
+
+        if mode not in ("AI", "HUMAN"):
+            raise ValueError("Unrecognized mode " + str(mode))
+        if mode == "HUMAN" and recording_path is None:
+            raise ValueError("mode \"HUMAN\" requires a recording_path to record to")
+        if transport not in ("threads", "asyncio"):
+            raise ValueError("Unrecognized transport " + str(transport))
+        if batch_size is not None and transport != "threads":
+            raise ValueError("batch_size requires transport \"threads\", since clients wait for each other")
+        if shared_memory is not None and actions is None:
+            raise ValueError("shared_memory requires actions, since trainers answer with an index into action_space")
+        if shared_memory is not None and batch_size is not None:
+            raise ValueError("shared_memory can't be used with batch_size, since trainers batch steps themselves")
+        if not callable(self.screenshot_decoder):
+            raise ValueError("Unrecognized screenshot_decoder " + str(screenshot_decoder))
+        if self.screenshot_decoder is decode_png_pillow and importlib.util.find_spec("PIL") is None:
+            raise ImportError("screenshot_decoder \"pillow\" requires Pillow to be installed")
 
         if system == "N64":
-            self.controls = {
+            self.initial_controls = {
                 "P1 A": False,
                 "P1 A Down": False,
                 "P1 A Left": False,
@@ -170,7 +2108,7 @@ class BHServer:
             }
 
         elif system == "NES":
-            self.controls = {
+            self.initial_controls = {
                 "P1 A": False,
                 "P1 B": False,
                 "P1 Down": False,
@@ -183,6 +2121,11 @@ class BHServer:
                 "Reset": False
             }
 
+        if actions is not None:
+            self.action_space = ActionSpace(actions, self.initial_controls)
+
+        self.default_session = self.get_session("")  # Session of clients without an id. Sets initial save
+
     #
     # Socket / Server Status Functions
     #
@@ -191,15 +2134,91 @@ class BHServer:
     def log(self, msg):
         if self.logging: print(msg)
 
+    #
+    # Session Functions
+    #
+
+    # Session of the client whose message is being handled by the current thread
+    @property
+    def session(self):
+        session = getattr(self.local, "session", None)
+        return self.default_session if session is None else session
+
+    @session.setter
+    def session(self, session):
+        self.local.session = session
+
+    # Whether to close the current thread's connection after the message being handled
+    @property
+    def close_client(self):
+        return getattr(self.local, "close_client", False)
+
+    @close_client.setter
+    def close_client(self, close_client):
+        self.local.close_client = close_client
+
+    # Handles the current thread's messages for the given session, within a with statement
+    @contextmanager
+    def using_session(self, session):
+        current = getattr(self.local, "session", None)
+        self.session = session
+        try:
+            yield session
+        finally:
+            self.local.session = current
+
+    # Returns a new ReplayBuffer for a session, or None if replay is disabled
+    def make_replay(self):
+        if self.replay_capacity is None: return None
+        return ReplayBuffer(self.replay_capacity, self.replay_history, self.replay_prioritized)
+
+    # Returns the session of a client id, creating it if it doesn't exist
+    def get_session(self, client_id):
+        session = self.sessions.get(client_id)
+        if session is not None: return session
+
+        with self.sessions_lock:
+            session = self.sessions.get(client_id)
+            if session is not None: return session
+
+            history = self.screenshot_history_path
+            if history is not None: history = client_path(history, client_id)
+            session = BHSession(
+                client_id, self.initial_controls, self.screenshot_capacity, history, self.ram_size,
+                self.pipeline_steps, self.keep_raw_screenshots, self.make_replay()
+            )
+
+            if self.mode == "HUMAN":
+                path = client_path(self.recording_path, client_id)
+                session.recorder = DemonstrationWriter(
+                    path, self.initial_controls, self.recording_chunk, threads = self.recording_threads
+                )
+
+            # Set initial save
+            with self.using_session(session):
+                self.load_save()
+
+            session.shared_client = len(self.sessions)
+            self.sessions[client_id] = session
+            return session
+
+    # Handles the current thread's next messages for a client, given the request line of an HTTP POST (POST /id HTTP/1.1)
+    def route(self, msg):
+        path = msg[:msg.find(b"\r\n")].split(b" ")
+        client_id = unquote_plus(path[1].decode("utf-8")).strip("/") if len(path) > 1 else ""
+        self.session = self.get_session(client_id)
+
     # Connects the client and handles its message(s)
     def handle_client_connection(self, client_socket):
+        self.session = self.default_session
         try:
             while True:
                 msg = client_socket.recv(self.BUFSIZE)
                 if not msg: break
+                self.stats.count("bytes_in", len(msg))
                 self.log('Received {}'.format(msg))
                 self.close_client = False
-                self.handle_msg(msg.decode("utf-8"), client_socket)
+                self.handle_msg(msg, client_socket)
                 if self.close_client: break
         finally:
             self.log("Client disconnected.")
@@ -209,10 +2228,11 @@ class BHServer:
     def run(self):
         self.socket = s.socket(s.AF_INET, s.SOCK_STREAM)
         self.socket.bind((self.ip, self.port))
-        self.socket.listen(5)
+        self.socket.listen(self.backlog)
         self.log("Listening on {}:{}.".format(self.ip, self.port))
         while True:
             client_socket, address = self.socket.accept()
+            self.stats.count("connections")
             self.log('Accepted connection from {}:{}'.format(address[0], address[1]))
 
             client_handler = threading.Thread(
@@ -221,11 +2241,156 @@ class BHServer:
             )
             client_handler.start()
 
+    # Connects the client and handles its message(s) on the event loop (transport = "asyncio")
+    # Messages are handled in the event loop's thread, so update() is never called by two clients at once
+    async def handle_client_stream(self, reader, writer):
+        session = self.default_session  # Session of this connection. Other connections change self.session
+        self.stats.count("connections")
+
+        # Sends a response, once the event loop gets to it
+        def write(response):
+            data = response.encode("utf-8")
+            self.stats.count("bytes_out", len(data))
+            writer.write(data)
+
+        try:
+            while True:
+                msg = await reader.read(self.BUFSIZE)
+                if not msg: break
+                self.log('Received {}'.format(msg))
+                start = time.perf_counter()
+
+                # Handle length-prefixed messages, over a connection that stays open (comm.socketServerSend)
+                if msg[:1].isdigit():
+                    while msg:
+                        # Receive the rest of the length and the message, if they were split
+                        if msg.find(b" ") == -1:
+                            msg += await reader.readuntil(b" ")
+                        space = msg.find(b" ")
+                        end = space + 1 + int(msg[:space])
+                        if len(msg) < end:
+                            msg += await reader.readexactly(end - len(msg))
+
+                        self.session = session
+                        self.stats.count("bytes_in", end)
+                        write(self.handle_framed(msg[:end], None))
+                        session = self.session  # RESET id may have switched sessions
+                        msg = msg[end:]
+                    self.stats.record("handle", start)
+                    await writer.drain()
+                    continue
+
+                # Handle a plain message of statements
+                if not msg.startswith(b"POST"):
+                    self.session = session
+                    self.stats.count("bytes_in", len(msg))
+                    write("; ".join(self.handle_statements(msg.decode("utf-8"), None)))
+                    session = self.session  # RESET id may have switched sessions
+                    self.stats.record("handle", start)
+                    await writer.drain()
+                    continue
+
+                # Receive the rest of the headers, if they were split
+                if msg.find(HEADER_END) == -1:
+                    msg += await reader.readuntil(HEADER_END)
+                head_end = msg.find(HEADER_END)
+                cont_len = self.content_length(msg, head_end)
+                body = msg[head_end + len(HEADER_END):head_end + len(HEADER_END) + cont_len]
+
+                # Should we expect the body in a new message directly after this one?
+                if not body and cont_len > 0:
+                    # Respond, to get the next message
+                    write(HTTP_OK)
+                    await writer.drain()
+
+                # Receive the rest of the body without blocking other clients
+                if len(body) < cont_len:
+                    body += await reader.readexactly(cont_len - len(body))
+
+                start = time.perf_counter()
+                self.route(msg)
+                self.stats.count("bytes_in", head_end + len(HEADER_END) + len(body))
+                write(self.handle_post_body(body, None))
+                self.stats.record("handle", start)
+                await writer.drain()
+                break  # BizHawk expects connection to close after each Lua method call
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("ERROR: Client disconnected before sending the whole message")
+        finally:
+            self.log("Client disconnected.")
+            writer.close()
+
+    # Checks for client connections on an event loop (transport = "asyncio")
+    async def run_async(self):
+        server = await asyncio.start_server(
+            self.handle_client_stream,
+            self.ip,
+            self.port,
+            backlog = self.backlog,
+            limit = self.BUFSIZE
+        )
+        self.socket = server.sockets[0]
+        self.log("Listening on {}:{}.".format(self.ip, self.port))
+        async with server:
+            await server.serve_forever()
+
+    # Serves plain-text statistics on metrics_port, answering every connection (curl, a browser, a metrics scraper)
+    def serve_metrics(self):
+        metrics_socket = s.socket(s.AF_INET, s.SOCK_STREAM)
+        metrics_socket.bind((self.ip, self.metrics_port))
+        metrics_socket.listen(self.backlog)
+        while True:
+            client_socket, address = metrics_socket.accept()
+            with client_socket:
+                # Every request gets the statistics, so it isn't read. Wait briefly for it, so it isn't reset
+                client_socket.settimeout(1)
+                try:
+                    client_socket.recv(self.BUFSIZE)
+                except OSError:
+                    pass
+
+                report = self.stats.report().encode("utf-8")
+                client_socket.sendall(
+                    "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+                        len(report)).encode("utf-8") + report)
+
     # Starts the server, listens for clients
     def start(self):
-        client_handler = threading.Thread(target = self.run)
+        if self.transport == "asyncio":
+            client_handler = threading.Thread(target = asyncio.run, args = (self.run_async(),))
+        else:
+            client_handler = threading.Thread(target = self.run)
         client_handler.start()
 
+        if self.metrics_port is not None:
+            threading.Thread(target = self.serve_metrics).start()
+
+    # Calls batch_update() for a batch of sessions, then gives each client its row of controls
+    def call_batch_update(self, sessions):
+        with self.update_lock:
+            # Stack the latest observation of every client, into an array reused by every batch
+            # Stacked while holding the lock, so the next batch can't overwrite it while batch_update() reads it
+            latest = [self.observation_of(session) for session in sessions if session.screenshots.count]
+            observations = None
+            if len(latest) == len(sessions):
+                shape = (self.batcher.batch_size,) + latest[0].shape
+                if self.observations is None or self.observations.shape != shape or self.observations.dtype != latest[0].dtype:
+                    self.observations = np.empty(shape, latest[0].dtype)
+                observations = np.stack(latest, out = self.observations[:len(latest)])
+
+            start = time.perf_counter()
+            controls = self.batch_update(observations, sessions)
+            self.stats.record("batch_update", start)
+
+        # Rows are controls dicts, or indices into action_space
+        if controls is not None:
+            for session, row in zip(sessions, controls):
+                if isinstance(row, dict):
+                    session.controls.update(row)
+                else:
+                    with self.using_session(session):
+                        self.use_action(row)
+
     #
     # Client/Data Functions
     #
@@ -235,27 +2400,73 @@ class BHServer:
     def update(self):
         print("ERROR: Update called, but not implemented")
 
+    # Called with a batch of UPDATEs from many clients, when the server is given batch_size. Replace this with your code.
+    # observations stacks the latest screenshot of each client (None if a client has no screenshot), in the order of
+    # sessions. Return a list of controls dicts, one per client, or None if controls were set directly.
+    # By default, calls update() for each client.
+    def batch_update(self, observations, sessions):
+        update = self.update
+        for session in sessions:
+            with self.using_session(session):
+                if update.__code__.co_argcount > 1: update(session)
+                else:                               update()
+
+    # Chooses controls by the index of an action in action_space
+    # Until the next UPDATE, GET controls sends the action's prebuilt response, unless controls are also edited directly
+    def use_action(self, idx):
+        self.action = int(idx)
+        self.controls.update(self.action_space[self.action])
+
+    # Latest observation of the current client: the last Stack(n) screenshots, or the last screenshot without a Stack
+    # A view, not a copy, once n have been stored
+    @property
+    def observation(self):
+        return self.observation_of(self.session)
+
+    # Returns the latest observation of a session (see observation)
+    @staticmethod
+    def observation_of(session):
+        if session.pipeline is None or session.pipeline.stack == 1: return session.screenshots.last(1)[0]
+        return session.pipeline.stacked(session.screenshots)
+
+    # Fields of ram, viewed through ram_dtype. Reads like a dictionary by field name. A view, not a copy
+    @property
+    def ram_fields(self):
+        return self.ram[:self.ram_dtype.itemsize].view(self.ram_dtype)[0]
+
     # Returns whether the client just called START. If True is returned, will return False until client starts again
     def client_started(self):
         started = self.client_started_flag
         self.client_started_flag = False
         return started
 
-    # Starts a new episode of learning
-    def new_episode(self):
+    # Starts a new episode of learning. The result of the episode that ended (such as its return) is recorded for its save
+    def new_episode(self, result = 0.0):
+        self.saves.record(self.save, result)
         # NOTE: load_save() should also be called before update() is finished,
         self.load_save()  # TODO TODO TODO
         self.restart = True  # Tell the emulator to restart
+        self.done = True  # End the episode in replay
         self.actions = 0
         self.episodes = self.episodes + 1
+        if self.checkpoint_episodes and self.episodes % self.checkpoint_episodes == 0:
+            self.checkpoint(self.checkpoint_path)
 
     # Cleans the server to resume learning
     # The server will not have to restart every time the client restarts if client calls "RESET" upon starting
     def reset_data(self):
         self.actions = 0
         self.episodes = 0
-        self.screenshots = dict()
+        if self.screenshot_history is not None:  # Episodes restart from 0, so the history continues after the last run
+            self.history_episode = self.screenshot_history.next_episode
+        self.screenshots.clear()
+        if self.raw_screenshots is not None: self.raw_screenshots.clear()
         self.data = dict()
+        self.action = None
+        self.ram.fill(0)
+        if self.replay is not None: self.replay.end_episode()
+        self.reward = 0.0
+        self.done = False
         self.client_started_flag = True
         self.log("Initialized data to defaults")
 
@@ -263,32 +2474,242 @@ class BHServer:
     def exit_client(self):
         self.episodes = self.episodes + 1  # Mark another completed episode
         self.exit = True
+        if self.recorder is not None: self.recorder.flush()
 
     # Loads a save state probabilistically using the self.saves, stores in self.save for client to read.
     def load_save(self):
-        self.save = np.random.choice(
-            a = list(self.saves.keys()),
-            size = 1,
-            # Convert values into probabilities if not already
-            p = list(v / sum(self.saves.values()) for v in self.saves.values())
-        )[0]
+        self.save = self.saves.sample()
 
     #
     # Data Exportation Functions
     #
 
-    # Saves a range of screenshots to disk from screenshots dictionary
+    # Saves a range of screenshots to disk from screenshots
     def save_screenshots(self, start, end, name):
+        import matplotlib.image as mpimg  # Saves without pyplot, so no GUI backend is started
         for idx in range(start, end + 1):
-            plt.imsave(name + str(idx) + ".png", self.screenshots[idx])
+            mpimg.imsave(name + str(idx) + ".png", self.screenshots[idx])
 
     # Previews an image of the screenshot at index idx
     # NOTE: Must be called from main thread, NOT from update()
     def show_screenshot(self, idx):
+        if self.headless:
+            print("ERROR: Cannot show screenshots in headless mode")
+            return
+
+        import matplotlib.pyplot as plt
         scrot = self.screenshots[idx]
         plt.imshow(scrot)
         plt.show()
 
+    #
+    # Checkpoints
+    #
+    # A checkpoint is a directory holding checkpoint.json, a small header of every session's state, and raw blocks of
+    # bytes per session: sessionN.screenshots, sessionN.raw_screenshots and sessionN.replay hold every slot of a store,
+    # and sessionN.arrays every smaller array (ram, INT[]/BOOL[] data, replay actions, ...) back to back
+    # Slots are only written again once changed since the last checkpoint to the same path
+    #
+
+    # Saves the learning state of every session to a checkpoint directory. Changed data is copied right away, and
+    # written to disk by a background thread, so clients aren't kept waiting. Given wait, returns once written
+    def checkpoint(self, path, wait = False):
+        snapshot = self.checkpoint_snapshot(path)
+        if self.checkpoint_thread is not None: self.checkpoint_thread.join()
+        self.checkpoint_thread = threading.Thread(target = self.write_checkpoint, args = (path,) + snapshot)
+        self.checkpoint_thread.start()
+        if wait: self.checkpoint_thread.join()
+
+    # Copies what a checkpoint writes, so clients can keep changing sessions while it's written. Returns (header, rings, arrays):
+    # rings holds (file, size, slots, frames) of slots to write in place, arrays holds (file, [arrays]) to rewrite
+    def checkpoint_snapshot(self, path):
+        header = {
+            "version": CHECKPOINT_VERSION,
+            "saves": dict(self.saves.items()),
+            "save_stats": {path: list(self.saves.stats(path).values()) for path in self.saves},
+            "sessions": [],
+        }
+        rings = []
+        arrays = []
+
+        for i, (client_id, session) in enumerate(list(self.sessions.items())):
+            self.wait_screenshot(session)
+            prefix = "session" + str(i)
+            blocks = {"arrays": [], "size": 0}
+            state = {
+                "id": client_id,
+                "prefix": prefix,
+                "episodes": session.episodes,
+                "history_episode": session.history_episode,
+                "actions": session.actions,
+                "save": session.save,
+                "controls": dict(session.controls),
+                "guessed": session.guessed,
+                "action": session.action,
+                "reward": session.reward,
+                "done": session.done,
+                "ram": add_block(blocks, session.ram),
+                "data": {
+                    var: [data_type, add_block(blocks, val.values) if isinstance(val, DataArray) else copy_value(val)]
+                    for var, (data_type, val) in list(session.data.items())
+                },
+            }
+
+            for name in ("screenshots", "raw_screenshots"):
+                store = getattr(session, name)
+                state[name] = None
+                if store is None or store.frames is None: continue
+                state[name] = {
+                    "capacity": store.capacity,
+                    "window": store.window,
+                    "shape": list(store.shape),
+                    "dtype": store.dtype.str,
+                    "head": store.head,
+                    "count": store.count,
+                    "advances": store.advances,
+                    "slots": list(store.slots.items()),
+                    "slot_keys": list(store.slot_keys),
+                }
+                rings.append(self.ring_snapshot(path, prefix + "." + name, store, store.advances))
+
+            replay = session.replay
+            state["replay"] = None
+            if replay is not None and replay.frames is not None:
+                with replay.lock:
+                    state["replay"] = {
+                        "capacity": replay.capacity,
+                        "history": replay.history,
+                        "prioritized": replay.tree is not None,
+                        "alpha": replay.alpha,
+                        "beta": replay.beta,
+                        "head": replay.head,
+                        "count": replay.count,
+                        "pending": replay.pending,
+                        "episode_start": replay.episode_start,
+                        "added": replay.added,
+                        "frame_shape": list(replay.frames.shape[1:]),
+                        "actions": add_block(blocks, replay.actions),
+                        "rewards": add_block(blocks, replay.rewards),
+                        "dones": add_block(blocks, replay.dones),
+                        "starts": add_block(blocks, replay.starts),
+                        "valid": add_block(blocks, replay.valid),
+                        "tree": None if replay.tree is None else add_block(blocks, replay.tree.tree),
+                        "max_priority": None if replay.tree is None else replay.tree.max_priority,
+                    }
+                    rings.append(self.ring_snapshot(path, prefix + ".replay", replay, replay.added))
+
+            arrays.append((prefix + ".arrays", blocks["arrays"]))
+            header["sessions"].append(state)
+
+        return header, rings, arrays
+
+    # Returns (file, size, slots, frames) of the slots of a store (ScreenshotStore or ReplayBuffer) to write to file,
+    # given how many frames the store has ever taken. Every slot is written the first time, or if its layout changed
+    def ring_snapshot(self, path, file, store, changes):
+        frames = store.frames[:store.capacity]
+        layout = (store.capacity, frames.shape[1:], frames.dtype.str)
+        mark = self.checkpoint_marks.get((path, file))
+        if mark is None or mark[1] != layout or not os.path.exists(os.path.join(path, file)):
+            slots = store.recent_slots(store.count)
+        else:
+            slots = store.recent_slots(changes - mark[0] + 1)
+        self.checkpoint_marks[(path, file)] = (changes, layout)
+        return file, frames.nbytes, slots, frames[slots]
+
+    # Writes a snapshot made by checkpoint_snapshot(). The header is replaced last, so it never describes missing data
+    def write_checkpoint(self, path, header, rings, arrays):
+        start = time.perf_counter()
+        os.makedirs(path, exist_ok = True)
+
+        for file, size, slots, frames in rings:
+            slot_bytes = frames[0].nbytes if len(frames) else 0
+            with open(os.path.join(path, file), "r+b" if os.path.exists(os.path.join(path, file)) else "w+b") as f:
+                f.truncate(size)
+                for slot, frame in zip(slots, frames):
+                    f.seek(int(slot) * slot_bytes)
+                    f.write(memoryview(frame))
+
+        for file, blocks in arrays:
+            with open(os.path.join(path, file + ".tmp"), "wb") as f:
+                for block in blocks: f.write(memoryview(block))
+            os.replace(os.path.join(path, file + ".tmp"), os.path.join(path, file))
+
+        with open(os.path.join(path, CHECKPOINT_HEADER + ".tmp"), "w") as f:
+            json.dump(header, f)
+        os.replace(os.path.join(path, CHECKPOINT_HEADER + ".tmp"), os.path.join(path, CHECKPOINT_HEADER))
+        self.stats.record("checkpoint", start)
+
+    # Restores the learning state of every session from a checkpoint directory. Stored screenshots and replay frames
+    # are read straight into their stores, without decoding
+    def restore(self, path):
+        if self.checkpoint_thread is not None: self.checkpoint_thread.join()
+        with open(os.path.join(path, CHECKPOINT_HEADER)) as f:
+            header = json.load(f)
+        if header["version"] != CHECKPOINT_VERSION:
+            raise ValueError("Unsupported checkpoint version " + str(header["version"]))
+        self.checkpoint_marks.clear()  # Stores are replaced, so the next checkpoint writes them in full
+
+        self.saves = SaveSampler(header["saves"])
+        for save, (episodes, mean_result, last_result) in header["save_stats"].items():
+            idx = self.saves.indices[save]
+            self.saves.episodes[idx] = episodes
+            self.saves.results[idx] = mean_result * episodes
+            self.saves.last[idx] = last_result
+        for state in header["sessions"]:
+            session = self.get_session(state["id"])
+            prefix = os.path.join(path, state["prefix"])
+            with open(prefix + ".arrays", "rb") as f:
+                raw = f.read()
+
+            session.episodes = state["episodes"]
+            if session.screenshot_history is not None:  # Continue past episodes stored since the checkpoint, if any
+                session.history_episode = max(
+                    state["history_episode"], session.screenshot_history.next_episode - session.episodes
+                )
+            session.actions = state["actions"]
+            session.save = state["save"]
+            session.controls = state["controls"]
+            session.guessed = state["guessed"]
+            session.action = state["action"]
+            session.reward = state["reward"]
+            session.done = state["done"]
+            session.ram = read_block(raw, state["ram"])
+            session.data = dict()
+            for var, (data_type, val) in state["data"].items():
+                if data_type.endswith("[]") and data_type[:-2] in DATA_DTYPES:  # INT[] and BOOL[] are kept in blocks
+                    val = DataArray(read_block(raw, val))
+                session.data[var] = (data_type, val)
+
+            for name in ("screenshots", "raw_screenshots"):
+                ring = state[name]
+                if ring is None: continue
+                store = ScreenshotStore(ring["capacity"], ring["shape"], ring["dtype"], ring["window"])
+                read_ring(prefix + "." + name, store.frames[:store.capacity])
+                store.frames[store.capacity:] = store.frames[:store.window - 1]
+                store.head = ring["head"]
+                store.count = ring["count"]
+                store.advances = ring["advances"]
+                store.slots = {key: slot for key, slot in ring["slots"]}
+                store.slot_keys = ring["slot_keys"]
+                setattr(session, name, store)
+                if session.pipeline is not None and name == "raw_screenshots": session.pipeline.raw_screenshots = store
+
+            ring = state["replay"]
+            if ring is not None:
+                replay = ReplayBuffer(ring["capacity"], ring["history"], ring["prioritized"], ring["alpha"], ring["beta"])
+                replay.frames = np.empty([ring["capacity"]] + ring["frame_shape"], np.uint8)
+                read_ring(prefix + ".replay", replay.frames)
+                for name in ("actions", "rewards", "dones", "starts"):
+                    setattr(replay, name, read_block(raw, ring[name]))
+                for name in ("head", "count", "pending", "episode_start", "added"):
+                    setattr(replay, name, ring[name])
+                replay.valid = read_block(raw, ring["valid"])
+                replay.complete = int(replay.valid.sum())
+                if replay.tree is not None:
+                    replay.tree.tree = read_block(raw, ring["tree"])
+                    replay.tree.max_priority = ring["max_priority"]
+                session.replay = replay
+
     #
     # Message Reading Functions
     #
@@ -300,6 +2721,8 @@ class BHServer:
         # * A msg can begin with "UPDATE", "RESET", "GET", "SET", "POST".
         # * Every msg can hold multiple statements separated by '; ' FIXME
         # * An UPDATE will call self.update(). This is useful for when the emu is ready to receive new controls, or needs to check whether or not to reset
+        # * A msg beginning with a digit is length-prefixed ("LENGTH MESSAGE"), sent by comm.socketServerSend() over a
+        #   connection that stays open. Its response is prefixed the same way
         # * A POST is simply an HTTP POST request
         #   It is utilized by two BizHawk lua methods:
         #   -comm.httpPost(), which sends a POST-formatted message, where we put all statements at the end (after "payload=")
@@ -317,295 +2740,665 @@ class BHServer:
         #   A list must be initialized with SET NAME TYPE[] [ELEMENTS]
         #   A list element can be set using SET NAME IDX VAL. You can only set an element at an existing position, or append an element by using the index equal to the list size
 
+        # msg arrives as bytes. An HTTP POST stays in bytes, since its body may be a large screenshot
+        if isinstance(msg, str): msg = msg.encode("utf-8")
+        start = time.perf_counter()
+
+        if msg.startswith(b"POST"):
+            self.route(msg)
+            response = self.handle_post(msg, client_socket)
+        elif msg[:1].isdigit():
+            # A length-prefixed message, over a connection that stays open (comm.socketServerSend)
+            response = self.handle_framed(msg, client_socket)
+        else:
+            # Send back the responses of every statement, separated by '; '
+            response = "; ".join(self.handle_statements(msg.decode("utf-8"), client_socket))
+
+        self.stats.record("handle", start)
+
+        start = time.perf_counter()
+        data = response.encode("utf-8")
+        client_socket.send(data)
+        self.stats.record("send", start)
+        self.stats.count("bytes_out", len(data))
+
+    # Handles every statement inside msg, returns a list of the responses of statements that return anything
+    def handle_statements(self, msg, client_socket):
+        responses = []
+
+        for stmt in msg.split("; "):
+            # Look up the handler by the statement's verb. Ignore unrecognized statements
+            verb, _, args = stmt.partition(" ")
+            handler = self.statement_handlers.get(verb)
+            if handler is None: continue
+
+            response = handler(args, client_socket)
+
+            # Did the statement return a response?
+            if response is not None: responses.append(response)
+
+        return responses
+
+    #
+    # Statement Handlers
+    #
+
+    # Handle RESET request: RESET [client_id]
+    # A client id switches this connection to the client's session, for clients that can't give it in the URL
+    def handle_reset(self, args, client_socket):
+        if args: self.session = self.get_session(args)
+        self.wait_screenshot(self.session)
+        self.reset_data()
+
+    # Handle UPDATE request
+    # In HUMAN mode, records a step instead of calling update()
+    def handle_update(self, args, client_socket):
+        self.wait_screenshot(self.session)  # The screenshot taken before this UPDATE
+        self.actions += 1
+        if self.update_workers is not None and self.recorder is None:
+            self.call_update_by_deadline(self.session)
+            return
+        self.action = None  # Controls are sent from the dictionary, unless update() chooses an action
+        if self.recorder is not None:
+            self.record_demonstration()
+            return
+        if self.batcher is not None:         self.batcher.submit(self.session)
+        elif self.shared_memory is not None: self.call_shared_update(self.session)
+        else:                                self.call_update(self.session)
+        if self.replay is not None: self.record_replay(self.screenshots.last(1)[0] if self.screenshots.count else None)
+
+    # Runs update() (or the session's batch) on a worker, waiting at most update_deadline seconds for it
+    # If it's late, the client is sent its previous controls, with guessed set. The late update() keeps running, and the
+    # client's next UPDATE waits on it instead of starting another. Once it finishes, its controls are sent instead
+    def call_update_by_deadline(self, session):
+        with self.deadline_lock:
+            future = session.update_future
+            if future is None or future.done():
+                if future is not None:  # A late update() finished. Raise whatever it raised, once
+                    session.update_future = None
+                    future.result()
+                previous = self.controls_of(session)  # Sent last time, or chosen by the late update()
+                session.action = None  # Controls are sent from the dictionary, unless update() chooses an action
+                # The frame is copied now, since more may be stored before update() returns and it's recorded into replay
+                frame = None
+                if session.replay is not None and session.screenshots.count:
+                    frame = session.screenshots.last(1)[0].copy()
+                future = session.update_future = self.update_workers.submit(self.run_update, session, frame)
+            else:
+                previous = session.sent_controls  # Still waiting on the same late update()
+
+        try:
+            future.result(timeout = self.update_deadline)
+        except concurrent.futures.TimeoutError:
+            if not future.done():  # Otherwise update() raised it
+                with self.deadline_lock:
+                    session.sent_controls = previous
+                    session.guessed = True
+                    session.missed_deadlines += 1
+                self.stats.count("missed_deadlines")
+                future.add_done_callback(lambda done: self.finish_late_update(session, done))
+                return
+            raise
+        finally:
+            # Finished, or failed: the next UPDATE starts a new update(), so an exception is only raised once
+            if future.done():
+                with self.deadline_lock:
+                    if session.update_future is future: session.update_future = None
+                    if session.sent_controls is not None:  # Back on time. Stop sending the previous controls
+                        session.sent_controls = None
+                        session.guessed = False
+
+    # Sends the controls chosen by an update() that missed its deadline, once it finishes, until the next UPDATE
+    def finish_late_update(self, session, future):
+        if future.exception() is not None: return  # Raised by the client's next UPDATE
+        with self.deadline_lock:
+            if session.update_future is future and session.sent_controls is not None:
+                session.sent_controls = self.controls_of(session)
+
+    # Calls update() for a session, in a worker's thread, then records frame (the latest screenshot when the UPDATE
+    # came, or None) into replay, along with the action update() chose and the reward it set, even if it was late
+    def run_update(self, session, frame = None):
+        with self.using_session(session):
+            if self.batcher is not None:         self.batcher.submit(session)
+            elif self.shared_memory is not None: self.call_shared_update(session)
+            else:                                self.call_update(session)
+            if session.replay is not None: self.record_replay(frame)
+
+    # Publishes a session's latest observation to the shared ring, then uses the action a trainer answers it with
+    # update() is called first if it's replaced, for game logic like setting reward or calling new_episode()
+    def call_shared_update(self, session):
+        if type(self).update is not BHServer.update: self.call_update(session)
+        if not session.screenshots.count: return
+        observation = self.observation_of(session)
+
+        shared = self.shared
+        if shared is None:
+            with self.sessions_lock:
+                if self.closed: return
+                if self.shared is None:
+                    self.shared = SharedObservationRing(
+                        self.shared_memory, observation.shape, observation.dtype, self.shared_capacity, self.shared_clients
+                    )
+                shared = self.shared
+
+        try:
+            seq = shared.publish(
+                session.shared_client, observation, session.episodes, session.actions, session.reward, session.done
+            )
+        except ValueError:
+            if shared.closed: return  # Closed by close() meanwhile
+            raise
+        if session.replay is None:  # Otherwise reset once recorded
+            session.reward = 0.0
+            session.done = False
+
+        start = time.perf_counter()
+        action = shared.wait_action(session.shared_client, seq, self.shared_timeout)
+        self.stats.record("trainer", start)
+        if action is None:  # No answer in time, or closed. The client keeps its controls
+            if not shared.closed: print("ERROR: No trainer answered within shared_timeout. Keeping the previous controls")
+            session.guessed = True
+            return
+        with self.using_session(session):
+            self.use_action(action)
+
+    # Records the latest screenshot, the controls played at it (as an action index, if there's an action_space), ram
+    # and data into the session's demonstration dataset
+    def record_demonstration(self):
+        if not self.screenshots.count: return
+        start = time.perf_counter()
+        controls = self.controls
+        # Data is copied now, since it's written later by the recorder's threads, while clients keep changing it
+        data = {
+            var: val.values.tolist() if isinstance(val, DataArray) else copy_value(val)
+            for var, (_, val) in list(self.data.items())
+        }
+        self.recorder.add(
+            self.screenshots.last(1)[0],
+            -1 if self.action_space is None else self.action_space.encode(controls),
+            [float(controls.get(name, 0)) for name in self.recorder.control_names],
+            self.ram,
+            data,
+            self.episodes,
+            self.actions - 1
+        )
+        self.stats.record("record", start)
+
+    # Writes every recorded step of every client to disk. Call before the server's process exits
+    def flush_recordings(self):
+        for session in list(self.sessions.values()):
+            if session.recorder is not None: session.recorder.flush()
+
+    # Frees what the server holds outside its process: writes every recording, then closes and unlinks the shared ring,
+    # waking UPDATEs waiting on trainers (they keep their controls). Call before the server's process exits
+    def close(self):
+        self.flush_recordings()
+        with self.sessions_lock:
+            self.closed = True
+            shared, self.shared = self.shared, None
+        if shared is not None: shared.close()
+
+    # Records a frame (None if there's no screenshot yet), the action chosen for it, and the reward and done flag set
+    # since the last frame, into replay
+    def record_replay(self, frame):
+        if frame is not None:
+            self.replay.add(frame, self.action, self.reward, self.done)
+        self.reward = 0.0
+        self.done = False
+
+    # Handle STEP request: STEP [path]
+    # One request per step: stores the PNG at path as a screenshot (written by the client with client.screenshot()),
+    # handles an UPDATE, then returns controls, restart, exit and guessed, separated by '; '
+    # Without a path, the screenshot is expected from a FRAME statement or comm.httpPostScreenshot() beforehand
+    # If the frame is outside frame_directory, or can't be read or decoded, nothing is updated, and the response is
+    # "ERROR: ..." instead
+    def handle_step(self, args, client_socket):
+        if args:
+            if not self.in_frame_directory(args):
+                print("ERROR: Frame " + args + " is outside frame_directory")
+                return "ERROR: Frame " + args + " is outside frame_directory"
+            try:
+                with open(args, "rb") as f:
+                    png = f.read()
+            except OSError as e:
+                print("ERROR: Could not read frame " + args + ": " + str(e))
+                return "ERROR: Could not read frame " + args
+            try:
+                self.store_screenshot(png)
+            except Exception as e:  # Decoders raise many kinds of errors on files that aren't images
+                print("ERROR: Could not decode frame " + args + ": " + str(e))
+                return "ERROR: Could not decode frame " + args
+
+        self.handle_update("", client_socket)
+        return "; ".join((self.get_controls(""), self.get_restart(""), self.get_exit(""), str(self.guessed)))
+
+    # Returns whether STEP may read a frame from path: always without frame_directory, else if it resolves inside it
+    def in_frame_directory(self, path):
+        if self.frame_directory is None: return True
+        try:
+            return os.path.commonpath((os.path.realpath(path), self.frame_directory)) == self.frame_directory
+        except ValueError:  # On another drive
+            return False
+
+    # Calls update(), given the session of the client that requested it
+    # update(self) reads and writes the client's session through the server's attributes, update(self, session) is
+    # also given the session
+    def call_update(self, session):
+        update = self.update
+        with self.update_lock:
+            start = time.perf_counter()
+            if update.__code__.co_argcount > 1: update(session)
+            else:                               update()
+            self.stats.record("update", start)
+
+    # Handle GET request: GET var [idx]
+    def handle_get(self, args, client_socket):
+        self.log("GET requested...")
+        var, _, idx = args.partition(" ")
+
+        # Handle variable requests outside of self.data
+        handler = self.get_handlers.get(var)
+        if handler is not None: return handler(idx)
+
+        #
+        # Handle variable requests inside self.data
+        #
+
+        # Are we getting the element of a list?
+        if idx:
+            idx = int(idx)
+
+            # Does the list not exist?
+            if self.data.get(var) is None: return "None"
+
+            lst = self.data[var][1]
+
+            # Does the element exist?
+            if idx >= len(lst) or idx < -1 * len(lst): return "None"
+
+            # Return the list element
+            return str(lst[idx])
+
+        # Are we getting the value of a variable?
+        val = self.data.get(var)
+
+        # Does the variable not exist?
+        if val is None: return "None"
+
+        # Send response, formatted based on data type
+        if val[0] == "DICT": return dict_as_str(val[1])
+        return val[0] + " " + str(val[1])
+
+    # Returns controls as a string. Prebuilt if chosen by use_action(), and not edited directly since
+    def get_controls(self, idx):
+        sent = self.sent_controls
+        if sent is not None: return sent
+        return self.controls_of(self.session)
+
+    # Returns the controls of a session as a string, ignoring sent_controls
+    def controls_of(self, session):
+        action = session.action
+        if action is not None: return self.action_space.response(action, session.controls)
+        return dict_as_str(session.controls)
+
+    # Returns a screenshot as its raw bytes in Base64, or None if it isn't stored
+    def get_screenshot(self, idx):
+        self.wait_screenshot(self.session)
+        idx = int(idx)
+        if idx not in self.screenshots: return "None"
+        return base64.b64encode(self.screenshots[idx].tobytes()).decode("utf-8")
+
+    # Returns the value of exit, then clears it
+    def get_exit(self, idx):
+        exit = self.exit
+        self.exit = False
+        return str(exit)
+
+    # Returns the value of restart, then clears it
+    def get_restart(self, idx):
+        restart = self.restart
+        self.restart = False
+        return str(restart)
+
+    # Handle SET request
+    def handle_set(self, args, client_socket):
+        self.log("SET requested...")
+
+        # Setting variable:
+        # 	SET name type val
+        # Setting list:
+        # 	SET name type[] []
+        # Setting list element value:
+        # 	SET name idx val
+
+        # Handle variable requests outside self.data
+        var, _, val = args.partition(" ")
+        handler = self.set_handlers.get(var)
+        if handler is not None: return handler(var, val)
+
         #
-        # Handle every statement inside msg
+        # Handle variable requests inside self.data
         #
 
+        parts = args.split(" ", 2)
+        if len(parts) < 3 or not parts[1]:
+            print("ERROR: Malformed SET statement " + args)
+            return
+        var, data_type, val = parts
+
+        # Are we setting list elements?
+        if data_type[0].isdigit():
+            self.set_elements(var, data_type, val)
+            return
+
+        # Convert the value according to the datatype
+        try:
+            self.data[var] = (data_type, parse_data(data_type, val))
+        except KeyError:
+            print("ERROR: Unrecognized datatype " + data_type)
+        except (ValueError, SyntaxError):
+            print(val)
+            if data_type.endswith("[]"): print("ERROR: List initialization value does not match datatype")
+            else:                        print("ERROR: Data value does not match datatype")
+
+    # Sets elements of a list in self.data, starting at idx. Elements past the end are appended
+    # Given "idx" and one element, or "idx:" and a list of elements
+    def set_elements(self, var, idx, val):
+        existing_var = self.data.get(var)
+
+        # Does the variable exist?
+        if existing_var is None:
+            print("ERROR: Attempt to index non-existent list " + var)
+            return
+
+        data_type, lst = existing_var
+        if not data_type.endswith("[]"):
+            print("ERROR: Attempt to index non-list " + var)
+            return
+
+        try:
+            if idx.endswith(":"):
+                idx = int(idx[:-1])
+                elements = parse_elements(data_type[:-2], val)
+            else:
+                idx = int(idx)
+                elements = [DATA_PARSERS[data_type[:-2]](val)]
+                if isinstance(lst, DataArray): elements = np.array(elements, lst.values.dtype)
+        except (ValueError, OverflowError, SyntaxError):
+            print(val)
+            print("ERROR: Data value does not match datatype")
+            return
+
+        # Are we setting existing elements, or appending new ones?
+        if idx > len(lst):
+            print("ERROR: List " + var + "[" + str(idx) + "]" + " index out of range")
+        elif isinstance(lst, DataArray):
+            lst.set(idx, elements)
+        else:
+            lst[idx:idx + len(elements)] = elements
+
+    # Handle APPEND request: APPEND name val, or APPEND name [e1, e2, ...]
+    # Appends one or many elements to the end of a list in self.data
+    def handle_append(self, args, client_socket):
+        var, _, val = args.partition(" ")
+        existing_var = self.data.get(var)
+        length = 0 if existing_var is None else len(existing_var[1])
+        self.set_elements(var, str(length) + (":" if val.lstrip().startswith("[") else ""), val)
+
+    # Handle FRAME request: FRAME width height format pixels
+    # Stores raw pixels as a screenshot, given in hex so they pass through comm.httpPost()'s URL encoding unchanged
+    def handle_frame(self, args, client_socket):
+        try:
+            width, height, pixel_format, pixels = args.split(" ", 3)
+            self.store_frame(bytes.fromhex(pixels), int(width), int(height), pixel_format)
+        except ValueError as e:
+            print("ERROR: Malformed FRAME statement: " + str(e))
+
+    # Handle JOYPAD request: JOYPAD name:value,name:value,...
+    # Sets controls to the joypad read by the client, while a person plays (HUMAN mode)
+    def handle_joypad(self, args, client_socket):
+        for pair in args.split(","):
+            name, _, val = pair.rpartition(":")
+            if not name: continue
+            if val in ("true", "True"):     self.controls[name] = True
+            elif val in ("false", "False"): self.controls[name] = False
+            else:
+                try:
+                    self.controls[name] = int(float(val))
+                except ValueError:
+                    print("ERROR: Unrecognized joypad value " + pair)
+
+    # Handle RAM request: RAM addr hex [addr hex ...]
+    # Stores ranges of emulator memory into ram, each given by its start address and its bytes in hex
+    def handle_ram(self, args, client_socket):
+        parts = args.split(" ")
+        if len(parts) % 2:
+            print("ERROR: Malformed RAM statement: expected pairs of address and bytes")
+            return
 
-        new_msg = True  # Indicates whether msg's value has changed (i.e. any POST with payload)
-        response = ""   # Response to the current statement
-
-        # Iterate over every collection of statements
-        while new_msg:
-            new_msg = False
-
-            # Iterate over every statement inside the msg
-            for stmt in msg.split("; "):
-                returns = False  # Indicates whether the statement returns anything
-
-                #
-                # Handle RESET request
-                #
-
-                if stmt.startswith("RESET"):
-                    # Reset variables
-                    self.reset_data()
-
-                #
-                # Handle UPDATE request
-                #
-
-                elif stmt.startswith("UPDATE"):
-                    self.actions += 1
-                    self.update()
-
-                #
-                # Handle GET request
-                #
-
-                elif stmt.startswith("GET"):
-                    self.log("GET requested...")
-                    returns = True
-                    match = re.match(r"GET (.*)", stmt, re.I)
-                    var = match.group(1)
-
-                    #
-                    # Handle variable requests outside of self.data
-                    #
-
-                    # Dictionaries
-                    if var.startswith("screenshots "): response += self.screenshots[int(var[11:])].decode("utf-8")
-                    elif var == "controls":            response += dict_as_str(self.controls)
-                    # Strings
-                    elif var == "rom":                 response += self.rom
-                    elif var == "save":                response += self.save
-                    # Integers
-                    elif var == "update_interval":     response += str(self.update_interval)
-                    elif var == "speed":               response += str(self.speed)
-                    elif var == "frameskip":           response += str(self.frameskip)
-                    # Booleans
-                    elif var == "exit":
-                        response += str(self.exit)
-                        self.exit = False
-                    elif var == "restart":
-                        response += str(self.restart)
-                        self.restart = False
-                    elif var == "sound":               response += str(self.sound)
-                    elif var == "guessed":             response += str(self.guessed)
-
-                    #
-                    # Handle variable requests inside self.data
-                    #
-
-                    else:
-                        splt = var.split(' ')
-
-                        # Are we getting the element of a list?
-                        if len(splt) == 2:
-                            var = splt[0]
-                            idx = int(splt[1])
-
-                            # Does the list not exist?
-                            if self.data.get(var) is None:
-                                response += "None"
-
-                            else:
-                                lst = self.data[var][1]
-
-                                # Does the element exist?
-                                if idx >= len(lst) or idx < -1 * len(lst):
-                                    response += "None"
-
-                                # Return the list element
-                                else:
-                                    response += str(lst[idx])
-
-                        # Are we getting the value of a variable?
-                        else:
-                            val = self.data.get(var)
-
-                            # Does the variable not exist?
-                            if val is None: response += "None"
-
-                            else:
-                                # Send response, formatted based on data type
-                                if val[0] == "DICT": response += dict_as_str(val[1])
-                                else:                response += val[0] + " " + str(val[1])
-
-                #
-                # Handle SET request
-                #
-
-                elif stmt.startswith("SET"):
-                    self.log("SET requested...")
-
-                    # Setting variable:
-                    # 	SET name type val
-                    # Setting list:
-                    # 	SET name type[] []
-                    # Setting list element value:
-                    # 	SET name idx val
-
-                    match = re.match(r"SET (.*)", stmt, re.I)
-                    after_set = match.group(1)
-
-                    #
-                    # Handle variable requests outside self.data
-                    #
-
-                    # Dictionaries
-                    if after_set.startswith("screenshots"):
-                        print("ERROR: screenshots is read only")
-                    elif after_set.startswith("controls"):
-                        print("ERROR: controls is read only")
-                    # Strings
-                    elif after_set.startswith("rom"):
-                        print("ERROR: rom is read only")
-                    elif after_set.startswith("save"):
-                        print("ERROR: save is read only")
-                    # Integers
-                    elif after_set.startswith("update_interval"):
-                        print("ERROR: update_interval is read only")
-                    elif after_set.startswith("actions"):
-                        print("ERROR: actions is read only")
-                    elif after_set.startswith("speed"):
-                        print("ERROR: speed is read only")
-                    elif after_set.startswith("frameskip"):
-                        print("ERROR: frameskip is read only")
-                    # Booleans
-                    elif after_set.startswith("exit"):
-                        print("ERROR: exit is read only")
-                    elif after_set.startswith("restart"):
-                        self.restart = after_set[8:]
-                    elif after_set.startswith("sound"):
-                        print("ERROR: sound is read only")
-                    elif after_set.startswith("guessed"):
-                        print("ERROR: guessed is read only")
-
-                    #
-                    # Handle variable requests inside self.data
-                    #
-
-                    else:
-                        match = re.match(r"([^ ]*) ([^ ]*) (.*)", match.group(1), re.I)
-
-                        var = match.group(1)
-                        val = match.group(3)
-                        existing_var = self.data.get(var)
-
-                        has_idx = False
-
-                        # Are we setting a list element?
-                        if match.group(2)[0].isdigit():
-                            has_idx = True
-                            idx = int(match.group(2))
-
-                            # Does the variable exist?
-                            if existing_var is None:
-                                print("ERROR: Attempt to index non-existent list " + var)
-                                return
-
-                            data_type = existing_var[0]
-
-                        # Are we setting a variable?
-                        else: data_type = match.group(2)
-
-                        # Convert the value according to the datatype
-                        if data_type.startswith("INT") or data_type.startswith("BOOL") or data_type.startswith("STRING"):
-                            try:
-                                val = ast.literal_eval(val)
-                            except:
-                                print(val)
-                                print("ERROR: Data value does not match datatype")
-                                return
-                        # TODO Check if BOOL when INT, INT when BOOL,
-                        # TODO INT inside BOOL list, BOOL inside INT list
-                        else:
-                            print("ERROR: Unrecognized datatype " + data_type)
-                            return
-
-                        # Are we working on a list?
-                        if data_type.endswith("[]"):
-                            if not isinstance(val, list) and not has_idx:
-                                print("ERROR: List initialization value does not match datatype")
-                                return
-
-                            # Are we initializing a new list?
-                            if existing_var is None and not has_idx:
-                                self.data[var] = (data_type, val)
-
-                            # Are we setting a list element or re-initializing the list?
-                            else:
-                                # Are we given a data type rather than an index?
-                                if not has_idx:
-                                    # Re-initialize the list
-                                    self.data[var] = (data_type, val)
-                                else:
-                                    lst = existing_var[1]
-
-                                    # Are we setting an existing element, or appending a new one?
-                                    if idx < len(lst):    lst[idx] = val
-                                    elif idx == len(lst): lst.append(val)
-
-                                    # Throw an error
-                                    else:
-                                        print("ERROR: List " + var + "[" + str(idx) + "]" + " index out of range")
-                                        return
-
-                        # Are we setting a non-list variable?
-                        else:
-                            self.data[var] = (data_type, val)
-
-                #
-                # Handle POST requests (from BizHawk's comm.http* functions)
-                #
-
-                elif stmt.startswith("POST"):
-                    # 68,859
-
-                    response = "HTTP/1.1 200 OK\r\n\r\n"
-                    self.close_client = True  # BizHawk expects connection to close after each Lua method call
-
-                    # Check the size of the body
-                    match = re.match(".*Content-Length: (\d*).*", stmt, re.S)
-                    cont_len = int(match.group(1))
-                    self.log("CONTENT_LENGTH: " + str(cont_len))
-
-                    # Should we expect the body in a new message directly after this one?
-                    if stmt.endswith("\r\n\r\n"):
-                        # Respond, to get the next message
-                        client_socket.send(response.encode("utf-8"))
-
-                        # Receive next message, replace old msg
-                        msg = client_socket.recv(cont_len).decode()
-
-                    # Check if message is screenshot
-                    screenshot_idx = msg[0:180].find("screenshot=")
-
-                    # Is this a screenshot?
-                    if screenshot_idx != -1:
-                        screenshot = msg[screenshot_idx + 11:]
-
-                        # Receive messages until msg size equals Content-Length
-                        while len(screenshot.encode("utf-8")) + 11 < cont_len:
-                            # Receive next msg
-                            msg = client_socket.recv(cont_len).decode()
-                            screenshot += msg
-
-                        # Store screenshot as numpy.ndarray (replace if already exists)
-                        img = base64.b64decode(unquote_plus(screenshot))  # Using unquote because urlsafe_ doesn't work
-                        img = mpimg.imread(io.BytesIO(img), format = 'png')
-                        if self.use_grayscale:
-                            img = to_grayscale(img)
-                        self.screenshots[self.actions] = img
-
-                    # Assume this is an HTTP-formatted POST command
-                    else:
-                        match = re.match(".*payload=(.*)", msg, re.S)
-                        msg = unquote_plus(match.group(1))
-
-                        # Re-iterate. handling body as new message
-                        new_msg = True
-
-                # Did the statement return a response?
-                if returns: response += "; "
-
-                # Ignore any other statements (though there shouldn't be any more)
-                if new_msg: break
-
-        # Send back the response. Remove final separator
-        if response.endswith("; "): client_socket.send(response.encode("utf-8")[:-2])
-        else:                       client_socket.send(response.encode("utf-8"))
+        try:
+            for addr, data in zip(parts[::2], parts[1::2]):
+                self.store_ram(int(addr, 0), bytes.fromhex(data))
+        except ValueError as e:
+            print("ERROR: Malformed RAM statement: " + str(e))
+
+    # Stores bytes of emulator memory into ram, starting at addr. Grows ram if they reach past its end
+    def store_ram(self, addr, data):
+        ram = self.ram
+        end = addr + len(data)
+        if end > len(ram):
+            grown = np.zeros(end, np.uint8)
+            grown[:len(ram)] = ram
+            self.ram = ram = grown
+        ram[addr:end] = np.frombuffer(data, np.uint8)
+
+    # Rejects a SET of a variable the client may only read
+    def set_read_only(self, var, val):
+        print("ERROR: " + var + " is read only")
+
+    # Sets restart from the client
+    def set_restart(self, var, val):
+        self.restart = val
+
+    # Handle POST requests (from BizHawk's comm.http* functions). Returns the HTTP response
+    def handle_post(self, msg, client_socket):
+        self.close_client = True  # BizHawk expects connection to close after each Lua method call
+
+        # Receive the rest of the headers, if they were split
+        head_end = msg.find(HEADER_END)
+        while head_end == -1:
+            chunk = client_socket.recv(self.BUFSIZE)
+            if not chunk: return HTTP_OK
+            self.stats.count("bytes_in", len(chunk))
+            msg += chunk
+            head_end = msg.find(HEADER_END)
+        body_start = head_end + len(HEADER_END)
+
+        # Check the size of the body
+        cont_len = self.content_length(msg, head_end)
+
+        # Should we expect the body in a new message directly after this one?
+        if len(msg) == body_start and cont_len > 0:
+            # Respond, to get the next message
+            client_socket.send(HTTP_OK.encode("utf-8"))
+            self.stats.count("bytes_out", len(HTTP_OK))
+
+        body = self.receive_body(msg, body_start, cont_len, client_socket)
+        if body is None: return HTTP_OK
+        return self.handle_post_body(body, client_socket)
+
+    # Returns a body of the given length, starting at body_start in msg. The rest is received from the client straight
+    # into the buffer. Returns None if the client disconnects first
+    def receive_body(self, msg, body_start, length, client_socket):
+        # Copy what we have of the body into a buffer that holds all of it
+        body = bytearray(length)
+        view = memoryview(body)
+        received = max(0, min(len(msg) - body_start, length))
+        view[:received] = msg[body_start:body_start + received]
+
+        # Receive the rest of the body straight into the buffer
+        if received < length:
+            start = time.perf_counter()
+            self.stats.count("bytes_in", length - received)
+            while received < length:
+                size = client_socket.recv_into(view[received:], length - received)
+                if size == 0:
+                    print("ERROR: Client disconnected before sending the whole body")
+                    return None
+                received += size
+            self.stats.record("receive", start)
+
+        view.release()
+        return body
+
+    # Returns the Content-Length of an HTTP POST, given its headers and where they end
+    def content_length(self, msg, head_end):
+        match = CONTENT_LENGTH_PATTERN.search(msg, 0, head_end)
+        cont_len = int(match.group(1)) if match else 0
+        self.log("CONTENT_LENGTH: " + str(cont_len))
+        return cont_len
+
+    # Handles the whole body of an HTTP POST. Returns the HTTP response
+    def handle_post_body(self, body, client_socket):
+        # Is this a screenshot?
+        screenshot_idx = body.find(SCREENSHOT_KEY, 0, 180)
+        if screenshot_idx != -1:
+            # Decode the screenshot once it is all received
+            png = self.unquote_screenshot(bytes(memoryview(body)[screenshot_idx + len(SCREENSHOT_KEY):]))
+            if self.decode_pool is not None:
+                self.submit_screenshot(png)
+                return HTTP_OK
+
+            # Store screenshot as numpy.ndarray (replace if already exists)
+            self.store_screenshot(png)
+            return HTTP_OK
+
+        # Is this a raw frame? Its pixels are not URL-encoded, so they're read in place
+        if body.startswith(FRAME_KEY):
+            self.store_frame_body(body)
+            return HTTP_OK
+
+        # Assume this is an HTTP-formatted POST command. Handle its body as new statements
+        payload_idx = body.find(PAYLOAD_KEY)
+        if payload_idx == -1: return HTTP_OK
+        start = time.perf_counter()
+        msg = unquote_plus(body[payload_idx + len(PAYLOAD_KEY):].decode("utf-8"))
+        self.stats.record("unquote", start)
+        return HTTP_OK + "; ".join(self.handle_statements(msg, client_socket))
+
+    # Handles length-prefixed messages, "LENGTH MESSAGE", from a client keeping its connection open (BizHawk's
+    # comm.socketServerSend). The message holds statements, a PNG screenshot, or a raw frame. Returns the response,
+    # prefixed with its length the same way
+    def handle_framed(self, msg, client_socket):
+        # Receive the rest of the length, if it was split
+        space = msg.find(b" ")
+        while space == -1:
+            chunk = client_socket.recv(self.BUFSIZE)
+            if not chunk: return ""
+            self.stats.count("bytes_in", len(chunk))
+            msg += chunk
+            space = msg.find(b" ")
+
+        length = int(msg[:space])
+        body = self.receive_body(msg, space + 1, length, client_socket)
+        if body is None: return ""
+
+        if body.startswith(PNG_SIGNATURE):
+            self.store_screenshot(bytes(body))
+            response = ""
+        elif body.startswith(FRAME_KEY):
+            self.store_frame_body(body)
+            response = ""
+        else:
+            response = "; ".join(self.handle_statements(body.decode("utf-8"), client_socket))
+
+        response = str(len(response.encode("utf-8"))) + " " + response
+
+        # Were more messages sent before this response? Handle them too
+        rest = msg[space + 1 + length:]
+        if rest: response += self.handle_framed(rest, client_socket)
+        return response
+
+    # Decodes the bytes of a PNG screenshot into screenshots, at the current action
+    def store_screenshot(self, img):
+        self.wait_screenshot(self.session)
+        self.store_image(self.screenshot_decoder, img)
+
+    # Returns the bytes of a screenshot POST's PNG, given its URL-encoded Base64
+    def unquote_screenshot(self, screenshot):
+        start = time.perf_counter()
+        screenshot = unquote_to_bytes(screenshot)  # Base64 holds no spaces, so no '+' needs unquoting
+        self.stats.record("unquote", start)
+        start = time.perf_counter()
+        img = base64.b64decode(screenshot)  # Using unquote because urlsafe_ doesn't work
+        self.stats.record("base64", start)
+        return img
+
+    # Hands the PNG of a screenshot POST to decode_threads, so the POST is answered before it's decoded
+    # Its URL-encoding and Base64 are undone beforehand, since they hold the GIL. Only the decoder runs on the threads
+    # A client's screenshots are stored in order, and wait_screenshot() waits for the latest
+    def submit_screenshot(self, png):
+        session = self.session
+        self.wait_screenshot(session)
+        session.screenshot_future = self.decode_pool.submit(
+            self.decode_screenshot, session, png, time.perf_counter()
+        )
+
+    # Decodes and stores a screenshot handed to decode_threads, given the session it belongs to and when it was handed
+    def decode_screenshot(self, session, png, submitted):
+        with self.using_session(session):
+            try:
+                self.store_image(self.screenshot_decoder, png)
+            except Exception as e:
+                print("ERROR: Could not decode screenshot: " + str(e))
+        self.stats.record("screenshot", submitted)
+
+    # Waits until a session's screenshot handed to decode_threads, if any, is stored
+    def wait_screenshot(self, session):
+        future = session.screenshot_future
+        if future is None: return
+        if not future.done():
+            start = time.perf_counter()
+            concurrent.futures.wait((future,))
+            self.stats.record("screenshot_wait", start)
+        session.screenshot_future = None
+
+    # Stores a raw frame into screenshots, given a body of "frame=WIDTH HEIGHT FORMAT " followed by the pixel bytes
+    def store_frame_body(self, body):
+        try:
+            header_end = body.index(b" ", body.index(b" ", body.index(b" ") + 1) + 1)
+            width, height, pixel_format = bytes(body[len(FRAME_KEY):header_end]).decode("ascii").split(" ")
+            self.store_frame(memoryview(body)[header_end + 1:], int(width), int(height), pixel_format)
+        except ValueError as e:
+            print("ERROR: Malformed frame: " + str(e))
+
+    # Stores raw pixels into screenshots, at the current action, given their size and one of PIXEL_FORMATS
+    def store_frame(self, pixels, width, height, pixel_format):
+        self.wait_screenshot(self.session)
+        self.store_image(decode_raw, pixels, width, height, pixel_format)
+
+    # Stores a screenshot into screenshots at the current action, given a decoder and the arguments it decodes
+    # With a pipeline, the screenshot is decoded into a raw frame, and its observation is stored instead
+    def store_image(self, decoder, *args):
+        start = time.perf_counter()
+        pipeline = self.pipeline
+        reserve = lambda shape, dtype: self.screenshots.reserve(self.actions, shape, dtype)
+        decoder(
+            *args,
+            reserve if pipeline is None else lambda shape, dtype: pipeline.reserve(self.actions, shape, dtype),
+            grayscale = self.use_grayscale or (pipeline is not None and pipeline.grayscale),
+            scale = self.screenshot_scale,
+            dtype = self.screenshot_dtype
+        )
+        self.stats.record("decode", start)
+        if pipeline is not None:
+            start = time.perf_counter()
+            pipeline.process(reserve)
+            self.stats.record("pipeline", start)
+        self.screenshots.commit()
+
+        if self.screenshot_history is not None:
+            self.screenshot_history[self.history_episode + self.episodes, self.actions] = self.screenshots[self.actions]
 
     #
     # Auxilliary Static Functions
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+# Tests import BHServer and BHBenchmark (for its server and screenshot helpers) from the parent directory
+# Run from the repository: python -m pytest tests
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BHBenchmark import make_png, RESOLUTIONS  # noqa: E402
+
+
+# Bytes of a NES-sized PNG, given a seed for its colors
+@pytest.fixture
+def png():
+    return lambda seed = 0: make_png(RESOLUTIONS["NES"], seed)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from BHBenchmark import make_server
+
+
+def test_restores_every_data_type(tmp_path):
+    server = make_server()
+    server.handle_statements('SET n INT 7; SET ints INT[] [1,2,3]; SET bools BOOL[] [True,False]; SET names STRING[] ["a", "b"]', None)
+    server.data["table"] = ("DICT", {"a": 1, "b": 2})
+    server.checkpoint(str(tmp_path), wait = True)
+
+    restored = make_server()
+    restored.restore(str(tmp_path))
+    data = restored.data
+    assert data["n"] == ("INT", 7)
+    assert data["ints"][0] == "INT[]" and data["ints"][1].values.tolist() == [1, 2, 3]
+    assert data["bools"][0] == "BOOL[]" and data["bools"][1].values.tolist() == [True, False]
+    assert data["names"] == ("STRING[]", ["a", "b"])
+    assert data["table"] == ("DICT", {"a": 1, "b": 2})
+
+
+def test_header_is_a_copy_of_the_session(tmp_path):
+    server = make_server(screenshot_decoder = "pillow")
+    server.data["names"] = ("STRING[]", ["a"])
+    server.controls["P1 A"] = False
+    header, rings, arrays = server.checkpoint_snapshot(str(tmp_path))
+
+    server.data["names"][1].append("b")
+    server.controls["P1 A"] = True
+    state = header["sessions"][0]
+    assert state["data"]["names"][1] == ["a"]
+    assert state["controls"]["P1 A"] is False
+
+
+def test_screenshots_are_restored_to_their_actions(tmp_path, png):
+    server = make_server(screenshot_decoder = "pillow")
+    for action in range(5):
+        server.actions = action
+        server.store_screenshot(png(action))
+    server.checkpoint(str(tmp_path), wait = True)
+
+    restored = make_server(screenshot_decoder = "pillow")
+    restored.restore(str(tmp_path))
+    for action in range(5):
+        assert np.array_equal(restored.screenshots[action], server.screenshots[action])
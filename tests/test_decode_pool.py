@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from BHBenchmark import make_server, make_screenshot_body
+
+
+def test_screenshots_are_stored_in_order_at_their_actions(png):
+    pngs = [png(seed) for seed in range(4)]
+    bodies = [make_screenshot_body(p) for p in pngs]
+    inline = make_server(screenshot_decoder = "pillow")
+    pooled = make_server(screenshot_decoder = "pillow", decode_threads = 4)
+    sessions = [pooled.get_session("emu" + str(idx)) for idx in range(3)]
+
+    # Clients take turns, each sending a screenshot and then an UPDATE, like BHClient
+    for step in range(8):
+        for idx, session in enumerate(sessions):
+            with pooled.using_session(session):
+                pooled.handle_post_body(bodies[(step + idx) % len(bodies)], None)
+                pooled.handle_update("", None)
+
+    expected = {}
+    for seed, p in enumerate(pngs):
+        inline.actions = seed
+        inline.store_screenshot(p)
+        expected[seed] = inline.screenshots[seed]
+
+    for idx, session in enumerate(sessions):
+        pooled.wait_screenshot(session)
+        assert session.screenshots.count == 8
+        for step in range(8):
+            assert np.array_equal(session.screenshots[step], expected[(step + idx) % len(pngs)])
+
+
+def test_update_waits_for_its_screenshot(png):
+    server = make_server(screenshot_decoder = "pillow", decode_threads = 1)
+    server.handle_post_body(make_screenshot_body(png()), None)
+    server.handle_update("", None)
+    assert server.session.screenshot_future is None
+    assert server.screenshots.count == 1
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from BHServer import DemonstrationWriter, DemonstrationDataset
+from BHBenchmark import make_server
+
+
+def test_recorded_data_is_a_snapshot(tmp_path, png):
+    server = make_server(mode = "HUMAN", recording_path = str(tmp_path / "run"), screenshot_decoder = "pillow")
+    server.handle_statements('SET names STRING[] ["a"]; SET ints INT[] [1]', None)
+    server.data["table"] = ("DICT", {"a": 1})
+    server.store_screenshot(png())
+    server.handle_update("", None)
+
+    # Changed by the next messages, before the step is written
+    server.handle_statements('APPEND names "b"; APPEND ints 2', None)
+    server.data["table"][1]["a"] = 2
+    server.flush_recordings()
+
+    data = DemonstrationDataset(str(tmp_path / "run"))[0]["data"]
+    assert data == [{"names": ["a"], "ints": [1], "table": {"a": 1}}]
+
+
+def test_data_that_cant_be_written_is_stored_as_null(tmp_path, capsys):
+    writer = DemonstrationWriter(str(tmp_path), ["P1 A"], chunk_size = 3)
+    frame = np.zeros((2, 2, 3), np.uint8)
+    ram = np.zeros(4, np.uint8)
+    for step, data in enumerate(({"x": 0}, {"x": object()}, {"x": 2})):
+        writer.add(frame, 0, [0.0], ram, data, 0, step)
+    writer.close()
+
+    chunk = DemonstrationDataset(str(tmp_path))[0]
+    assert chunk["data"] == [{"x": 0}, None, {"x": 2}]
+    assert chunk["steps"].tolist() == [0, 1, 2]
+    assert "episode 0 step 1" in capsys.readouterr().out
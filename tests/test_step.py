@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from BHServer import FRAME_DIRECTORY
+from BHBenchmark import make_server
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def test_frames_inside_frame_directory_are_read(tmp_path, png):
+    server = make_server(screenshot_decoder = "pillow", frame_directory = str(tmp_path))
+    response = server.handle_step(write(tmp_path / "frame.png", png()), None)
+    assert not response.startswith("ERROR")
+    assert server.actions == 1
+    assert server.screenshots.count == 1
+
+
+def test_frames_outside_frame_directory_are_refused(tmp_path, png):
+    inside = tmp_path / "frames"
+    inside.mkdir()
+    outside = write(tmp_path / "frame.png", png())
+    server = make_server(screenshot_decoder = "pillow", frame_directory = str(inside))
+
+    for path in (outside, os.path.join(str(inside), "..", "frame.png")):
+        assert server.handle_step(path, None).startswith("ERROR: Frame")
+    assert server.actions == 0
+    assert server.screenshots.count == 0
+
+
+def test_frame_directory_defaults_to_the_server_directory(tmp_path, png):
+    server = make_server(screenshot_decoder = "pillow")
+    assert server.frame_directory == os.path.realpath(FRAME_DIRECTORY)
+    assert server.handle_step(write(tmp_path / "frame.png", png()), None).startswith("ERROR: Frame")
+
+
+def test_unreadable_and_undecodable_frames_are_errors(tmp_path):
+    server = make_server(screenshot_decoder = "pillow", frame_directory = str(tmp_path))
+    assert server.handle_step(str(tmp_path / "missing.png"), None).startswith("ERROR: Could not read frame")
+    assert server.handle_step(write(tmp_path / "junk.png", b"not a png"), None).startswith("ERROR: Could not decode frame")
+    assert server.actions == 0
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import pytest
+
+from BHBenchmark import BenchServer
+
+
+# Server whose update() runs the given function, counting its calls
+class DeadlineServer(BenchServer):
+    def __init__(self, behavior, **kwargs):
+        self.behavior = behavior
+        self.calls = 0
+        super().__init__(saves = {"Save/Bench.State": 1}, update_deadline = 0.05, **kwargs)
+
+    def update(self):
+        self.calls += 1
+        self.behavior(self, self.calls)
+
+
+def fail_first(server, call):
+    if call == 1: raise RuntimeError("boom")
+
+
+def test_exception_is_raised_once_then_update_runs_again():
+    server = DeadlineServer(fail_first)
+    with pytest.raises(RuntimeError, match = "boom"):
+        server.handle_update("", None)
+    server.handle_update("", None)
+    server.handle_update("", None)
+    assert server.calls == 3
+    assert server.session.update_future is None
+
+
+def fail_late(server, call):
+    if call == 1:
+        time.sleep(0.2)
+        raise RuntimeError("late")
+
+
+def test_late_exception_is_raised_once_by_the_next_update():
+    server = DeadlineServer(fail_late)
+    server.handle_update("", None)  # Misses its deadline
+    assert server.guessed
+    assert server.missed_deadlines == 1
+    time.sleep(0.3)
+
+    with pytest.raises(RuntimeError, match = "late"):
+        server.handle_update("", None)
+    server.handle_update("", None)
+    assert server.calls == 2
+    assert not server.guessed
+    assert server.sent_controls is None
+
+
+def press_late(server, call):
+    if call == 1:
+        time.sleep(0.2)
+        server.controls["P1 A"] = True
+
+
+def test_late_controls_replace_the_fallback_once_finished():
+    server = DeadlineServer(press_late)
+    fallback = server.get_controls("")
+    server.handle_update("", None)
+    assert server.get_controls("") == fallback
+    time.sleep(0.3)
+    assert "P1 A:True" in server.get_controls("").split(",")
+
+
+def reward_by_call(server, call):
+    if call == 2: time.sleep(0.3)
+    server.reward = float(call)
+    server.use_action(call % 2)
+
+
+def test_late_update_records_its_own_reward_and_action(png):
+    server = DeadlineServer(reward_by_call, replay_capacity = 16, screenshot_decoder = "pillow",
+                            actions = [("P1 A", [False, True])])
+    for step in range(3):
+        server.actions = step
+        server.store_screenshot(png(step))
+        server.handle_update("", None)
+        if step == 1: time.sleep(0.4)  # Let the late update() finish before the next UPDATE
+
+    replay = server.replay
+    assert replay.added == 3
+    assert replay.actions[:3].tolist() == [1, 0, 1]
+    assert replay.rewards[:2].tolist() == [2.0, 3.0]  # Each reward is set for the previous frame